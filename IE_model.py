@@ -1,101 +1,723 @@
 # -*- coding: utf-8 -*-
 import os
-from typing import List, Dict
+import time
+import threading
+import bisect
+from typing import List, Dict, Tuple, Set, Callable
 from easydict import EasyDict
 import yaml
 import torch
-from transformers import AutoTokenizer
+from transformers import AutoTokenizer, AutoConfig
 from transformers import AutoModelForTokenClassification, AutoModelForSequenceClassification
 from IE_modules.Utilities import Information_Extraction_Document
 from IE_modules.NER_utilities import Sentence_NER_Dataset, NER_Predictor
 from IE_modules.RE_utilities import InlineTag_RE_Dataset, RE_Predictor
+from IE_modules.Compile_utilities import Compiled_Model
 from modules.utilities import backend_model
+from modules.cache import model_cache, result_cache
+from modules.scheduler import batch_scheduler
+from modules.incremental import get_equal_blocks, map_span, overlaps
 import logging
 
 logging.basicConfig(format='%(asctime)s - %(message)s', level=logging.INFO)
 
 class IE_model(backend_model):
-  def __init__(self):
-    self.reset()
+  def __init__(self, model_dir:str='models', memory_budget_MB:float=None, 
+               result_cache_config:Dict=None, sentence_cache_config:Dict=None, 
+               scheduler_config:Dict=None, compile_mode:str=None, length_bucketing:bool=False,
+               stream_segments:int=None, prefetch_batches:int=0):
+    """
+    This class is the PyTorch backend. Loaded NER/ RE models are kept in a model 
+    cache, so switching between models does not reload them from disk. 
+    Predictions are kept in a result cache, keyed by model, model config and 
+    input content, so repeated requests skip inference. NER token predictions are 
+    also kept per sentence, so sentences seen before (e.g. boilerplate) skip inference.
+
+    Parameters
+    ----------
+    model_dir : str, optional
+      Directory with NER and RE model folders. The default is 'models'.
+    memory_budget_MB : float, optional
+      Max resident memory (MB) for cached models. The default is None (no limit).
+    result_cache_config : Dict, optional
+      {enabled, max_entries, cache_dir} for the result cache. 
+      The default is None (no result cache).
+    sentence_cache_config : Dict, optional
+      {enabled, max_entries} for the NER sentence cache (max_entries per NER model). 
+      The default is None (no sentence cache).
+    scheduler_config : Dict, optional
+      {enabled, window_ms} for micro-batching model inputs of concurrent requests. 
+      The default is None (each request runs its own batches).
+    compile_mode : str, optional
+      torchscript or torch.compile to run the models compiled per input shape bucket 
+      (see IE_modules.Compile_utilities). The default is None (eager).
+    length_bucketing : bool, optional
+      If True, NER runs segments in order of token length and pads each batch to its 
+      longest segment instead of token_length. The default is False.
+    stream_segments : int, optional
+      If given, NER of get_entities_batch decodes entities every stream_segments segments, 
+      so memory for token predictions does not grow with the number of documents. 
+      The default is None (entities are decoded after all segments are predicted).
+    prefetch_batches : int, optional
+      If > 0, NER/ RE batches are tokenized in a worker thread while the model runs, 
+      with up to prefetch_batches batches waiting. The default is 0 (no pipelining).
+    """
+    self.model_dir = model_dir
+    self.model_cache = model_cache(memory_budget_MB)
+    if result_cache_config is not None and result_cache_config['enabled']:
+      self.result_cache = result_cache(max_entries=result_cache_config['max_entries'],
+                                       cache_dir=result_cache_config['cache_dir'])
+    else:
+      self.result_cache = None
+    self.sentence_cache_config = sentence_cache_config
+    self.sentence_caches = {}
+    self.lock = threading.Lock()
+    # rounds of context extension in incremental NER before a full prediction
+    self.max_incremental_rounds = 3
+    if scheduler_config is not None and scheduler_config['enabled']:
+      self.scheduler = batch_scheduler(window_ms=scheduler_config['window_ms'])
+    else:
+      self.scheduler = None
+    self.compile_mode = compile_mode
+    self.length_bucketing = length_bucketing
+    self.stream_segments = stream_segments
+    self.prefetch_batches = prefetch_batches
+    # set when preloading is done (or no preloading)
+    self.ready = threading.Event()
+    self.ready.set()
+    self.preload_status = {'total':0, 'loaded':[], 'failed':[]}
     
     
-  def reset(self):
-    self.ner_model_info = None
-    self.ner_model = None
-    self.ner_tokenizer = None
-    self.re_model_info = None
-    self.re_model = None
-    self.re_tokenizer = None
+  def _load_model_info(self, mode:str, model_name:str) -> EasyDict:
+    """
+    This method outputs the config.yaml of a NER/ RE model as EasyDict
+    """
+    with open(os.path.join(self.model_dir, mode, model_name, 'config.yaml')) as yaml_file:
+      return EasyDict(yaml.safe_load(yaml_file))
     
-  
-  def get_entities(self, NER_model_info:Dict[str, str], text:str) -> List[Dict[str,str]]:
-    """ Check if model is first time loaded or has been changed """
-    logging.info('NER prediction starts...')
-    if (self.ner_model_info is None or 
-      NER_model_info['model_name'] != self.ner_model_info['model_name']):
+    
+  def _load_model(self, mode:str, model_name:str) -> Tuple[EasyDict, int]:
+    """
+    This method loads model, tokenizer and config.yaml for a NER/ RE model
+    outputs the EasyDict {model, tokenizer, model_info} and the model size in bytes
+    """
+    model_path = os.path.join(self.model_dir, mode, model_name)
+    model_info = self._load_model_info(mode, model_name)
       
-      logging.info('Loading NER model...')
-      self.ner_model = AutoModelForTokenClassification.\
-        from_pretrained(os.path.join('models', 'NER', NER_model_info['model_name'], 'weight'))
-        
-      logging.info('Loading NER tokenizer...')
-      self.ner_tokenizer = AutoTokenizer.\
-        from_pretrained(os.path.join('models', 'NER', NER_model_info['model_name'], 'tokenizer'))
-        
-      self.ner_model_info = NER_model_info
+    precision = model_info.get('precision', 'fp32')
+    logging.info(f'Loading {mode} model ({precision})...')
+    model = self._load_weight(mode, model_path, precision)
       
-    """ Prediction """
-    logging.info('Packaging input text...')
+    logging.info(f'Loading {mode} tokenizer...')
+    tokenizer = AutoTokenizer.from_pretrained(os.path.join(model_path, 'tokenizer'))
+    
+    # dynamic quantized models only run on CPU
+    device = 'cpu' if precision == 'int8-dynamic' else None
+    size = self._model_size(model)
+    if self.compile_mode is not None:
+      # traced models are saved under the model folder, keyed by precision and weight
+      model = Compiled_Model(model, mode=self.compile_mode, 
+                             cache_dir=os.path.join(model_path, 'compiled'),
+                             cache_key=f'{precision}_{self._weight_hash(model_path)}')
+    return EasyDict({'model':model, 'tokenizer':tokenizer, 'model_info':model_info, 'device':device}), size
+  
+  
+  def _load_weight(self, mode:str, model_path:str, precision:str='fp32') -> torch.nn.Module:
+    """
+    This method loads the model weight in a precision:
+      fp32: full precision.
+      int8-dynamic: Linear layers are dynamically quantized to int8. The quantized 
+        state_dict is cached under model_path/precision_cache, keyed by the weight files 
+        and torch version, so quantization only runs once. The cache is loaded with 
+        weights_only into the quantized model built from the model config.
+      bf16: weights are cast to bfloat16.
+    """
+    weight_path = os.path.join(model_path, 'weight')
+    model_class = AutoModelForTokenClassification if mode == 'NER' else AutoModelForSequenceClassification
+    if precision == 'fp32':
+      return model_class.from_pretrained(weight_path)
+    if precision == 'bf16':
+      return model_class.from_pretrained(weight_path).to(torch.bfloat16)
+    if precision != 'int8-dynamic':
+      raise ValueError(f'precision must be one of fp32, int8-dynamic or bf16, not {precision}.')
+    
+    cache_dir = os.path.join(model_path, 'precision_cache')
+    cache_path = os.path.join(cache_dir, f'{precision}_{self._weight_hash(model_path)}.state_dict.pt')
+    if os.path.exists(cache_path):
+      logging.info(f'Loading quantized model from {cache_path}...')
+      # quantized modules from the config (no weight loaded), then the quantized weights
+      model = torch.ao.quantization.quantize_dynamic(model_class.from_config(AutoConfig.from_pretrained(weight_path)).eval(), 
+                                                     {torch.nn.Linear}, dtype=torch.qint8)
+      model.load_state_dict(torch.load(cache_path, weights_only=True))
+      return model
+    
+    logging.info('Quantizing model...')
+    model = torch.ao.quantization.quantize_dynamic(model_class.from_pretrained(weight_path).eval(), 
+                                                   {torch.nn.Linear}, dtype=torch.qint8)
+    os.makedirs(cache_dir, exist_ok=True)
+    for file_name in os.listdir(cache_dir):
+      if file_name.startswith(f'{precision}_'):
+        os.remove(os.path.join(cache_dir, file_name))
+    tmp_path = f'{cache_path}.{os.getpid()}.tmp'
+    torch.save(model.state_dict(), tmp_path)
+    os.replace(tmp_path, cache_path)
+    return model
+  
+  
+  @staticmethod
+  def _weight_hash(model_path:str) -> str:
+    """
+    This method outputs a hash of the weight files (name, size, modified time) and 
+    torch version, used to key the artifacts derived from the weight.
+    """
+    weight_path = os.path.join(model_path, 'weight')
+    files = sorted((f, os.path.getsize(os.path.join(weight_path, f)), os.path.getmtime(os.path.join(weight_path, f))) 
+                   for f in os.listdir(weight_path))
+    return result_cache.hash([files, torch.__version__])[:16]
+  
+  
+  @staticmethod
+  def _model_size(model:torch.nn.Module) -> int:
+    """
+    This method outputs the size in bytes of the model tensors, including 
+    quantized (packed) weights. Shared tensors are counted once.
+    """
+    tensors = {}
+    for value in model.state_dict().values():
+      for t in (value if isinstance(value, tuple) else (value,)):
+        if isinstance(t, torch.Tensor):
+          tensors[t.data_ptr()] = t.numel() * t.element_size()
+    return sum(tensors.values())
+  
+  
+  def _get_model(self, mode:str, model_name:str) -> EasyDict:
+    """
+    This method outputs the cached {model, tokenizer, model_info} for a NER/ RE model
+    """
+    return self.model_cache.get((mode, model_name), lambda: self._load_model(mode, model_name))
+    
+  
+  def _result_key(self, mode:str, model_name:str, doc_id:str, text:str, entities:List[Dict]=None) -> str:
+    """
+    This method outputs the result cache key for a prediction.
+    NER results are keyed by (model, config hash, doc_id, text hash); RE results are also
+    keyed by the entity set hash. doc_id is in the key since it is part of the
+    entity/ relation IDs. Only entity fields used by RE are hashed, so display
+    fields (e.g. color) do not change the key.
+    """
+    if (mode, model_name) in self.model_cache:
+      model_info = self._get_model(mode, model_name).model_info
+    else:
+      model_info = self._load_model_info(mode, model_name)
+    key = [mode, model_name, result_cache.hash(model_info), doc_id, result_cache.hash(text)]
+    if entities is not None:
+      key.append(result_cache.hash([[e['entity_id'], e['entity_type'], e['start'], e['end']]
+                                    for e in entities]))
+    return '/'.join(key)
+
+
+  def _get_sentence_cache(self, model_name:str, model_info:EasyDict) -> result_cache:
+    """
+    This method outputs the sentence cache for a NER model and config, 
+    or None if the sentence cache is disabled.
+    """
+    if self.sentence_cache_config is None or not self.sentence_cache_config['enabled']:
+      return None
+    
+    key = (model_name, result_cache.hash(model_info))
+    with self.lock:
+      if key not in self.sentence_caches:
+        self.sentence_caches[key] = result_cache(max_entries=self.sentence_cache_config['max_entries'])
+      return self.sentence_caches[key]
+  
+  
+  def get_entities(self, NER_model_info:Dict[str, str], text:str,
+                   use_cache:bool=True, progress:Callable[[str, int, int], None]=None,
+                   partial:Callable[[List[Dict]], None]=None) -> List[Dict[str,str]]:
+    doc_partial = None if partial is None else lambda results: partial(results['input_doc'])
+    return self.get_entities_batch(NER_model_info, [('input_doc', text)], use_cache, progress, doc_partial)['input_doc']
+
+
+  def get_entities_batch(self, NER_model_info:Dict[str, str], docs:List[Tuple[str, str]],
+                         use_cache:bool=True, progress:Callable[[str, int, int], None]=None,
+                         partial:Callable[[Dict[str, List[Dict]]], None]=None) -> Dict[str, List[Dict[str,str]]]:
+    """
+    This method inputs a list of (doc_id, text) and outputs a dict of {doc_id: entities}.
+    Segments of all documents are packed into the same batches.
+    progress is called with (stage, done, total) as the prediction goes. partial is 
+    called after each batch with {doc_id: new entities since the last call} of the 
+    documents with new entities.
+    """
+    assert len({doc_id for doc_id, _ in docs}) == len(docs), 'doc_id must be unique.'
+    results = {}
+    keys = {}
+    """ Check result cache """
+    if use_cache and self.result_cache is not None:
+      for doc_id, text in docs:
+        keys[doc_id] = self._result_key('NER', NER_model_info['model_name'], doc_id, text)
+        entities = self.result_cache.get(keys[doc_id])
+        if entities is not None:
+          results[doc_id] = entities
+      logging.info(f'Result cache: {self.result_cache.stats()}')
+
+    docs_to_predict = [(doc_id, text) for doc_id, text in docs if doc_id not in results]
+    if len(docs_to_predict) > 0:
+      """ Get model from cache, load if first time used """
+      logging.info(f'NER prediction starts ({len(docs_to_predict)} documents)...')
+      ner = self._get_model('NER', NER_model_info['model_name'])
+      ner_model_info = ner.model_info
+      sentence_cache = self._get_sentence_cache(NER_model_info['model_name'], ner_model_info) \
+                       if use_cache else None
+
+      """ Prediction """
+      logging.info('Packaging input text...')
+      if progress is not None:
+        progress('Segmenting', 0, len(docs_to_predict))
+      IEs = [Information_Extraction_Document(doc_id=doc_id, text=text) for doc_id, text in docs_to_predict]
+      pred_dataset = Sentence_NER_Dataset(IEs=IEs,
+                                          tokenizer=ner.tokenizer,
+                                          label_map=ner_model_info['label_map'],
+                                          token_length=ner_model_info['token_length'],
+                                          has_label=False,
+                                          mode=ner_model_info['BIO_mode'],
+                                          segmenter=ner_model_info.get('segmenter', 'spacy'))
+
+      predictor = NER_Predictor(model=ner.model,
+                            tokenizer=ner.tokenizer,
+                            dataset=pred_dataset,
+                            label_map=ner_model_info['label_map'],
+                            batch_size=ner_model_info['eval_batch_size'],
+                            device=ner.device,
+                            segment_cache=sentence_cache,
+                            scheduler=self.scheduler,
+                            progress=progress,
+                            partial=None if partial is None else lambda ies: partial({ie['doc_id']:ie['entity'] for ie in ies}),
+                            length_bucketing=self.length_bucketing,
+                            stream_segments=self.stream_segments,
+                            prefetch_batches=self.prefetch_batches)
+
+      logging.info('Predicting...')
+      for ie in predictor.predict():
+        results[ie['doc_id']] = ie['entity']
+        if ie['doc_id'] in keys:
+          self.result_cache.put(keys[ie['doc_id']], ie['entity'])
+      logging.info(f'NER padding: {predictor.padding_stats()}')
+      if sentence_cache is not None:
+        logging.info(f'Sentence cache: {sentence_cache.stats()}')
+
+    return {doc_id:results[doc_id] for doc_id, _ in docs}
+
+
+  def get_relations(self, RE_model_info:Dict[str, str], text:str, entities:List[Dict],
+                    use_cache:bool=True, progress:Callable[[str, int, int], None]=None,
+                    partial:Callable[[List[Dict]], None]=None) -> List[Dict[str,str]]:
+    doc_partial = None if partial is None else lambda results: partial(results['input_doc'])
+    return self.get_relations_batch(RE_model_info, [('input_doc', text, entities)], use_cache, progress, 
+                                    doc_partial)['input_doc']
+
+
+  def get_relations_batch(self, RE_model_info:Dict[str, str], docs:List[Tuple[str, str, List[Dict]]],
+                          use_cache:bool=True, progress:Callable[[str, int, int], None]=None,
+                          partial:Callable[[Dict[str, List[Dict]]], None]=None) -> Dict[str, List[Dict[str,str]]]:
+    """
+    This method inputs a list of (doc_id, text, entities) and outputs a dict of {doc_id: relations}.
+    Entity pairs of all documents are packed into the same batches.
+    progress is called with (stage, done, total) as the prediction goes. partial is 
+    called after each batch with {doc_id: new relations since the last call} of the 
+    documents with new relations.
+    """
+    assert len({doc_id for doc_id, _, _ in docs}) == len(docs), 'doc_id must be unique.'
+    results = {}
+    keys = {}
+    """ Check result cache """
+    if use_cache and self.result_cache is not None:
+      for doc_id, text, entities in docs:
+        keys[doc_id] = self._result_key('RE', RE_model_info['model_name'], doc_id, text, entities)
+        relations = self.result_cache.get(keys[doc_id])
+        if relations is not None:
+          results[doc_id] = relations
+      logging.info(f'Result cache: {self.result_cache.stats()}')
+
+    docs_to_predict = [(doc_id, text, entities) for doc_id, text, entities in docs if doc_id not in results]
+    if len(docs_to_predict) > 0:
+      """ Get model from cache, load if first time used """
+      logging.info(f'RE prediction starts ({len(docs_to_predict)} documents)...')
+      re_ = self._get_model('RE', RE_model_info['model_name'])
+      re_model_info = re_.model_info
+
+      """ Prediction """
+      logging.info('Packaging input text...')
+      IEs = [Information_Extraction_Document(doc_id=doc_id, text=text, entity_list=entities)
+             for doc_id, text, entities in docs_to_predict]
+      pred_dataset = InlineTag_RE_Dataset(IEs=IEs,
+                                          tokenizer=re_.tokenizer,
+                                          possible_rel=re_model_info['possible_rel'],
+                                          token_length=re_model_info['token_length'],
+                                          label_map=re_model_info['label_map'],
+                                          has_label=False)
+
+      predictor = RE_Predictor(model=re_.model,
+                              tokenizer=re_.tokenizer,
+                              dataset=pred_dataset,
+                              label_map=re_model_info['label_map'],
+                              batch_size=re_model_info['eval_batch_size'],
+                              device=re_.device,
+                              scheduler=self.scheduler,
+                              progress=progress,
+                              partial=None if partial is None else lambda ies: partial({ie['doc_id']:ie['relation'] for ie in ies}),
+                              prefetch_batches=self.prefetch_batches)
+
+      for ie in predictor.predict():
+        results[ie['doc_id']] = ie['relation']
+        if ie['doc_id'] in keys:
+          self.result_cache.put(keys[ie['doc_id']], ie['relation'])
+
+    return {doc_id:results[doc_id] for doc_id, _, _ in docs}
+
+
+  def get_entities_incremental(self, NER_model_info:Dict[str, str], text:str, 
+                               prev_text:str, prev_entities:List[Dict],
+                               progress:Callable[[str, int, int], None]=None,
+                               partial:Callable[[List[Dict]], None]=None) -> List[Dict[str,str]]:
+    """
+    This method diffs the text against the previous submission and only runs NER 
+    on the sentences that changed. Entities in unchanged sentences are carried 
+    over with shifted offsets. partial is only called if it falls back to a full prediction.
+    """
+    if self.result_cache is not None:
+      entities = self.result_cache.get(self._result_key('NER', NER_model_info['model_name'], 'input_doc', text))
+      if entities is not None:
+        return entities
+      
+    """ Get model from cache, load if first time used """
+    logging.info('Incremental NER prediction starts...')
+    ner = self._get_model('NER', NER_model_info['model_name'])
+    ner_model_info = ner.model_info
+    sentence_cache = self._get_sentence_cache(NER_model_info['model_name'], ner_model_info)
+    
+    """ Find changed sentences """
+    if progress is not None:
+      progress('Segmenting', 0, 1)
+    blocks = get_equal_blocks(prev_text, text)
     ie = Information_Extraction_Document(doc_id='input_doc', text=text)
     pred_dataset = Sentence_NER_Dataset(IEs=[ie], 
-                                        tokenizer=self.ner_tokenizer, 
-                                        label_map=self.ner_model_info['label_map'], 
-                                        token_length=self.ner_model_info['token_length'], 
+                                        tokenizer=ner.tokenizer, 
+                                        label_map=ner_model_info['label_map'], 
+                                        token_length=ner_model_info['token_length'], 
                                         has_label=False,
-                                        mode=self.ner_model_info['BIO_mode'])
+                                        mode=ner_model_info['BIO_mode'],
+                                        segmenter=ner_model_info.get('segmenter', 'spacy'))
     
-    predictor = NER_Predictor(model=self.ner_model,
-                          tokenizer=self.ner_tokenizer,
-                          dataset=pred_dataset,
-                          label_map=self.ner_model_info['label_map'],
-                          batch_size=self.ner_model_info['eval_batch_size'])
+    # a sentence is unchanged if it was also a sentence of the previous text
+    prev_segments = {(seg['start'], seg['end']) for seg in pred_dataset._get_segments('input_doc', prev_text)}
+    segments = pred_dataset.segments
+    changed = [i for i, seg in enumerate(segments) 
+               if map_span(seg['start'], seg['end'], blocks, to_prev=True) not in prev_segments]
+    changed_spans = [(segments[i]['start'], segments[i]['end']) for i in changed]
+    logging.info(f'{len(changed)} of {len(segments)} sentences changed')
     
-    logging.info('Predicting...')
-    pred_IEs = predictor.predict()
-    return pred_IEs[0]['entity']
+    """ Predict changed sentences """
+    entities = []
+    if len(changed) > 0:
+      # changed sentences are predicted with the sentences before and after them, 
+      # so entities continuing across sentence boundaries are chunked as in a full prediction
+      context = {j for i in changed for j in (i - 1, i, i + 1) if 0 <= j < len(segments)}
+      context = self._extend_context(context, segments, prev_entities, blocks)
+      # sentences predicted in earlier rounds are not run again
+      segment_cache = sentence_cache if sentence_cache is not None else result_cache(max_entries=len(segments))
+      for n_round in range(self.max_incremental_rounds + 1):
+        # if most of the text is affected, or the context keeps extending, a full prediction is faster
+        if len(context) > len(segments) // 2 or n_round == self.max_incremental_rounds:
+          logging.info('Too many sentences affected, run full prediction')
+          return self.get_entities(NER_model_info, text, progress=progress, partial=partial)
+        
+        # each run of consecutive sentences is predicted separately, so entities 
+        # are not chunked across runs
+        runs = []
+        for j in sorted(context):
+          if runs and runs[-1][-1] == j - 1:
+            runs[-1].append(j)
+          else:
+            runs.append([j])
+            
+        entities = []
+        for run in runs:
+          pred_dataset.segments = [segments[j] for j in run]
+          predictor = NER_Predictor(model=ner.model,
+                                    tokenizer=ner.tokenizer,
+                                    dataset=pred_dataset,
+                                    label_map=ner_model_info['label_map'],
+                                    batch_size=ner_model_info['eval_batch_size'],
+                                    device=ner.device,
+                                    segment_cache=segment_cache,
+                                    scheduler=self.scheduler,
+                                    progress=progress,
+                                    length_bucketing=self.length_bucketing,
+                                    prefetch_batches=self.prefetch_batches)
+          entities.extend(predictor.predict()[0]['entity'])
+          
+        # extend the context if a predicted entity starts/ ends at the edge of the context
+        edge_starts, edge_ends = {}, {}
+        for j in context:
+          seg = segments[j]
+          if j - 1 >= 0 and j - 1 not in context:
+            edge_starts[seg['end'] - len(seg['segment'].lstrip())] = j - 1
+          if j + 1 < len(segments) and j + 1 not in context:
+            edge_ends[seg['start'] + len(seg['segment'].rstrip())] = j + 1
+        new = {edge_starts[e['start']] for e in entities if e['start'] in edge_starts} | \
+              {edge_ends[e['end']] for e in entities if e['end'] in edge_ends}
+        if not new:
+          break
+        context |= new
       
+      entities = [e for e in entities if overlaps(e['start'], e['end'], changed_spans)]
+    
+    """ Carry over entities in unchanged sentences """
+    new_spans = [(e['start'], e['end']) for e in sorted(entities, key=lambda e:e['start'])]
+    for e in prev_entities:
+      span = map_span(e['start'], e['end'], blocks)
+      if span is None or overlaps(*span, changed_spans) or overlaps(*span, new_spans):
+        continue
+      entities.append({'entity_id':f'input_doc_{span[0]}_{span[1]}', 
+                       'entity_text':e['entity_text'], 
+                       'entity_type':e['entity_type'],
+                       'start':span[0],
+                       'end':span[1],
+                       'prob':e['prob'],
+                       'conf':e['conf']})
+    
+    entities = sorted(entities, key=lambda e:e['start'])
+    if self.result_cache is not None:
+      self.result_cache.put(self._result_key('NER', NER_model_info['model_name'], 'input_doc', text), entities)
+    return entities
+  
+  
+  def _extend_context(self, context:Set[int], segments:List[Dict], prev_entities:List[Dict], 
+                      blocks:List[Tuple[int, int, int]]) -> Set[int]:
+    """
+    This method extends the context sentences (by index) to cover the previous 
+    entities that continue across sentence boundaries into the context, 
+    plus one sentence on each side. 
+    """
+    seg_starts = [seg['start'] for seg in segments]
+    spans = []
+    for e in prev_entities:
+      span = map_span(e['start'], e['end'], blocks)
+      if span is not None:
+        first = bisect.bisect_right(seg_starts, span[0]) - 1
+        last = bisect.bisect_right(seg_starts, span[1] - 1) - 1
+        if last > first:
+          spans.append((first, last))
+    
+    extended = True
+    while extended:
+      extended = False
+      for first, last in spans:
+        if any(j in context for j in range(first, last + 1)):
+          new = {j for j in range(first - 1, last + 2) if 0 <= j < len(segments)} - context
+          if new:
+            context |= new
+            extended = True
+    return context
   
-  def get_relations(self, RE_model_info:Dict[str, str], text:str, entities:List[Dict]) -> List[Dict[str,str]]:
-    """ Check if model is first time loaded or has been changed """
-    logging.info('RE prediction starts...')
-    if (self.re_model_info is None or 
-      RE_model_info['model_name'] != self.re_model_info['model_name']):
+  
+  def get_relations_incremental(self, RE_model_info:Dict[str, str], text:str, entities:List[Dict], 
+                                prev_text:str, prev_entities:List[Dict], 
+                                prev_relations:List[Dict], 
+                                progress:Callable[[str, int, int], None]=None,
+                                partial:Callable[[List[Dict]], None]=None) -> List[Dict[str,str]]:
+    """
+    This method diffs the text against the previous submission and only runs RE 
+    on the entity pairs that are new or whose context changed. Relations of 
+    the other pairs are carried over. partial is called with the carried over 
+    relations first, then with the new relations after each batch.
+    """
+    if self.result_cache is not None:
+      relations = self.result_cache.get(self._result_key('RE', RE_model_info['model_name'], 'input_doc', text, entities))
+      if relations is not None:
+        return relations
       
-      logging.info('Loading RE model...')
-      self.re_model = AutoModelForSequenceClassification.\
-        from_pretrained(os.path.join('models', 'RE', RE_model_info['model_name'], 'weight'))
-        
-      logging.info('Loading RE tokenizer...')
-      self.re_tokenizer = AutoTokenizer.\
-        from_pretrained(os.path.join('models', 'RE', RE_model_info['model_name'], 'tokenizer'))
-        
-      self.re_model_info = RE_model_info
+    """ Get model from cache, load if first time used """
+    logging.info('Incremental RE prediction starts...')
+    re_ = self._get_model('RE', RE_model_info['model_name'])
+    re_model_info = re_.model_info
+    
+    """ Map entities to the previous submission """
+    blocks = get_equal_blocks(prev_text, text)
+    prev_entity_ids = {(e['start'], e['end'], e['entity_type']):e['entity_id'] for e in prev_entities}
+    carried = {}
+    for e in entities:
+      span = map_span(e['start'], e['end'], blocks, to_prev=True)
+      if span is not None and (span[0], span[1], e['entity_type']) in prev_entity_ids:
+        carried[e['entity_id']] = prev_entity_ids[(span[0], span[1], e['entity_type'])]
+    
+    prev_pairs = {(r['entity_1_id'], r['entity_2_id']):r for r in prev_relations}
+    
+    """ Find changed entity pairs """
+    # a pair is unchanged if both entities are carried over and the model input is the same
+    prev_ie = Information_Extraction_Document(doc_id='input_doc', text=prev_text, entity_list=prev_entities)
+    prev_dataset = InlineTag_RE_Dataset(IEs=[prev_ie], 
+                                        tokenizer=re_.tokenizer, 
+                                        possible_rel=re_model_info['possible_rel'],
+                                        token_length=re_model_info['token_length'], 
+                                        label_map=re_model_info['label_map'], 
+                                        has_label=False)
+    prev_segments = {(seg['entity_1_id'], seg['entity_2_id']):seg['segment'] for seg in prev_dataset.segments}
     
-    """ Prediction """
-    logging.info('Packaging input text...')
     ie = Information_Extraction_Document(doc_id='input_doc', text=text, entity_list=entities)
     pred_dataset = InlineTag_RE_Dataset(IEs=[ie], 
-                                        tokenizer=self.re_tokenizer, 
-                                        possible_rel=self.re_model_info['possible_rel'],
-                                        token_length=self.re_model_info['token_length'], 
-                                        label_map=self.re_model_info['label_map'], 
+                                        tokenizer=re_.tokenizer, 
+                                        possible_rel=re_model_info['possible_rel'],
+                                        token_length=re_model_info['token_length'], 
+                                        label_map=re_model_info['label_map'], 
                                         has_label=False)
+    segments = pred_dataset.segments
+    relations = {}
+    changed = []
+    for seg in segments:
+      prev_pair = (carried.get(seg['entity_1_id']), carried.get(seg['entity_2_id']))
+      if prev_segments.get(prev_pair) == seg['segment']:
+        r = prev_pairs.get(prev_pair)
+        if r is not None:
+          relations[(seg['entity_1_id'], seg['entity_2_id'])] = {
+            'relation_id':f"input_doc_{seg['entity_1_id']}_{seg['entity_2_id']}",
+            'relation_type':r['relation_type'],
+            'relation_prob':r['relation_prob'],
+            'entity_1_id':seg['entity_1_id'],
+            'entity_2_id':seg['entity_2_id'],
+            'entity_1_text':r['entity_1_text'],
+            'entity_2_text':r['entity_2_text']}
+      else:
+        changed.append(seg)
+    logging.info(f'{len(changed)} of {len(segments)} entity pairs changed')
+    if partial is not None and len(relations) > 0:
+      partial(list(relations.values()))
     
-    predictor = RE_Predictor(model=self.re_model,
-                            tokenizer=self.re_tokenizer,
-                            dataset=pred_dataset,
-                            label_map=self.re_model_info['label_map'],
-                            batch_size=self.re_model_info['eval_batch_size'])
+    """ Predict changed entity pairs """
+    if len(changed) > 0:
+      pred_dataset.segments = changed
+      predictor = RE_Predictor(model=re_.model,
+                              tokenizer=re_.tokenizer,
+                              dataset=pred_dataset,
+                              label_map=re_model_info['label_map'],
+                              batch_size=re_model_info['eval_batch_size'],
+                              device=re_.device,
+                              scheduler=self.scheduler,
+                              progress=progress,
+                              partial=None if partial is None else lambda ies: partial(ies[0]['relation']),
+                              prefetch_batches=self.prefetch_batches)
+      for r in predictor.predict()[0]['relation']:
+        relations[(r['entity_1_id'], r['entity_2_id'])] = r
     
-    pred_IEs = predictor.predict()
-    return pred_IEs[0]['relation']
\ No newline at end of file
+    # same order as a full prediction
+    relations = [relations[(seg['entity_1_id'], seg['entity_2_id'])] for seg in segments 
+                 if (seg['entity_1_id'], seg['entity_2_id']) in relations]
+    if self.result_cache is not None:
+      self.result_cache.put(self._result_key('RE', RE_model_info['model_name'], 'input_doc', text, entities), relations)
+    return relations
+  
+  
+  def preload(self, NER_model_names:List[str]=None, RE_model_names:List[str]=None, 
+              warm_up_text:str=None):
+    """
+    This method loads NER/ RE models into the model cache and runs a warm-up 
+    prediction with each, so the first user request does not pay for model 
+    loading and first-forward initialization. self.ready is set when done (see status()), 
+    also if some models fail. A model that fails to load or warm up is logged, recorded 
+    in preload_status['failed'] and skipped. Preloading stops before a model that would 
+    not fit the memory budget (estimated from its weight files), so preloaded models 
+    are not evicted.
+
+    Parameters
+    ----------
+    NER_model_names : List[str], optional
+      NER model names, or "all" for all models under model_dir/NER.
+    RE_model_names : List[str], optional
+      RE model names, or "all" for all models under model_dir/RE.
+    warm_up_text : str, optional
+      text for warm-up prediction. If None, models are loaded without warm-up.
+    """
+    self.ready.clear()
+    start_time = time.time()
+    self.preload_status = {'total':0, 'loaded':[], 'failed':[]}
+    try:
+      model_names = [('NER', name) for name in self._list_models('NER', NER_model_names)] + \
+                    [('RE', name) for name in self._list_models('RE', RE_model_names)]
+      self.preload_status['total'] = len(model_names)
+      entities = None
+      for mode, model_name in model_names:
+        if (mode, model_name) not in self.model_cache and \
+          not self.model_cache.fits(self._weight_size(mode, model_name)):
+          logging.warning(f'Model cache memory budget reached. Preloading stopped before {mode} model {model_name}.')
+          break
+        
+        try:
+          logging.info(f'Preloading {mode} model {model_name}...')
+          self._get_model(mode, model_name)
+          if warm_up_text is not None:
+            if mode == 'NER':
+              entities = self.get_entities({'model_name':model_name}, warm_up_text, 
+                                           use_cache=False)
+            elif entities is not None:
+              self.get_relations({'model_name':model_name}, warm_up_text, entities, 
+                                 use_cache=False)
+        except Exception as e:
+          logging.exception(f'Preloading {mode} model {model_name} failed')
+          self.preload_status['failed'].append({'model':f'{mode}/{model_name}', 'error':f'{type(e).__name__}: {e}'})
+          continue
+        
+        self.preload_status['loaded'].append(f'{mode}/{model_name}')
+    except Exception:
+      logging.exception('Preloading failed')
+    finally:
+      self.ready.set()
+      logging.info(f'Backend ready: {len(self.preload_status["loaded"])} models preloaded, ' + \
+                   f'{len(self.preload_status["failed"])} failed in {time.time() - start_time:.1f}s')
+      
+      
+  def status(self) -> Dict:
+    """
+    This method outputs {ready, preload: {total, loaded, failed}}: whether preloading is done, 
+    the number of models to preload, the models preloaded so far and the models that 
+    failed to preload {model, error}
+    """
+    return {'ready':self.ready.is_set(), 
+            'preload':{'total':self.preload_status['total'], 
+                       'loaded':list(self.preload_status['loaded']),
+                       'failed':list(self.preload_status['failed'])}}
+  
+  
+  def _weight_size(self, mode:str, model_name:str) -> int:
+    """
+    This method outputs the size in bytes of the weight files of a model, used to 
+    estimate its memory before loading (an upper bound for int8-dynamic and bf16). 
+    0 if the model has no weight folder.
+    """
+    weight_path = os.path.join(self.model_dir, mode, model_name, 'weight')
+    if not os.path.isdir(weight_path):
+      return 0
+    return sum(os.path.getsize(os.path.join(weight_path, f)) for f in os.listdir(weight_path))
+  
+  
+  def _list_models(self, mode:str, model_names:List[str]=None) -> List[str]:
+    """
+    This method outputs the list of model names. "all" returns all models under model_dir/mode
+    """
+    if model_names is None:
+      return []
+    if model_names == 'all':
+      return sorted(os.listdir(os.path.join(self.model_dir, mode)))
+    return list(model_names)
+
+
+  def share_memory(self):
+    """
+    This method moves the weights of the cached models to shared memory, so 
+    worker processes forked after it (e.g. gunicorn workers) use the same copy 
+    instead of copying pages on write. Models loaded later by a worker are private 
+    to that worker.
+    """
+    for entry in self.model_cache.entries.values():
+      entry.model.eval()
+      entry.model.share_memory()
+    logging.info(f'Shared memory: {list(self.model_cache.entries.keys())}')
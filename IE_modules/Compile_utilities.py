@@ -0,0 +1,163 @@
+# -*- coding: utf-8 -*-
+import os
+import threading
+import logging
+from types import SimpleNamespace
+from typing import Callable, Dict, Tuple
+import torch
+
+
+class Logits_Module(torch.nn.Module):
+  def __init__(self, model:torch.nn.Module):
+    """
+    This class wraps a Hugging Face model to take positional inputs and output the logits tensor,
+    which can be traced by TorchScript
+    """
+    super().__init__()
+    self.model = model
+
+
+  def forward(self, input_ids:torch.Tensor, attention_mask:torch.Tensor) -> torch.Tensor:
+    return self.model(input_ids=input_ids, attention_mask=attention_mask).logits
+
+
+class Compiled_Model:
+  def __init__(self, model:torch.nn.Module, mode:str='torchscript', cache_dir:str=None, cache_key:str='model'):
+    """
+    This class runs a NER/ RE model in compiled mode. It has the interface of the
+    model used by NER_Predictor and RE_Predictor (called with input_ids and
+    attention_mask, outputs {logits}).
+    Inputs are padded to a shape bucket (batch size rounded up to a power of 2,
+    sequence length rounded up to a multiple of 32) and each bucket is compiled once.
+    In torchscript mode, traced models are saved to a cache_key subfolder of cache_dir, 
+    named by device and bucket, so a restart loads them instead of tracing again. Loaded traced models
+    share the weight tensors of the eager model. If compilation or a compiled run fails,
+    the bucket falls back to the eager model.
+
+    Parameters
+    ----------
+    model : torch.nn.Module
+      a token/ sequence classification model.
+    mode : str, optional
+      torchscript (TorchScript tracing) or torch.compile. The default is 'torchscript'.
+    cache_dir : str, optional
+      directory for traced models. The default is None (no disk cache).
+    cache_key : str, optional
+      key of the model weight, e.g. precision and weight hash. Each key has its own 
+      subfolder, so traces of other keys (e.g. another precision) are kept. The default is 'model'.
+    """
+    if mode not in ('torchscript', 'torch.compile'):
+      raise ValueError(f'compile mode must be torchscript or torch.compile, not {mode}.')
+    self.model = model.eval()
+    self.logits_module = Logits_Module(model).eval()
+    self.mode = mode
+    self.cache_dir = None if cache_dir is None else os.path.join(cache_dir, cache_key)
+    self.cache_key = cache_key
+    self.device = 'cpu'
+    # compiled functions by (device, batch bucket, sequence bucket), None falls back to eager
+    self.compiled = {}
+    self.lock = threading.Lock()
+    self.compiled_module = torch.compile(self.logits_module, dynamic=False) if mode == 'torch.compile' else None
+
+
+  @staticmethod
+  def bucket(batch_size:int, seq_length:int) -> Tuple[int, int]:
+    """
+    This method outputs the padded (batch size, sequence length) of an input shape
+    """
+    return 2 ** (batch_size - 1).bit_length(), -(-seq_length // 32) * 32
+
+
+  def __call__(self, input_ids:torch.Tensor, attention_mask:torch.Tensor) -> SimpleNamespace:
+    batch_size, seq_length = input_ids.shape
+    batch_bucket, seq_bucket = self.bucket(batch_size, seq_length)
+    key = (str(self.device), batch_bucket, seq_bucket)
+    fn = self.compiled[key] if key in self.compiled else self._compile(key)
+    if fn is not None:
+      padded_ids = input_ids.new_zeros((batch_bucket, seq_bucket))
+      padded_ids[:batch_size, :seq_length] = input_ids
+      padded_mask = attention_mask.new_zeros((batch_bucket, seq_bucket))
+      padded_mask[:batch_size, :seq_length] = attention_mask
+      # padding rows attend to one token, so their attention is well defined
+      padded_mask[batch_size:, 0] = 1
+      try:
+        logits = fn(padded_ids, padded_mask)
+        return SimpleNamespace(logits=logits[:batch_size, :seq_length] if logits.dim() == 3 else logits[:batch_size])
+      except Exception as e:
+        logging.warning(f'Compiled model failed for shape {key}, running eager: {e}')
+        self.compiled[key] = None
+
+    return self.model(input_ids=input_ids, attention_mask=attention_mask)
+
+
+  def _compile(self, key:Tuple[str, int, int]) -> Callable:
+    """
+    This method compiles (or loads) the model for a (device, batch bucket, sequence bucket)
+    outputs the compiled function, or None if compilation failed
+    """
+    with self.lock:
+      if key in self.compiled:
+        return self.compiled[key]
+
+      device, batch_bucket, seq_bucket = key
+      example = (torch.zeros((batch_bucket, seq_bucket), dtype=torch.long, device=device),
+                 torch.ones((batch_bucket, seq_bucket), dtype=torch.long, device=device))
+      try:
+        with torch.no_grad():
+          if self.mode == 'torch.compile':
+            logging.info(f'Compiling model for shape {key}...')
+            fn = self.compiled_module
+            fn(*example)
+          else:
+            fn = self._trace(device, batch_bucket, seq_bucket, example)
+      except Exception as e:
+        logging.warning(f'Compiling model for shape {key} failed, running eager: {e}')
+        fn = None
+
+      self.compiled[key] = fn
+      return fn
+
+
+  def _trace(self, device:str, batch_bucket:int, seq_bucket:int,
+             example:Tuple[torch.Tensor, torch.Tensor]) -> torch.jit.ScriptModule:
+    """
+    This method traces the model with TorchScript, or loads the traced model from cache_dir
+    """
+    path = None if self.cache_dir is None else \
+           os.path.join(self.cache_dir, f'{device.replace(":", "")}_{batch_bucket}x{seq_bucket}.pt')
+    if path is not None and os.path.exists(path):
+      logging.info(f'Loading traced model {path}...')
+      traced = torch.jit.load(path, map_location=device)
+      # share the weight tensors of the eager model instead of keeping a copy per bucket
+      parameters = dict(self.logits_module.named_parameters())
+      for name, parameter in traced.named_parameters():
+        parameter.data = parameters[name].data
+      return traced
+
+    logging.info(f'Tracing model for shape {(device, batch_bucket, seq_bucket)}...')
+    traced = torch.jit.trace(self.logits_module, example, check_trace=False)
+    if path is not None:
+      os.makedirs(self.cache_dir, exist_ok=True)
+      tmp_path = f'{path}.{os.getpid()}.tmp'
+      torch.jit.save(traced, tmp_path)
+      os.replace(tmp_path, path)
+    return traced
+
+
+  def to(self, device:str) -> 'Compiled_Model':
+    self.model.to(device)
+    self.device = device
+    return self
+
+
+  def eval(self) -> 'Compiled_Model':
+    return self
+
+
+  def state_dict(self) -> Dict[str, torch.Tensor]:
+    return self.model.state_dict()
+
+
+  def share_memory(self) -> 'Compiled_Model':
+    self.model.share_memory()
+    return self
@@ -1,15 +1,14 @@
 # -*- coding: utf-8 -*-
 import abc
-from typing import List, Tuple, Dict, Optional
-import pandas as pd
-from IE_modules.Utilities import Information_Extraction_Document, Trainer
+from typing import List, Tuple, Dict, Optional, Callable, Iterator
+import numpy as np
+from IE_modules.Utilities import Information_Extraction_Document, Trainer, to_tensor, uncollate, prefetch
+from IE_modules.Segmenter_utilities import get_sentence_segmenter
 from transformers import AutoTokenizer
 import torch
 from torch.utils.data import Dataset, DataLoader
 from transformers import AutoModelForTokenClassification
 from tqdm import tqdm
-import spacy
-import re
 
 
 class NER_Dataset(Dataset):
@@ -22,7 +21,7 @@ class NER_Dataset(Dataset):
                mode: str='BIO'):
     """
     This parent class inputs list of IEs and outputs dict 
-    {document_id, input_ids, attention_mask, start, end, (labels)}
+    {doc_index, input_ids, attention_mask, spans, (labels)}
     number of tokens per input is padded/ truncated to token_length
 
     Parameters
@@ -47,8 +46,14 @@ class NER_Dataset(Dataset):
     self.has_label = has_label
     assert mode in {"BIO", "IO"}, 'BIO mode must be one of {"BIO", "IO"}.'
     self.mode = mode
+    # index of each document in IEs
+    self.doc_index = {ie['doc_id']:i for i, ie in enumerate(self.IEs)}
     self.segments = []
     self.get_segments()
+    # pre-tokenized segments (see pretokenize)
+    self.encodings = None
+    self.encoded_rows = {}
+    self.encoded_segments = None
     
   @abc.abstractmethod
   def _get_segments(self, doc_id:str, text:str, entities:Optional[List[Dict]]=None) -> List[Dict[str, str]]:
@@ -74,44 +79,129 @@ class NER_Dataset(Dataset):
     """
     return len(self.segments)
   
-  def __getitem__(self, idx) -> Dict:
+  def pretokenize(self, indices:List[int]=None):
     """
-    This method outputs a dict {doc_id, input_ids, attention_mask, start, end, (labels)}
+    This method tokenizes segments (all segments by default) in one batched tokenizer call. 
+    input_ids, attention_mask and token spans in the document are kept as [segment, token_length] 
+    tensors, and __getitem__ outputs slices of them. Segments not pre-tokenized, or all segments 
+    if self.segments is replaced, are tokenized in __getitem__.
     """
-    # get segment
-    seg = self.segments[idx]
-    # tokenize segment
-    tokens = self.tokenizer(seg['segment'], 
+    indices = list(range(len(self.segments))) if indices is None else list(indices)
+    encoded = self.encode(indices) if len(indices) > 0 else None
+    self.encoded_segments = self.segments
+    self.encoded_rows = {idx:row for row, idx in enumerate(indices)}
+    self.encodings = None if encoded is None else {key:encoded[key] for key in ['input_ids', 'attention_mask', 'spans']}
+    
+  def encode(self, indices:List[int]) -> Dict[str, torch.Tensor]:
+    """
+    This method tokenizes segments in one batched tokenizer call, or slices them from 
+    the pre-tokenized segments if all are pre-tokenized
+    outputs a batch {doc_index, input_ids, attention_mask, spans} as collate() (without labels)
+    """
+    rows = [self._encoded_row(idx) for idx in indices]
+    if len(rows) > 0 and None not in rows:
+      rows = torch.tensor(rows)
+      return {**{key:value[rows] for key, value in self.encodings.items()},
+              'doc_index':torch.tensor([self.doc_index[self.segments[idx]['doc_id']] for idx in indices])}
+    
+    tokens = self.tokenizer([self.segments[idx]['segment'] for idx in indices], 
                             padding='max_length',
                             max_length=self.token_length,
                             truncation=True,
                             add_special_tokens=True,
                             return_offsets_mapping=True,
                             return_token_type_ids=False)
+    shape = (len(indices), self.token_length)
+    # token spans in the document, (0, 0) for special tokens and padding
+    offsets = to_tensor(tokens['offset_mapping'], shape + (2,))
+    seg_starts = torch.tensor([self.segments[idx]['start'] for idx in indices])[:, None, None]
+    spans = torch.where((offsets != 0).any(dim=-1, keepdim=True), offsets + seg_starts, 0)
+    return {'input_ids':to_tensor(tokens['input_ids'], shape),
+            'attention_mask':to_tensor(tokens['attention_mask'], shape),
+            'spans':spans,
+            'doc_index':torch.tensor([self.doc_index[self.segments[idx]['doc_id']] for idx in indices])}
+    
+  def _encoded_row(self, idx:int) -> Optional[int]:
+    """
+    This method outputs the row of a segment in self.encodings, or None if not pre-tokenized
+    """
+    if self.encodings is None or self.encoded_segments is not self.segments:
+      return None
+    return self.encoded_rows.get(idx)
+  
+  def get_token_lengths(self, indices:List[int]) -> List[int]:
+    """
+    This method outputs the number of tokens (with special tokens, truncated to token_length) 
+    of segments, from the pre-tokenized segments or in one batched tokenizer call
+    """
+    rows = [self._encoded_row(idx) for idx in indices]
+    if None not in rows:
+      return self.encodings['attention_mask'][rows].sum(dim=1).tolist()
     
-    tokens['input_ids'] = torch.tensor(tokens['input_ids'])
-    tokens['attention_mask'] = torch.tensor(tokens['attention_mask'])
-    # calculate each tokens' span in the original document
-    doc_span = []
-    for offset in tokens['offset_mapping']:
-      if offset == (0, 0):
-        doc_span.append((0, 0))
-      else:
-        doc_span.append((offset[0] + seg['start'], offset[1] + seg['start']))
+    tokens = self.tokenizer([self.segments[idx]['segment'] for idx in indices],
+                            max_length=self.token_length,
+                            truncation=True,
+                            add_special_tokens=True)
+    return [len(input_ids) for input_ids in tokens['input_ids']]
+  
+  def __getitem__(self, idx) -> Dict:
+    """
+    This method outputs a dict {doc_index, input_ids, attention_mask, spans, (labels)}. 
+    doc_index is the index of the document in IEs, spans is a [token_length, 2] tensor 
+    of token (start, end) in the document.
+    """
+    # get segment
+    seg = self.segments[idx]
+    row = self._encoded_row(idx)
+    if row is not None:
+      tokens = {'input_ids':self.encodings['input_ids'][row],
+                'attention_mask':self.encodings['attention_mask'][row],
+                'spans':self.encodings['spans'][row]}
+    else:
+      # tokenize segment
+      encoded = self.tokenizer(seg['segment'], 
+                               padding='max_length',
+                               max_length=self.token_length,
+                               truncation=True,
+                               add_special_tokens=True,
+                               return_offsets_mapping=True,
+                               return_token_type_ids=False)
+      # calculate each tokens' span in the original document
+      doc_span = []
+      for offset in encoded['offset_mapping']:
+        if offset == (0, 0):
+          doc_span.append((0, 0))
+        else:
+          doc_span.append((offset[0] + seg['start'], offset[1] + seg['start']))
+        
+      tokens = {'input_ids':torch.tensor(encoded['input_ids']),
+                'attention_mask':torch.tensor(encoded['attention_mask']),
+                'spans':torch.tensor(doc_span)}
       
-    tokens['spans'] = doc_span
-    # Assign document ID
-    tokens['doc_id'] = [seg['doc_id']] * self.token_length
+    # Assign document index
+    tokens['doc_index'] = self.doc_index[seg['doc_id']]
     # Assign entity type label to each token
     if self.has_label:
+      spans = [tuple(span) for span in tokens['spans'].tolist()]
       if self.mode == 'BIO':
-        tokens['labels'] = self._get_BIO_entity_type(tokens['spans'], seg['entities'])
+        tokens['labels'] = self._get_BIO_entity_type(spans, seg['entities'])
       elif self.mode == 'IO':
-        tokens['labels'] = self._get_IO_entity_type(tokens['spans'], seg['entities'])
+        tokens['labels'] = self._get_IO_entity_type(spans, seg['entities'])
       
       tokens['labels'] = torch.tensor(tokens['labels'])
       
     return tokens
+  
+  @staticmethod
+  def collate(items:List[Dict]) -> Dict[str, torch.Tensor]:
+    """
+    This method collates dataset items into a batch {doc_index, input_ids, attention_mask, spans, (labels)}. 
+    input_ids, attention_mask (and labels) are [batch, token_length] tensors, spans is a 
+    [batch, token_length, 2] tensor and doc_index is a [batch] tensor.
+    """
+    batch = {key:torch.stack([item[key] for item in items]) for key in items[0] if key != 'doc_index'}
+    batch['doc_index'] = torch.tensor([item['doc_index'] for item in items])
+    return batch
     
   
   def _is_in_entity(self, span:Tuple[int, int], start:int, end:int, criterion:str='contain') -> bool:
@@ -192,9 +282,12 @@ class Sentence_NER_Dataset(NER_Dataset):
                label_map: Dict,
                has_label: bool=True,
                mode: str='BIO', 
-               N_sentences:int=1):
+               N_sentences:int=1,
+               segmenter:str='spacy',
+               n_process:int=1):
     """
-    This class 
+    This class segments documents into sentences (or N sentences) as inputs.
+    The sentence segmenter is shared by all instances.
 
     Parameters
     ----------
@@ -212,45 +305,57 @@ class Sentence_NER_Dataset(NER_Dataset):
       The BIO mode, must be {"BIO", "IO"}. If has_label=False, mode will be ignored.
     N_sentences : int, optional
       Number of sentences to put together as an input. The default is 1.
+    segmenter : str, optional
+      Sentence segmenter engine, must be {"spacy", "regex"}. The default is "spacy".
+    n_process : int, optional
+      Number of processes for sentence segmentation. The default is 1.
     """
-    
-    self.nlp = spacy.load("en_core_web_sm")
+    self.segmenter = get_sentence_segmenter(segmenter)
     self.N_sentences = N_sentences
-    # Remove unused pipelines to speed up
-    for pipe in self.nlp.pipeline: 
-      pipe_name = pipe[0]
-      self.nlp.remove_pipe(pipe_name)
-  
-    self.sentencizer = self.nlp.add_pipe("sentencizer")
-    
+    self.n_process = n_process
     super().__init__(IEs, tokenizer, token_length, label_map, has_label, mode)
     
+  def get_segments(self):
+    """
+    This method segments all documents in one batched call of the segmenter
+    """
+    sent_spans = self.segmenter.segment_batch([ie['text'] for ie in self.IEs], n_process=self.n_process)
+    loop = tqdm(zip(self.IEs, sent_spans), total=len(self.IEs), leave=True)
+    for ie, spans in loop:
+      entities = ie['entity'] if self.has_label else None
+      self.segments.extend(self._spans_to_segments(ie['doc_id'], ie['text'], spans, entities))
+    
   def _get_segments(self, doc_id:str, text:str, entities:Optional[List[Dict]]=None) -> List[Dict[str, str]]:
-    doc = self.nlp(text)
-    sent_list = [s for s in doc.sents]
-    sentences = []
+    return self._spans_to_segments(doc_id, text, self.segmenter.segment(text), entities)
     
+  def _spans_to_segments(self, doc_id:str, text:str, sent_list:List[Tuple[int, int]], 
+                         entities:Optional[List[Dict]]=None) -> List[Dict[str, str]]:
+    """
+    This method inputs sentence spans (start, end) of a document 
+    outputs a list of dict {doc_id, segment, start, end, (entities)}
+    """
+    sentences = []
     
     if self.N_sentences == 1:
-      for sent in sent_list:
-        sentences.append({'doc_id':doc_id, 'segment': sent.text.replace('\n', ' '), 
-                          'start': sent.start_char, 'end': sent.end_char})
+      for sent_start, sent_end in sent_list:
+        sentences.append({'doc_id':doc_id, 'segment': text[sent_start:sent_end].replace('\n', ' '), 
+                          'start': sent_start, 'end': sent_end})
       
     else:  
       start = 0
-      for i, sent in enumerate(sent_list):
+      for i, (sent_start, sent_end) in enumerate(sent_list):
         # The correct number of sentenes to output
         if (i + 1) % self.N_sentences == 0:        
-          sentences.append({'doc_id':doc_id, 'segment': text[start:sent.end_char].replace('\n', ' '), 
-                            'start': start, 'end': sent.end_char})   
+          sentences.append({'doc_id':doc_id, 'segment': text[start:sent_end].replace('\n', ' '), 
+                            'start': start, 'end': sent_end})   
         # The first sentence in the bundle
         elif i % self.N_sentences == 0:
-          start = sent.start_char 
+          start = sent_start 
           
       # append the remaining sentences
       if len(sent_list) % self.N_sentences != 0:
-        sentences.append({'doc_id':doc_id, 'segment': text[start:sent.end_char].replace('\n', ' '), 
-                          'start': start, 'end': sent.end_char})  
+        sentences.append({'doc_id':doc_id, 'segment': text[start:sent_end].replace('\n', ' '), 
+                          'start': start, 'end': sent_end})  
     
     #If gold entities were given, calculate entities in this segment
     if entities is not None:
@@ -359,17 +464,116 @@ class NER_Trainer(Trainer):
       
             
 
+class Token_Buffer:
+  def __init__(self, capacity:int):
+    """
+    This class keeps token predictions {doc, start, end, tag, prob} in preallocated 
+    NumPy arrays of capacity tokens. doc is the document index. The arrays are 
+    enlarged only if more than capacity tokens are kept.
+    """
+    dtypes = {'doc':np.int32, 'start':np.int64, 'end':np.int64, 'tag':np.int32, 'prob':np.float32}
+    self.arrays = {key:np.empty(max(capacity, 1), dtype=dtype) for key, dtype in dtypes.items()}
+    self.size = 0
+    
+  def append(self, tokens:Dict[str, np.ndarray]):
+    n_tokens = len(tokens['tag'])
+    if self.size + n_tokens > len(self.arrays['tag']):
+      capacity = max(2 * len(self.arrays['tag']), self.size + n_tokens)
+      for key, value in self.arrays.items():
+        self.arrays[key] = np.empty(capacity, dtype=value.dtype)
+        self.arrays[key][:self.size] = value[:self.size]
+    for key, value in self.arrays.items():
+      value[self.size:self.size + n_tokens] = tokens[key]
+    self.size += n_tokens
+    
+  def tokens(self) -> Dict[str, np.ndarray]:
+    """
+    This method outputs views of the kept tokens
+    """
+    return {key:value[:self.size] for key, value in self.arrays.items()}
+  
+  def pop_front(self, n_tokens:int):
+    """
+    This method removes the first n_tokens tokens
+    """
+    for value in self.arrays.values():
+      value[:self.size - n_tokens] = value[n_tokens:self.size]
+    self.size -= n_tokens
+    
+    
+def NER_forward(model:AutoModelForTokenClassification, ins:Dict, device:str, special_ids:torch.Tensor, 
+                codes:List[int], length_bucketing:bool=False) -> List[Dict[str, np.ndarray]]:
+  """
+  This function inputs a collated batch of NER dataset items and runs the model. It only 
+  depends on its arguments, so batches mixed from predictors of the same model can run with it.
+  outputs a list of dict {start, end, tag, prob, length} per item, without special tokens. 
+  start, end are token offsets in the document, tag is the index of the predicted 
+  tag in codes (label_map values) and prob is its probability. length is the number 
+  of tokens run through the model for the item.
+
+  Parameters
+  ----------
+  model : AutoModelForTokenClassification
+    A model to make prediction.
+  ins : Dict
+    collated batch {input_ids, attention_mask, spans} (see NER_Dataset.collate).
+  device : str
+    device of the model.
+  special_ids : torch.Tensor
+    token IDs of the tokenizer special tokens, excluded from the outputs.
+  codes : List[int]
+    label codes of the model, in label_map order.
+  length_bucketing : bool, optional
+    If True, the batch is padded to its longest segment instead of token_length. The default is False.
+  """
+  if length_bucketing:
+    # pad the batch to its longest segment
+    length = int(ins['attention_mask'].sum(dim=1).max())
+    ins = {**ins, 'input_ids':ins['input_ids'][:, :length], 
+           'attention_mask':ins['attention_mask'][:, :length],
+           'spans':ins['spans'][:, :length]}
+  input_ids = ins['input_ids'].to(device)
+  attention_mask = ins['attention_mask'].to(device)
+  with torch.no_grad():
+    p = model(input_ids=input_ids, attention_mask=attention_mask)
+    # probabilities in label_map order. The first max is taken on ties.
+    prob, tag = p.logits.float().softmax(dim=-1)[:, :, codes].max(dim=-1)
+    
+  keep = (~torch.isin(ins['input_ids'], special_ids)).numpy()
+  spans = ins['spans'].numpy()
+  tag = tag.cpu().numpy()
+  prob = prob.cpu().numpy()
+  length = ins['input_ids'].shape[1]
+  return [{'start':spans[b, keep[b], 0], 'end':spans[b, keep[b], 1], 'tag':tag[b, keep[b]], 'prob':prob[b, keep[b]], 
+           'length':length} for b in range(len(keep))]
+
+
 class NER_Predictor:
+  # with length_bucketing, segments are sorted by length within windows of bucket_batches batches
+  bucket_batches = 8
+  
   def __init__(self, 
                model:AutoModelForTokenClassification,
                tokenizer:AutoTokenizer, 
                dataset: Dataset,
                label_map:Dict,
                batch_size:int,
-               device:str=None):
+               device:str=None,
+               segment_cache=None,
+               scheduler=None,
+               progress:Callable[[str, int, int], None]=None,
+               partial:Callable[[List[Information_Extraction_Document]], None]=None,
+               length_bucketing:bool=False,
+               stream_segments:int=None,
+               prefetch_batches:int=0):
     """
     This class takes a model and an unlabeled dataset 
-    outputs a list of IEs with entities
+    outputs a list of IEs with entities.
+    If a segment cache is given, token predictions are cached by segment text 
+    (relative to the segment start), so only segments never seen before are 
+    run through the model. Repeated segments within the dataset run once.
+    If a scheduler is given, segments are run in batches shared with other 
+    predictors of the same model.
 
     Parameters
     ----------
@@ -385,6 +589,37 @@ class NER_Predictor:
       batch size for prediction. Does not affect prediction results.
     device : str, optional
       CUDA device name. The default is cuda:0 if available, or cpu.
+    segment_cache : optional
+      cache with get(key) and put(key, value) methods (e.g. modules.cache.result_cache), 
+      dedicated to this model. The default is None (no cache).
+    scheduler : optional
+      batch scheduler with a submit(key, items, run_batch, batch_size) method 
+      (e.g. modules.scheduler.batch_scheduler). The default is None (batches from this dataset only).
+    progress : Callable[[str, int, int], None], optional
+      function called after each batch with ('NER', segments done, segments to predict). 
+      It can raise an exception to cancel the prediction. The default is None.
+    partial : Callable[[List[Information_Extraction_Document]], None], optional
+      function called after each batch with IEs of the new entities since the last call 
+      (only documents with new entities), for showing results before the prediction is done. 
+      Entities are passed once the leading segments up to them are all predicted and they 
+      cannot change. The default is None.
+    length_bucketing : bool, optional
+      If True, segments are run in order of token length within windows of bucket_batches 
+      batches, and each batch is padded to its longest segment instead of token_length, 
+      so short segments are batched together. Windows run in dataset order, so partial 
+      results still grow from the start. Each window is tokenized before it runs (also 
+      with prefetch_batches). Entities are the same. The default is False.
+    stream_segments : int, optional
+      If given, segments are predicted in windows of stream_segments segments in dataset 
+      order, and entities are decoded after each window, so token predictions of at most 
+      one window (and the last, unfinished, entity) are kept in memory, however many documents 
+      are in the dataset. Repeated segments are only shared across windows through segment_cache. 
+      progress and partial are called after each window. Entities are the same. 
+      The default is None (token predictions of all segments are kept until the end).
+    prefetch_batches : int, optional
+      If > 0, batches are tokenized in a worker thread while the model runs, with up to 
+      prefetch_batches tokenized batches waiting. The default is 0 (segments are tokenized 
+      before the first batch runs).
     """
     
     if device:
@@ -399,85 +634,347 @@ class NER_Predictor:
     self.label_map = label_map
     self.batch_size = batch_size
     self.dataset = dataset
-    self.dataloader = DataLoader(self.dataset, batch_size=self.batch_size, shuffle=False, drop_last=False)
+    self.dataloader = DataLoader(self.dataset, batch_size=self.batch_size, shuffle=False, drop_last=False, 
+                                 collate_fn=self.dataset.collate)
+    self.segment_cache = segment_cache
+    self.scheduler = scheduler
+    self.progress = progress
+    self.partial = partial
+    self.length_bucketing = length_bucketing
+    self.stream_segments = stream_segments
+    self.prefetch_batches = prefetch_batches
+    self.special_ids = torch.tensor(self.tokenizer.all_special_ids)
+    self.codes = list(self.label_map.values())
+    # tokens run through the model, and tokens if padded to token_length
+    self.padded_tokens = 0
+    self.max_length_tokens = 0
 
   def predict(self) -> List[Information_Extraction_Document]:
     """
     This method outputs a list of IE with entities
     """
-    token_pred = {'doc_id':[],
-                  'input_id':[],
-                 'start':[],
-                 'end':[]}
-    for tag in self.label_map.keys():
-      token_pred[f'prob_{tag}'] = []
+    if self.stream_segments is not None:
+      return self._predict_stream()
     
-    loop = tqdm(enumerate(self.dataloader), total=len(self.dataloader), leave=True)
-    for i, ins in loop:  
-      input_ids = ins['input_ids'].to(self.device)
-      attention_mask = ins['attention_mask'].to(self.device)
-      with torch.no_grad():
-        p = self.model(input_ids=input_ids, attention_mask=attention_mask)
-        prob = p.logits.softmax(dim=-1)
-        for b in range(prob.shape[0]):
-          token_pred['doc_id'].extend([i[b] for i in ins['doc_id']])
-          token_pred['input_id'].extend(ins['input_ids'][b].cpu().tolist())
-          token_pred['start'].extend([i[0][b].item() for i in ins['spans']])
-          token_pred['end'].extend([i[1][b].item() for i in ins['spans']])
-          for tag, code in self.label_map.items():
-            token_pred[f'prob_{tag}'].extend(prob[b,:,code].cpu().tolist())
-    
-    # df of predicted entities
-    token_pred_df = pd.DataFrame(token_pred)
-    # exlucde special tokens
-    token_pred_df = token_pred_df.loc[~token_pred_df['input_id'].isin(self.tokenizer.all_special_ids)].\
-      reset_index(drop=True)
-    # Calculate predicted entity type
-    token_pred_df['entity_type'] = token_pred_df[[f'prob_{v}' for v in self.label_map.keys()]].\
-    idxmax(axis=1).str.replace('prob_', '')
-    token_pred_df['prob'] = token_pred_df[[v for v in token_pred_df.columns if \
-                                                       re.match('^prob_', v)]].max(axis=1)
+    segment_preds, indices = self._lookup_segments(range(len(self.dataset.segments)))
+    # leading segments passed to partial, and their tokens of an entity that can continue
+    n_partial = 0
+    partial_buffer = Token_Buffer(self.batch_size * self.dataset.token_length) if self.partial is not None else None
+    done = 0
+    for preds in self._run_segments(indices):
+      segment_preds.update(preds)
+      done += len(preds)
+      if self.partial is not None:
+        n_partial = self._update_partial(segment_preds, n_partial, partial_buffer)
+      if self.progress is not None:
+        self.progress('NER', done, len(indices))
       
-    token_pred_df = token_pred_df[['doc_id', 'start', 'end', 'entity_type', 'prob']]
-    
-    entities = self._tokens_to_entities(token_df=token_pred_df)
-    return self._entities_to_IEs(entities)
-
-
-  def _tokens_to_entities(self, token_df: pd.DataFrame) -> pd.DataFrame:
+    return self._segments_to_IEs(segment_preds, len(self.dataset.segments))
+  
+  
+  def _predict_stream(self) -> List[Information_Extraction_Document]:
     """
-    This method inputs a df of tokens. must has columns: [doc_id, start, end, entity_type, prob]
-    outputs a df of [doc_id, start, end, entity_type, prob, conf]
+    This method predicts segments in windows of stream_segments segments and decodes 
+    entities after each window. Tokens of the last chunk of a window are kept in the 
+    token buffer, since the chunk can continue in the next window.
     """
-    
-    if self.dataset.mode == 'BIO':
-      entity_chunk = (token_df['entity_type'].str.match('^B-|^O')).cumsum()
+    segments = self.dataset.segments
+    ies = [Information_Extraction_Document(doc_id=ie['doc_id'], text=ie['text']) for ie in self.dataset.IEs]
+    buffer = Token_Buffer(self.stream_segments * self.dataset.token_length)
+    for window_start in range(0, len(segments), self.stream_segments):
+      window_end = min(window_start + self.stream_segments, len(segments))
+      segment_preds, indices = self._lookup_segments(range(window_start, window_end))
+      for preds in self._run_segments(indices):
+        segment_preds.update(preds)
+        
+      entities = self._decode_buffer(buffer, self._segments_to_tokens(segment_preds, segments[window_start:window_end]), 
+                                     window_end == len(segments))
+      new_ies = self._new_entity_IEs(entities)
+      for doc, ie in new_ies.items():
+        ies[doc].entity.extend(ie.entity)
+      if self.partial is not None and len(new_ies) > 0:
+        self.partial(list(new_ies.values()))
+      if self.progress is not None:
+        self.progress('NER', window_end, len(segments))
+        
+    return ies
+  
+  
+  def _update_partial(self, segment_preds:Dict[str, Dict[str, np.ndarray]], n_partial:int, 
+                      buffer:Token_Buffer) -> int:
+    """
+    This method calls partial with the new entities of the leading segments that are 
+    all predicted, after the first n_partial segments already passed to partial. 
+    Tokens of an entity that can continue in the next segment are kept in buffer. 
+    outputs the number of leading segments passed to partial
+    """
+    segments = self.dataset.segments
+    n_segments = n_partial
+    while n_segments < len(segments) and segment_preds[segments[n_segments]['segment']] is not None:
+      n_segments += 1
+    if n_segments > n_partial:
+      entities = self._decode_buffer(buffer, self._segments_to_tokens(segment_preds, segments[n_partial:n_segments]), 
+                                     n_segments == len(segments))
+      new_ies = self._new_entity_IEs(entities)
+      if len(new_ies) > 0:
+        self.partial(list(new_ies.values()))
+    return n_segments
+  
+  
+  def _decode_buffer(self, buffer:Token_Buffer, tokens:Dict[str, np.ndarray], last:bool) -> Dict[str, np.ndarray]:
+    """
+    This method appends tokens to the token buffer and decodes the entities that 
+    cannot change, or all entities if last is True (no more tokens follow)
+    outputs entity arrays (see _tokens_to_entities)
+    """
+    buffer.append(tokens)
+    tokens = buffer.tokens()
+    n_tokens = len(tokens['tag']) if last else self._complete_length(tokens)
+    entities = self._tokens_to_entities({key:value[:n_tokens] for key, value in tokens.items()})
+    buffer.pop_front(n_tokens)
+    return entities
+  
+  
+  def _lookup_segments(self, indices:Iterator[int]) -> Tuple[Dict[str, Dict[str, np.ndarray]], List[int]]:
+    """
+    This method inputs dataset indices and looks up their segments in the segment cache
+    outputs token predictions by segment text (None if not cached) and the indices 
+    of the first occurrence of each segment not in cache
+    """
+    segment_preds = {}
+    indices_to_run = []
+    for idx in indices:
+      segment = self.dataset.segments[idx]['segment']
+      if segment not in segment_preds:
+        cached = None if self.segment_cache is None else self.segment_cache.get(segment)
+        if cached is None:
+          segment_preds[segment] = None
+          indices_to_run.append(idx)
+        else:
+          segment_preds[segment] = {key:np.array(value) for key, value in cached.items()}
+          
+    return segment_preds, indices_to_run
+  
+  
+  def _run_segments(self, indices:List[int]) -> Iterator[Dict[str, Dict[str, np.ndarray]]]:
+    """
+    This method inputs dataset indices and runs the model on these segments
+    yields token predictions by segment text for each batch, and puts them in the segment cache
+    """
+    if len(indices) == 0:
+      return
+    # with length bucketing, segments are sorted within windows, so leading segments are done early
+    window = self.batch_size * self.bucket_batches if self.length_bucketing else len(indices)
+    for window_start in range(0, len(indices), window):
+      window_indices = indices[window_start:window_start + window]
+      # length bucketing needs the token lengths first, batches are then sliced from the same tokenization
+      if self.prefetch_batches == 0 or self.length_bucketing:
+        self.dataset.pretokenize(window_indices)
+      if self.length_bucketing:
+        # stable sort, segments of the same length keep the document order
+        lengths = self.dataset.get_token_lengths(window_indices)
+        window_indices = [idx for _, idx in sorted(zip(lengths, window_indices), key=lambda x: x[0])]
+      done = 0
+      for preds in self._predict_segments(window_indices):
+        batch_preds = {}
+        for idx, pred in zip(window_indices[done:done + len(preds)], preds):
+          batch_preds[self.dataset.segments[idx]['segment']] = pred
+          if self.segment_cache is not None:
+            self.segment_cache.put(self.dataset.segments[idx]['segment'], 
+                                   {key:value.tolist() for key, value in pred.items()})
+        done += len(preds)
+        yield batch_preds
+  
+  
+  def _segments_to_IEs(self, segment_preds:Dict[str, Dict[str, np.ndarray]], 
+                       n_segments:int) -> List[Information_Extraction_Document]:
+    """
+    This method inputs token predictions by segment text and outputs a list of IEs 
+    with the entities in the first n_segments segments of the dataset
+    """
+    tokens = self._segments_to_tokens(segment_preds, self.dataset.segments[:n_segments])
+    return self._entities_to_IEs(self._tokens_to_entities(tokens))
+  
+  
+  def _segments_to_tokens(self, segment_preds:Dict[str, Dict[str, np.ndarray]], 
+                          segments:List[Dict]) -> Dict[str, np.ndarray]:
+    """
+    This method inputs token predictions by segment text and a list of segments
+    outputs token arrays {doc, start, end, tag, prob} of the segments, with offsets in 
+    the document. doc is the index of the document in dataset.IEs.
+    """
+    preds = [segment_preds[seg['segment']] for seg in segments]
+    lengths = [len(pred['start']) for pred in preds]
+    seg_starts = np.repeat(np.array([seg['start'] for seg in segments], dtype=np.int64), lengths)
+    return {'doc':np.repeat(np.array([self.dataset.doc_index[seg['doc_id']] for seg in segments], dtype=np.int64), lengths),
+            'start':np.concatenate([pred['start'] for pred in preds] + [np.zeros(0, dtype=np.int64)]) + seg_starts,
+            'end':np.concatenate([pred['end'] for pred in preds] + [np.zeros(0, dtype=np.int64)]) + seg_starts,
+            'tag':np.concatenate([pred['tag'] for pred in preds] + [np.zeros(0, dtype=np.int64)]),
+            'prob':np.concatenate([pred['prob'] for pred in preds] + [np.zeros(0)])}
+  
+  
+  def _predict_segments(self, indices:List[int]) -> Iterator[List[Dict[str, np.ndarray]]]:
+    """
+    This method inputs dataset indices and runs the model on these segments
+    yields a list of dict {start, end, tag, prob} per segment for each batch. 
+    start, end are token offsets relative to the segment start, tag is the index 
+    of the predicted tag in label_map and prob is its probability. 
+    Special tokens are excluded.
+    """
+    batch_indices = [indices[i:i + self.batch_size] for i in range(0, len(indices), self.batch_size)]
+    if self.prefetch_batches > 0:
+      # tokenize the next batches in a worker thread while the model runs
+      inputs = prefetch((self.dataset.encode(idx) for idx in batch_indices), self.prefetch_batches)
     else:
-      entity_chunk = (token_df['entity_type'] != token_df['entity_type'].shift()).cumsum()
+      inputs = (self.dataset.collate([self.dataset[i] for i in idx]) for idx in batch_indices)
       
-    entity = token_df.groupby(['doc_id', entity_chunk], sort=False, as_index=False).\
-      agg({'start':'min', 'end':'max', 'entity_type':'max', 'prob':'mean'})
+    if self.scheduler is None:
+      loop = tqdm(inputs, total=len(batch_indices), leave=True)
+      batches = (self._forward(ins) for ins in loop)
+    else:
+      # submit one batch at a time, so results are returned per batch
+      # batches can mix items of predictors of the same model, so run_batch does not use the predictor
+      model, device, special_ids, codes, length_bucketing = self.model, self.device, self.special_ids, self.codes, self.length_bucketing
+      collate = self.dataset.collate
+      run_batch = lambda items: NER_forward(model, collate(items), device, special_ids, codes, length_bucketing)
+      batches = (self.scheduler.submit(key=('NER', id(self.model), self.length_bucketing), 
+                                       items=uncollate(ins), 
+                                       run_batch=run_batch, 
+                                       batch_size=self.batch_size)
+                 for ins in inputs)
+      
+    done = 0
+    for outputs in batches:
+      segment_preds = []
+      for idx, output in zip(indices[done:done + len(outputs)], outputs):
+        self.padded_tokens += output['length']
+        self.max_length_tokens += self.dataset.token_length
+        seg_start = self.dataset.segments[idx]['start']
+        segment_preds.append({'start':output['start'] - seg_start,
+                              'end':output['end'] - seg_start,
+                              'tag':output['tag'],
+                              'prob':output['prob']})
+      done += len(outputs)
+      yield segment_preds
+  
   
-    entity = entity.loc[entity['entity_type'] != 'O']
-    entity['entity_type'] = entity['entity_type'].str.replace('B-', '').str.replace('I-', '')
+  def _forward(self, ins:Dict) -> List[Dict[str, np.ndarray]]:
+    """
+    This method inputs a collated batch of dataset items and runs the model (see NER_forward)
+    outputs a list of dict {start, end, tag, prob, length} per item, without special tokens. 
+    """
+    return NER_forward(self.model, ins, self.device, self.special_ids, self.codes, self.length_bucketing)
+
+
+  def padding_stats(self) -> Dict[str, float]:
+    """
+    This method outputs {padded_tokens, max_length_tokens, padding_saved}: tokens run through 
+    the model, tokens if all segments were padded to token_length and the ratio saved
+    """
+    return {'padded_tokens':self.padded_tokens,
+            'max_length_tokens':self.max_length_tokens,
+            'padding_saved':round(1 - self.padded_tokens / self.max_length_tokens, 3) if self.max_length_tokens else 0}
+
+
+  def _tokens_to_entities(self, tokens:Dict[str, np.ndarray]) -> Dict[str, np.ndarray]:
+    """
+    This method inputs token arrays {doc, start, end, tag, prob} in document order 
+    outputs entity arrays {doc, start, end, entity_type, prob, conf}. 
+    Tokens are chunked by run-length: in BIO mode a chunk starts at each B- or O tag, 
+    in IO mode at each change of tag, and always at a new document. A chunk spans its 
+    tokens, its type is the max tag name (string order), its prob is the mean token 
+    prob, and chunks of type O are dropped.
+    """
+    tags = list(self.label_map.keys())
+    n_tokens = len(tokens['tag'])
+    if n_tokens == 0:
+      return {'doc':np.zeros(0, dtype=np.int64), 'start':np.zeros(0, dtype=np.int64), 'end':np.zeros(0, dtype=np.int64),
+              'entity_type':np.zeros(0, dtype=object), 'prob':np.zeros(0), 'conf':np.zeros(0)}
+    
+    tag = tokens['tag']
+    chunk_starts = np.flatnonzero(self._new_chunks(tokens))
+    counts = np.diff(np.append(chunk_starts, n_tokens))
+    
+    # max tag name of each chunk, by the rank of tag names in string order
+    tag_order = np.argsort(np.array(tags, dtype=object))
+    tag_rank = np.empty(len(tags), dtype=np.int64)
+    tag_rank[tag_order] = np.arange(len(tags))
+    chunk_tag = tag_order[np.maximum.reduceat(tag_rank[tag], chunk_starts)]
+    entity_types = np.array([t.replace('B-', '').replace('I-', '') for t in tags], dtype=object)
+    
+    entity = {'doc':tokens['doc'][chunk_starts],
+              'start':np.minimum.reduceat(tokens['start'], chunk_starts),
+              'end':np.maximum.reduceat(tokens['end'], chunk_starts),
+              'entity_type':entity_types[chunk_tag],
+              'prob':np.add.reduceat(tokens['prob'].astype(np.float64), chunk_starts) / counts}
+    is_entity = np.array([t != 'O' for t in tags])[chunk_tag]
+    entity = {key:value[is_entity] for key, value in entity.items()}
     # confident = prob / baseline prob
     entity['conf'] = entity['prob'] * len(self.label_map)
-    return entity.reindex(['doc_id', 'start', 'end', 'entity_type', 'prob', 'conf'], axis=1)
+    return entity
     
   
-  def _entities_to_IEs(self, entities: pd.DataFrame) -> List[Information_Extraction_Document]:
-    ies = {ie['doc_id']: Information_Extraction_Document(doc_id=ie['doc_id'], text=ie['text']) 
-           for ie in self.dataset.IEs}
-    for r in entities.itertuples():
-      entity_id = f'{r.doc_id}_{r.start}_{r.end}'
-      entity_text = ies[r.doc_id]['text'][r.start:r.end].replace('\n', ' ')
-      ies[r.doc_id].entity.append({'entity_id':entity_id, 
-                                   'entity_text':entity_text, 
-                                   'entity_type':r.entity_type,
-                                   'start':r.start,
-                                   'end':r.end,
-                                   'prob':r.prob,
-                                   'conf':r.conf})
+  def _new_chunks(self, tokens:Dict[str, np.ndarray]) -> np.ndarray:
+    """
+    This method inputs token arrays {doc, tag, ...} and outputs a bool array, True 
+    for tokens that start a chunk (see _tokens_to_entities)
+    """
+    tag = tokens['tag']
+    new_chunk = np.ones(len(tag), dtype=bool)
+    if self.dataset.mode == 'BIO':
+      starts_chunk = np.array([t.startswith('B-') or t.startswith('O') for t in self.label_map.keys()])
+      new_chunk[1:] = starts_chunk[tag[1:]]
+    else:
+      new_chunk[1:] = tag[1:] != tag[:-1]
+    new_chunk[1:] |= tokens['doc'][1:] != tokens['doc'][:-1]
+    return new_chunk
+  
+  
+  def _complete_length(self, tokens:Dict[str, np.ndarray]) -> int:
+    """
+    This method inputs token arrays that more tokens may follow
+    outputs the number of leading tokens whose chunks cannot change. The last chunk 
+    can continue, so its tokens are excluded. A chunk with an O tag stays type O 
+    (O is after B- and I- tags in string order), so only the tokens from its last O 
+    tag are excluded, which following tokens are chunked with.
+    """
+    if len(tokens['tag']) == 0:
+      return 0
+    last_start = int(np.flatnonzero(self._new_chunks(tokens))[-1])
+    O_tokens = np.flatnonzero(tokens['tag'][last_start:] == list(self.label_map.keys()).index('O'))
+    return last_start + int(O_tokens[-1]) if len(O_tokens) > 0 else last_start
+  
+  
+  def _new_entity_IEs(self, entities:Dict[str, np.ndarray]) -> Dict[int, Information_Extraction_Document]:
+    """
+    This method inputs entity arrays (see _tokens_to_entities)
+    outputs new IEs with these entities by document index, for the documents with entities
+    """
+    ies = {doc:Information_Extraction_Document(doc_id=self.dataset.IEs[doc]['doc_id'], text=self.dataset.IEs[doc]['text']) 
+           for doc in set(entities['doc'].tolist())}
+    return self._entities_to_IEs(entities, ies)
+  
+  
+  def _entities_to_IEs(self, entities:Dict[str, np.ndarray], 
+                       ies:List[Information_Extraction_Document]=None) -> List[Information_Extraction_Document]:
+    """
+    This method inputs entity arrays (see _tokens_to_entities) and adds the entities 
+    to ies, a list (or dict) of IEs by document index (new IEs of dataset.IEs by default)
+    outputs the IEs
+    """
+    if ies is None:
+      ies = [Information_Extraction_Document(doc_id=ie['doc_id'], text=ie['text']) for ie in self.dataset.IEs]
+    for doc, start, end, entity_type, prob, conf in zip(entities['doc'].tolist(), entities['start'].tolist(),
+                                                         entities['end'].tolist(), entities['entity_type'].tolist(),
+                                                         entities['prob'].tolist(), entities['conf'].tolist()):
+      ie = ies[doc]
+      ie.entity.append({'entity_id':f'{ie["doc_id"]}_{start}_{end}', 
+                        'entity_text':ie['text'][start:end].replace('\n', ' '), 
+                        'entity_type':entity_type,
+                        'start':start,
+                        'end':end,
+                        'prob':prob,
+                        'conf':conf})
       
-    return list(ies.values())
+    return ies
   
\ No newline at end of file
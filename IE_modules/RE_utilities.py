@@ -1,14 +1,14 @@
 # -*- coding: utf-8 -*-
 import abc
-from typing import List, Tuple, Dict, Optional
+from typing import List, Tuple, Dict, Optional, Callable
+import numpy as np
 import pandas as pd
-from IE_modules.Utilities import Information_Extraction_Document, Trainer
+from IE_modules.Utilities import Information_Extraction_Document, Trainer, to_tensor, uncollate, prefetch
 from transformers import AutoTokenizer
 import torch
 from torch.utils.data import Dataset, DataLoader
 from transformers import AutoModelForSequenceClassification
 from tqdm import tqdm
-from itertools import combinations
 
 
 def binary_search(position:int, spans:Tuple[int, int]) -> int:
@@ -53,7 +53,8 @@ class RE_Dataset(Dataset):
     """
     This parent class inputs list of IEs and for any combination of 2 entities, 
     outputs the segment of tokens (tokenizer) as dict 
-    {document_id, input_ids, attention_mask, (labels)}
+    {pair_index, input_ids, attention_mask, (label)}. pair_index is the index of 
+    the segment (entity pair) in segments.
     number of tokens per input is padded/ truncated to token_length
 
     Parameters
@@ -77,6 +78,11 @@ class RE_Dataset(Dataset):
     self.tokenizer = tokenizer
     self.token_length = token_length
     self.possible_rel = set([tuple(rel)for rel in possible_rel])
+    # entity types that can have a relation with each entity type
+    self.possible_rel_index = {}
+    for entity_1_type, entity_2_type in self.possible_rel:
+      self.possible_rel_index.setdefault(entity_1_type, set()).add(entity_2_type)
+      self.possible_rel_index.setdefault(entity_2_type, set()).add(entity_1_type)
     self.label_map = label_map
     self.has_label = has_label
     
@@ -86,6 +92,9 @@ class RE_Dataset(Dataset):
     
     self.segments = []
     self.get_segments()
+    # pre-tokenized segments (see pretokenize)
+    self.encodings = None
+    self.encoded_segments = None
     
   
   @abc.abstractmethod
@@ -154,31 +163,102 @@ class RE_Dataset(Dataset):
             (entity_2_type, entity_1_type) in self.possible_rel
   
   
+  def _get_candidate_pairs(self, ie:Information_Extraction_Document) -> List[Tuple[Dict, Dict]]:
+    """
+    This method outputs the pairs of entities to model: pairs within token_length tokens 
+    (_check_N_tokens_between) that are possible to have relation (_check_possible_rel), 
+    in the order of combinations(ie['entity'], 2). 
+    Entities are sorted by token position and each entity is checked against the 
+    following entities within token_length tokens only, instead of all entities.
+    """
+    entities = ie['entity']
+    positions = [self.entity_spans[ie['doc_id']][e['entity_id']] for e in entities]
+    order = sorted(range(len(entities)), key=lambda i:positions[i])
+    pairs = []
+    for k, i in enumerate(order):
+      entity_2_types = self.possible_rel_index.get(entities[i]['entity_type'], set())
+      m = k + 1
+      while m < len(order) and positions[order[m]] - positions[i] < self.token_length:
+        j = order[m]
+        if entities[j]['entity_type'] in entity_2_types:
+          pairs.append((min(i, j), max(i, j)))
+        m += 1
+    
+    pairs.sort()
+    return [(entities[i], entities[j]) for i, j in pairs]
+  
+  
   def __len__(self):
     return len(self.segments)
   
   
-  def __getitem__(self, idx:int) -> Dict:
-    # get segment
-    seg = self.segments[idx]
-    # tokenize segment
-    tokens = self.tokenizer(seg['segment'], 
+  def pretokenize(self):
+    """
+    This method tokenizes all segments in one batched tokenizer call. input_ids and 
+    attention_mask are kept as [segment, token_length] tensors, and __getitem__ outputs 
+    slices of them. If self.segments is replaced, segments are tokenized in __getitem__.
+    """
+    self.encoded_segments = self.segments
+    if len(self.segments) == 0:
+      self.encodings = None
+      return
+    
+    encoded = self.encode(range(len(self.segments)))
+    self.encodings = {key:encoded[key] for key in ['input_ids', 'attention_mask']}
+  
+  
+  def encode(self, indices:List[int]) -> Dict[str, torch.Tensor]:
+    """
+    This method tokenizes segments in one batched tokenizer call
+    outputs a batch {pair_index, input_ids, attention_mask} as collate() (without labels)
+    """
+    tokens = self.tokenizer([self.segments[idx]['segment'] for idx in indices], 
                             padding='max_length',
                             max_length=self.token_length,
                             truncation=True,
                             add_special_tokens=True,
                             return_token_type_ids=False)
-    
-    tokens['input_ids'] = torch.tensor(tokens['input_ids'])
-    tokens['attention_mask'] = torch.tensor(tokens['attention_mask'])
-    tokens['doc_id'] = seg['doc_id']
-    tokens['entity_1_id'] = seg['entity_1_id']
-    tokens['entity_2_id'] = seg['entity_2_id']
+    shape = (len(indices), self.token_length)
+    return {'input_ids':to_tensor(tokens['input_ids'], shape),
+            'attention_mask':to_tensor(tokens['attention_mask'], shape),
+            'pair_index':torch.tensor(list(indices))}
+  
+  
+  def __getitem__(self, idx:int) -> Dict:
+    # get segment
+    seg = self.segments[idx]
+    if self.encodings is not None and self.encoded_segments is self.segments:
+      tokens = {'input_ids':self.encodings['input_ids'][idx],
+                'attention_mask':self.encodings['attention_mask'][idx]}
+    else:
+      # tokenize segment
+      encoded = self.tokenizer(seg['segment'], 
+                               padding='max_length',
+                               max_length=self.token_length,
+                               truncation=True,
+                               add_special_tokens=True,
+                               return_token_type_ids=False)
+      tokens = {'input_ids':torch.tensor(encoded['input_ids']),
+                'attention_mask':torch.tensor(encoded['attention_mask'])}
+      
+    tokens['pair_index'] = idx
     
     if self.has_label:
       tokens['label'] = torch.tensor(self.label_map[seg['relation_type']])
     
     return tokens
+  
+  
+  @staticmethod
+  def collate(items:List[Dict]) -> Dict[str, torch.Tensor]:
+    """
+    This method collates dataset items into a batch {pair_index, input_ids, attention_mask, (label)}. 
+    input_ids, attention_mask are [batch, token_length] tensors, pair_index (and label) 
+    are [batch] tensors.
+    """
+    batch = {key:torch.stack([item[key] for item in items]) for key in items[0] if key != 'pair_index'}
+    batch['pair_index'] = torch.tensor([item['pair_index'] for item in items])
+    return batch
 
 
 class InlineTag_RE_Dataset(RE_Dataset):
@@ -206,35 +286,31 @@ class InlineTag_RE_Dataset(RE_Dataset):
     
   def _get_segments(self, ie:Information_Extraction_Document) -> List[Dict[str, str]]:
     segments = []
-    for entity_1, entity_2 in combinations(ie['entity'], 2):
-      within_N_tokens = self._check_N_tokens_between(ie['doc_id'], entity_1['entity_id'], entity_2['entity_id'])
-      within_possible_rel = self._check_possible_rel(entity_1['entity_type'], entity_2['entity_type'])
+    for entity_1, entity_2 in self._get_candidate_pairs(ie):
+      mid_token_pos = (self.entity_spans[ie['doc_id']][entity_1['entity_id']] + \
+                       self.entity_spans[ie['doc_id']][entity_2['entity_id']]) //2
       
-      if within_N_tokens and within_possible_rel:
-        mid_token_pos = (self.entity_spans[ie['doc_id']][entity_1['entity_id']] + \
-                         self.entity_spans[ie['doc_id']][entity_2['entity_id']]) //2
-        
-        start_token_pos = max(0, mid_token_pos - self.token_length//2) + 1
-        end_token_pos = min(mid_token_pos + self.token_length//2, len(self.token_spans[ie['doc_id']]) - 1)
-        
-        start_pos = self.token_spans[ie['doc_id']][start_token_pos][0]
-        end_pos = self.token_spans[ie['doc_id']][end_token_pos][1]
-        first_entity, second_entity = sorted([entity_1, entity_2], key=lambda x:x['start'])
-        
-        segment = ie['text'][start_pos:first_entity['start']] + " [E] " + \
-                  ie['text'][first_entity['start']:first_entity['end']] + " [\E] " + \
-                  ie['text'][first_entity['end']:second_entity['start']] + " [E] " + \
-                  ie['text'][second_entity['start']:second_entity['end']] + " [\E] " + \
-                  ie['text'][second_entity['end']:end_pos]
-        
-        if self.has_label:
-          segments.append({'doc_id':ie['doc_id'], 'segment':segment, 
-                           'entity_1_id':entity_1['entity_id'], 'entity_2_id':entity_2['entity_id'],
-                           'relation_type':self._get_relation_type(ie['relation'], 
-                                                                   entity_1['entity_id'], entity_2['entity_id'])})
-        else:
-          segments.append({'doc_id':ie['doc_id'], 'segment':segment, 
-                           'entity_1_id':entity_1['entity_id'], 'entity_2_id':entity_2['entity_id']})
+      start_token_pos = max(0, mid_token_pos - self.token_length//2) + 1
+      end_token_pos = min(mid_token_pos + self.token_length//2, len(self.token_spans[ie['doc_id']]) - 1)
+      
+      start_pos = self.token_spans[ie['doc_id']][start_token_pos][0]
+      end_pos = self.token_spans[ie['doc_id']][end_token_pos][1]
+      first_entity, second_entity = sorted([entity_1, entity_2], key=lambda x:x['start'])
+      
+      segment = ie['text'][start_pos:first_entity['start']] + " [E] " + \
+                ie['text'][first_entity['start']:first_entity['end']] + " [\E] " + \
+                ie['text'][first_entity['end']:second_entity['start']] + " [E] " + \
+                ie['text'][second_entity['start']:second_entity['end']] + " [\E] " + \
+                ie['text'][second_entity['end']:end_pos]
+      
+      if self.has_label:
+        segments.append({'doc_id':ie['doc_id'], 'segment':segment, 
+                         'entity_1_id':entity_1['entity_id'], 'entity_2_id':entity_2['entity_id'],
+                         'relation_type':self._get_relation_type(ie['relation'], 
+                                                                 entity_1['entity_id'], entity_2['entity_id'])})
+      else:
+        segments.append({'doc_id':ie['doc_id'], 'segment':segment, 
+                         'entity_1_id':entity_1['entity_id'], 'entity_2_id':entity_2['entity_id']})
     
     return segments
     
@@ -336,6 +412,19 @@ class RE_Trainer(Trainer):
       self.best_loss = min(self.best_loss, valid_mean_loss)
             
 
+def RE_forward(model:AutoModelForSequenceClassification, batch:Dict, device:str) -> List[np.ndarray]:
+  """
+  This function inputs a collated batch of RE dataset items and runs the model. It only 
+  depends on its arguments, so batches mixed from predictors of the same model can run with it.
+  outputs the probabilities of each label per item
+  """
+  input_ids = batch['input_ids'].to(device)
+  attention_mask = batch['attention_mask'].to(device)
+  with torch.no_grad():
+    p = model(input_ids=input_ids, attention_mask=attention_mask)
+    return list(p.logits.float().softmax(dim=-1).cpu().numpy())
+
+
 class RE_Predictor:
   def __init__(self, 
                model:AutoModelForSequenceClassification,
@@ -343,11 +432,17 @@ class RE_Predictor:
                dataset: Dataset,
                label_map:Dict,
                batch_size:int,
-               device:str=None):
+               device:str=None,
+               scheduler=None,
+               progress:Callable[[str, int, int], None]=None,
+               partial:Callable[[List[Information_Extraction_Document]], None]=None,
+               prefetch_batches:int=0):
     """
     This class inputs a fine-tuned model and a dataset. 
     outputs a list of IEs with entities (same as input), relations and probability
     {relation_id, relation_type, relation_prob, entity_1_id, entity_2_id, entity_1_text, entity_2_text}
+    If a scheduler is given, entity pairs are run in batches shared with other 
+    predictors of the same model.
 
     Parameters
     ----------
@@ -363,6 +458,20 @@ class RE_Predictor:
       batch size for prediction. Does not affect prediction results.
     device : str, optional
       CUDA device name. The default is cuda:0 if available, or cpu.
+    scheduler : optional
+      batch scheduler with a submit(key, items, run_batch, batch_size) method 
+      (e.g. modules.scheduler.batch_scheduler). The default is None (batches from this dataset only).
+    progress : Callable[[str, int, int], None], optional
+      function called after each batch with ('RE', entity pairs done, entity pairs). 
+      It can raise an exception to cancel the prediction. The default is None.
+    partial : Callable[[List[Information_Extraction_Document]], None], optional
+      function called after each batch with IEs of the relations in the batch (only 
+      documents with relations), for showing results before the prediction is done. 
+      The default is None.
+    prefetch_batches : int, optional
+      If > 0, batches are tokenized in a worker thread while the model runs, with up to 
+      prefetch_batches tokenized batches waiting. The default is 0 (entity pairs are 
+      tokenized before the first batch runs).
     """
     if device:
       self.device = device
@@ -376,45 +485,102 @@ class RE_Predictor:
     self.label_map = label_map
     self.batch_size = batch_size
     self.dataset = dataset
-    self.dataloader = DataLoader(self.dataset, batch_size=self.batch_size, shuffle=False, drop_last=False)
+    self.dataloader = DataLoader(self.dataset, batch_size=self.batch_size, shuffle=False, drop_last=False, 
+                                 collate_fn=self.dataset.collate)
+    self.scheduler = scheduler
+    self.progress = progress
+    self.partial = partial
+    self.prefetch_batches = prefetch_batches
+    # entity text by (doc_id, entity_id), the first entity with the ID as in get_entity_by_id
+    self.entity_texts = {}
+    for ie in self.dataset.IEs:
+      for e in ie['entity']:
+        self.entity_texts.setdefault((ie['doc_id'], e['entity_id']), e['entity_text'])
 
   def predict(self) -> List[Information_Extraction_Document]:
     """
     This method outputs a dict of IEs {doc_id, IE} with relations
     """
-    prob_list = []
-    entity_pair_list = []
-    loop = tqdm(enumerate(self.dataloader), total=len(self.dataloader), leave=True)
-    for i, batch in loop:  
-      input_ids = batch['input_ids'].to(self.device)
-      attention_mask = batch['attention_mask'].to(self.device)
-      with torch.no_grad():
-        p = self.model(input_ids=input_ids, attention_mask=attention_mask)
-        pred = p.logits.softmax(dim=-1).cpu().tolist()
-        entity_pair_list.extend(list(zip(batch['doc_id'], batch['entity_1_id'], batch['entity_2_id'])))
-        prob_list.extend(pred)
-    
+    # label probabilities of each entity pair, filled by pair index
+    probs = np.zeros((len(self.dataset), len(self.label_map)))
+    batch_indices = [range(i, min(i + self.batch_size, len(self.dataset))) for i in range(0, len(self.dataset), self.batch_size)]
+    if self.prefetch_batches > 0:
+      # tokenize the next batches in a worker thread while the model runs
+      inputs = prefetch((self.dataset.encode(idx) for idx in batch_indices), self.prefetch_batches)
+    else:
+      self.dataset.pretokenize()
+      inputs = (self.dataset.collate([self.dataset[i] for i in idx]) for idx in batch_indices)
+      
+    if self.scheduler is None:
+      loop = tqdm(inputs, total=len(batch_indices), leave=True)
+      batches = ((batch['pair_index'].numpy(), self._forward(batch)) for batch in loop)
+    else:
+      # submit one batch at a time, so results are returned per batch
+      # batches can mix items of predictors of the same model, so run_batch does not use the predictor
+      model, device, collate = self.model, self.device, self.dataset.collate
+      batches = ((batch['pair_index'].numpy(),
+                  self.scheduler.submit(key=('RE', id(self.model)), 
+                                        items=uncollate(batch), 
+                                        run_batch=lambda items: RE_forward(model, collate(items), device), 
+                                        batch_size=self.batch_size))
+                 for batch in inputs)
+      
+    done = 0
+    for pair_index, batch_probs in batches:
+      probs[pair_index] = batch_probs
+      done += len(pair_index)
+      if self.partial is not None:
+        new_ies = self._probs_to_IEs(pair_index, probs[pair_index], all_docs=False)
+        if len(new_ies) > 0:
+          self.partial(new_ies)
+      if self.progress is not None:
+        self.progress('RE', done, len(self.dataset))
     
-    pair_df = pd.DataFrame(entity_pair_list, columns=['doc_id', 'entity_1_id', 'entity_2_id'])
-    prob_df = pd.DataFrame(prob_list, columns=self.label_map.keys())
-    pair_df['pred'] = prob_df.idxmax(axis=1)
-    pair_df['prob'] = prob_df.max(axis=1)
+    return self._probs_to_IEs(np.arange(len(self.dataset)), probs)
+  
+  
+  def _probs_to_IEs(self, pair_index:np.ndarray, probs:np.ndarray, all_docs:bool=True) -> List[Information_Extraction_Document]:
+    """
+    This method inputs entity pair indices (in dataset segments) and their label probabilities
+    outputs a list of IEs with relations (see _pairs_to_IEs)
+    """
+    segments = self.dataset.segments
+    pair_df = pd.DataFrame([(segments[idx]['doc_id'], segments[idx]['entity_1_id'], segments[idx]['entity_2_id']) 
+                            for idx in pair_index.tolist()], 
+                           columns=['doc_id', 'entity_1_id', 'entity_2_id'])
+    # first max on ties
+    pair_df['pred'] = np.array(list(self.label_map.keys()), dtype=object)[probs.argmax(axis=1)]
+    pair_df['prob'] = probs.max(axis=1)
     # Remove No_relation entity pairs
     pair_df = pair_df.loc[pair_df['pred'] != 'No_relation'].reset_index(drop=True)
     # pair_df has columns {'doc_id', 'entity_1_id', 'entity_2_id', 'pred', 'prob'}
-    return self._pairs_to_IEs(pair_df)
+    return self._pairs_to_IEs(pair_df, all_docs)
   
   
-  def _pairs_to_IEs(self, pairs:pd.DataFrame) -> List[Information_Extraction_Document]:
+  def _forward(self, batch:Dict) -> List[np.ndarray]:
+    """
+    This method inputs a collated batch of dataset items and runs the model (see RE_forward)
+    outputs the probabilities of each label per item
+    """
+    return RE_forward(self.model, batch, self.device)
+  
+  
+  def _pairs_to_IEs(self, pairs:pd.DataFrame, all_docs:bool=True) -> List[Information_Extraction_Document]:
+    """
+    This method inputs predicted relations {'doc_id', 'entity_1_id', 'entity_2_id', 'pred', 'prob'}
+    outputs a list of IEs with relations, for all documents of the dataset, or only 
+    the documents with relations if all_docs is False
+    """
+    doc_ids = None if all_docs else set(pairs['doc_id'])
     ies = {ie['doc_id']: Information_Extraction_Document(doc_id=ie['doc_id'], 
                                                          text=ie['text'], 
                                                          entity_list=ie['entity']) 
-           for ie in self.dataset.IEs}
+           for ie in self.dataset.IEs if doc_ids is None or ie['doc_id'] in doc_ids}
     
     for r in pairs.itertuples():
       relation_id = f'{r.doc_id}_{r.entity_1_id}_{r.entity_2_id}'
-      entity_1_text = ies[r.doc_id].get_entity_by_id(r.entity_1_id)['entity_text']
-      entity_2_text = ies[r.doc_id].get_entity_by_id(r.entity_2_id)['entity_text']
+      entity_1_text = self.entity_texts[(r.doc_id, r.entity_1_id)]
+      entity_2_text = self.entity_texts[(r.doc_id, r.entity_2_id)]
       
       ies[r.doc_id].relation.append({'relation_id':relation_id, 
                                      'relation_type':r.pred, 
@@ -0,0 +1,331 @@
+# -*- coding: utf-8 -*-
+"""
+Sentence segmenter engines: spaCy sentencizer and a pure-Python regex segmenter.
+
+The regex segmenter matches the spaCy engine on the bundled examples 
+(python -m benchmarks.segmenter_benchmark checks it), but is not identical on all 
+texts. Known differences, all from tokenization rules that are not implemented:
+  - Letters outside the Latin alphabets (e.g. Greek, Cyrillic, Arabic, CJK) are not letters 
+    for the suffix and infix rules, so "д. Next" or "mg.Ω" is not split after the period. 
+    spaCy also counts the sentence-final marks of some scripts (e.g. "॥", "።") as letters, 
+    so "Dr.። Next" or ",॥.Z" is one sentence. Sentence-final marks are the same as spaCy 
+    (Sentencizer.default_punct_chars), so marks separated by spaces or after words of 
+    their script (e.g. "गया। वह", "ሰላም። ዓለም") match.
+  - Symbols and emoji (e.g. "°", "😀") inside a chunk are only split at its start or end, 
+    e.g. "end😀. Next" or "b°.” ?" is one sentence.
+  - Emoticons (e.g. ":)") are only kept as one token when they are a whole chunk.
+  - spaCy's URL matcher keeps chunks with a URL or email address whole, the regex 
+    segmenter splits them by the regular rules, so "Dr.X]?a@b.com" is two sentences.
+These need unusual characters next to sentence-final punctuation, and did not 
+change any sentence of the example notes.
+"""
+import abc
+import re
+import threading
+import unicodedata
+from typing import List, Tuple
+
+
+class Sentence_Segmenter:
+  def __init__(self):
+    """
+    This parent class segments texts into sentences.
+    outputs sentence spans (start, end) as character positions in the text.
+    Use get_sentence_segmenter() to get the process-wide instance of an engine.
+    """
+    pass
+
+  @abc.abstractmethod
+  def segment(self, text:str) -> List[Tuple[int, int]]:
+    """
+    This method inputs a text and outputs a list of sentence spans (start, end)
+    """
+    return NotImplemented
+
+  def segment_batch(self, texts:List[str], n_process:int=1, batch_size:int=64) -> List[List[Tuple[int, int]]]:
+    """
+    This method inputs a list of texts and outputs a list of sentence spans (start, end)
+    for each text.
+
+    Parameters
+    ----------
+    texts : List[str]
+      list of document texts.
+    n_process : int, optional
+      Number of processes. Use > 1 for corpus-scale jobs. The default is 1.
+    batch_size : int, optional
+      Number of texts per batch. The default is 64.
+    """
+    return [self.segment(text) for text in texts]
+
+
+class Spacy_Sentence_Segmenter(Sentence_Segmenter):
+  def __init__(self, spacy_model:str='en_core_web_sm'):
+    """
+    This class segments texts into sentences with spaCy sentencizer.
+
+    Parameters
+    ----------
+    spacy_model : str, optional
+      spaCy model name. Only the tokenizer is used. The default is "en_core_web_sm".
+    """
+    # spaCy is only imported when this engine is used
+    import spacy
+    self.nlp = spacy.load(spacy_model)
+    # Remove unused pipelines to speed up
+    for pipe in self.nlp.pipeline:
+      pipe_name = pipe[0]
+      self.nlp.remove_pipe(pipe_name)
+
+    self.sentencizer = self.nlp.add_pipe("sentencizer")
+
+  def segment(self, text:str) -> List[Tuple[int, int]]:
+    return [(sent.start_char, sent.end_char) for sent in self.nlp(text).sents]
+
+  def segment_batch(self, texts:List[str], n_process:int=1, batch_size:int=64) -> List[List[Tuple[int, int]]]:
+    """
+    Texts are processed in batches with nlp.pipe.
+    """
+    return [[(sent.start_char, sent.end_char) for sent in doc.sents]
+            for doc in self.nlp.pipe(texts, n_process=n_process, batch_size=batch_size)]
+
+
+class Regex_Sentence_Segmenter(Sentence_Segmenter):
+  """
+  Character classes and tokenizer exceptions follow spaCy's English tokenizer,
+  restricted to Latin alphabets.
+  """
+  PUNCT = '…,:;!?¿؟¡()[]{}<>_#*&。？！，、；：～·।،۔؛٪'
+  QUOTES = '\'"”“`‘´’‚,„»«「」『』（）〔〕【】《》〈〉⟦⟧'
+  CURRENCY = '$£€¥฿₽﷼₴₠₡₢₣₤₥₦₧₨₩₪₫₭₮₯₰₱₲₳₵₶₷₸₹₺₻₼₾₿'
+  ALPHA_LOWER = 'a-zß-öø-ÿ'
+  ALPHA_UPPER = 'A-ZÀ-ÖØ-Þ'
+  # sentence-final characters of spaCy (Sentencizer.default_punct_chars)
+  SENT_END_CHARS = {'!', '.', '?', '։', '؟', '۔', '܀', '܁', '܂', '߹', '।', '॥', '၊', '။', '።', '፧',
+                    '፨', '᙮', '᜵', '᜶', '᠃', '᠉', '᥄', '᥅', '᪨', '᪩', '᪪', '᪫', '᭚', '᭛', '᭞', '᭟',
+                    '᰻', '᰼', '᱾', '᱿', '‼', '‽', '⁇', '⁈', '⁉', '⸮', '⸼', '꓿', '꘎', '꘏', '꛳', '꛷',
+                    '꡶', '꡷', '꣎', '꣏', '꤯', '꧈', '꧉', '꩝', '꩞', '꩟', '꫰', '꫱', '꯫', '﹒', '﹖', '﹗',
+                    '！', '．', '？', '𐩖', '𐩗', '𑁇', '𑁈', '𑂾', '𑂿', '𑃀', '𑃁', '𑅁', '𑅂', '𑅃', '𑇅', '𑇆',
+                    '𑇍', '𑇞', '𑇟', '𑈸', '𑈹', '𑈻', '𑈼', '𑊩', '𑑋', '𑑌', '𑗂', '𑗃', '𑗉', '𑗊', '𑗋', '𑗌',
+                    '𑗍', '𑗎', '𑗏', '𑗐', '𑗑', '𑗒', '𑗓', '𑗔', '𑗕', '𑗖', '𑗗', '𑙁', '𑙂', '𑜼', '𑜽', '𑜾',
+                    '𑩂', '𑩃', '𑪛', '𑪜', '𑱁', '𑱂', '𖩮', '𖩯', '𖫵', '𖬷', '𖬸', '𖭄', '𛲟', '𝪈', '｡', '。'}
+  EXCEPTIONS = set('''(._.) ._. 0.0 0.o 10a.m. 10p.m. 11a.m. 11p.m. 12a.m. 12p.m. 1a.m. 1p.m. 2a.m.
+    2p.m. 3a.m. 3p.m. 4a.m. 4p.m. 5a.m. 5p.m. 6a.m. 6p.m. 7a.m. 7p.m. 8a.m. 8p.m. 9a.m. 9p.m. <.< >.< >.>
+    Adm. Ak. Ala. Apr. Ariz. Ark. Aug. Bros. Calif. Co. Colo. Conn. Corp. D.C. Dec. Del. Dr. E.G. E.g.
+    Feb. Fla. Ga. Gen. Gov. I.E. I.e. Ia. Id. Ill. Inc. Ind. Jan. Jr. Jul. Jun. Kan. Kans. Ky. La. Ltd.
+    Mar. Mass. Md. Messrs. Mich. Minn. Miss. Mo. Mont. Mr. Mrs. Ms. Mt. N.C. N.D. N.H. N.J. N.M. N.Y.
+    Neb. Nebr. Nev. Nov. O.O O.o Oct. Okla. Ore. Pa. Ph.D. Prof. Rep. Rev. S.C. Sen. Sep. Sept. St. Tenn.
+    V.V Va. Wash. Wis. a. a.m. b. c. co. d. e. e.g. f. g. h. i. i.e. j. k. l. m. n. o. o.0 o.O o.o p.
+    p.m. q. r. s. t. u. v. v.s. v.v vs. w. x. y. z. °C. °F. °K. °c. °f. °k. ä. ö. ü.
+    'Cause 'Cos 'Coz 'Cuz 'S 'bout 'cause 'cos 'coz 'cuz 'd 'em 'll 'nuff 're 's (-8 (o: (ಠ_ಠ) :-0 :-3
+    :-D :-O :-P :-X :-o :-p :-x :0 :1 :3 :D :O :P :X :o :o) :p :x ;-D ;D ‘S ‘s ’Cause ’Cos ’Coz ’Cuz ’S
+    ’bout ’cause ’cos ’coz ’cuz ’d ’em ’ll ’nuff ’re ’s'''.split())
+
+  def __init__(self):
+    """
+    This class segments texts into sentences with pure-Python rules that follow
+    spaCy sentencizer on the spaCy English tokenizer: a sentence starts at the first
+    token that is not punctuation after a sentence-final punctuation token
+    (e.g., ".", "!", "?"). Only the tokenization rules that decide sentence-final
+    punctuation tokens are implemented, so spaCy is not imported. Sentences match 
+    spaCy on the bundled examples, see the module docstring for known differences.
+    """
+    punct, quotes = re.escape(self.PUNCT), re.escape(self.QUOTES)
+    al, au = self.ALPHA_LOWER, self.ALPHA_UPPER
+    self.chunk_re = re.compile(r'\S+|\s+')
+    self.prefix_re = re.compile(r'^(?:\.\.+|US\$|C\$|A\$|\+(?![0-9])|[§%=—–' + \
+                                punct + quotes + re.escape(self.CURRENCY) + '])')
+    self.suffix_re = re.compile('(?:' + '|'.join([r'\.\.+', '……', '…', "'s", "'S", '’s', '’S', '—', '–',
+                                                  '[' + punct + quotes + ']',
+                                                  r'(?<=[0-9])\+',
+                                                  r'(?<=°[FfCcKk])\.',
+                                                  r'(?<=[0-9' + al + r'%²\-+|(?:)' + punct + quotes + r'])\.',
+                                                  r'(?<=[' + au + '][' + au + r'])\.']) + ')$')
+    self.infix_re = re.compile('|'.join([r'\.\.+', '…',
+                                         r'(?<=[0-9])[+\-*^](?=[0-9-])',
+                                         r'(?<=[' + al + quotes + r'])\.(?=[' + au + quotes + '])',
+                                         r'(?<=[' + al + au + r']),(?=[' + al + au + '])',
+                                         r'(?<=[' + al + au + r'0-9])(?:---|--|——|-|–|—|~)(?=[' + al + au + '])',
+                                         r'(?<=[' + al + au + r'0-9])[:<>=/](?=[' + al + au + '])']))
+    # exceptions that are more than one token, as token lengths
+    self.split_exceptions = {f'°{c}.':[1, 1, 1] for c in 'CFKcfk'}
+    self.split_exceptions.update({f'{h}{m}.m.':[len(str(h)), 4] for h in range(1, 13) for m in 'ap'})
+
+  def _is_icon(self, char:str) -> bool:
+    return unicodedata.category(char) == 'So'
+
+  def _find_prefix(self, string:str) -> int:
+    match = self.prefix_re.search(string)
+    if match:
+      return match.end()
+    return 1 if string and self._is_icon(string[0]) else 0
+
+  def _find_suffix(self, string:str) -> int:
+    match = self.suffix_re.search(string)
+    if match:
+      return match.end() - match.start()
+    return 1 if string and self._is_icon(string[-1]) else 0
+
+  def _split_chunk(self, chunk:str) -> List[Tuple[int, int]]:
+    """
+    This method splits a non-whitespace chunk into token spans (start, end)
+    relative to the chunk, by stripping prefixes, suffixes and splitting infixes.
+    """
+    prefixes, suffixes = [], []
+    start, end = 0, len(chunk)
+    last_size = -1
+    while last_size != end - start:
+      string = chunk[start:end]
+      if string in self.EXCEPTIONS:
+        break
+      last_size = end - start
+      pre_len = self._find_prefix(string)
+      if pre_len and string[pre_len:] in self.EXCEPTIONS:
+        prefixes.append((start, start + pre_len))
+        start += pre_len
+        break
+      suf_len = self._find_suffix(string[pre_len:])
+      if suf_len and string[:-suf_len] in self.EXCEPTIONS:
+        suffixes.append((end - suf_len, end))
+        end -= suf_len
+        break
+      if pre_len and suf_len and pre_len + suf_len <= len(string):
+        prefixes.append((start, start + pre_len))
+        suffixes.append((end - suf_len, end))
+        start, end = start + pre_len, end - suf_len
+      elif pre_len:
+        prefixes.append((start, start + pre_len))
+        start += pre_len
+      elif suf_len:
+        suffixes.append((end - suf_len, end))
+        end -= suf_len
+
+    tokens = prefixes
+    string = chunk[start:end]
+    if string:
+      if string in self.EXCEPTIONS:
+        tokens.extend(self._exception_tokens(string, start))
+      else:
+        pos = 0
+        for match in self.infix_re.finditer(string):
+          if match.start() == 0:
+            continue
+          if match.start() != pos:
+            tokens.append((start + pos, start + match.start()))
+          if match.start() != match.end():
+            tokens.append((start + match.start(), start + match.end()))
+          pos = match.end()
+        if pos < len(string):
+          tokens.append((start + pos, end))
+
+    tokens.extend(reversed(suffixes))
+    if len(tokens) > 1 and '.' in chunk:
+      tokens = self._merge_exceptions(chunk, tokens)
+    return tokens
+
+  def _exception_tokens(self, string:str, start:int) -> List[Tuple[int, int]]:
+    """
+    This method outputs token spans (start, end) of a tokenizer exception
+    """
+    tokens = []
+    for length in self.split_exceptions.get(string, [len(string)]):
+      tokens.append((start, start + length))
+      start += length
+    return tokens
+
+  def _merge_exceptions(self, chunk:str, tokens:List[Tuple[int, int]], max_tokens:int=6) -> List[Tuple[int, int]]:
+    """
+    This method re-tokenizes token sequences that form a tokenizer exception after
+    affix splitting (e.g., "c/e." -> "c", "/", "e."). Longer sequences are preferred,
+    then the leftmost.
+    """
+    matches = []
+    for i in range(len(tokens)):
+      for j in range(i + 2, min(i + max_tokens, len(tokens)) + 1):
+        if chunk[tokens[i][0]:tokens[j - 1][1]] in self.EXCEPTIONS:
+          matches.append((i, j))
+    if len(matches) == 0:
+      return tokens
+
+    seen = set()
+    spans = {}
+    for i, j in sorted(matches, key=lambda m:(m[0] - m[1], m[0])):
+      if i not in seen and j - 1 not in seen:
+        spans[i] = j
+      seen.update(range(i, j))
+
+    merged = []
+    i = 0
+    while i < len(tokens):
+      if i in spans:
+        j = spans[i]
+        merged.extend(self._exception_tokens(chunk[tokens[i][0]:tokens[j - 1][1]], tokens[i][0]))
+        i = j
+      else:
+        merged.append(tokens[i])
+        i += 1
+    return merged
+
+  def _tokenize(self, text:str) -> List[Tuple[int, int]]:
+    """
+    This method outputs token spans (start, end). Like spaCy, a single space
+    after a token is attached to it, other whitespaces are tokens.
+    """
+    tokens = []
+    for match in self.chunk_re.finditer(text):
+      start, end = match.span()
+      if text[start].isspace():
+        # the first space after a token is its trailing whitespace
+        if start > 0 and text[start] == ' ':
+          start += 1
+        if start < end:
+          tokens.append((start, end))
+      elif text[start:end].isalnum():
+        # plain words have no affixes
+        tokens.append((start, end))
+      else:
+        tokens.extend([(start + s, start + e) for s, e in self._split_chunk(text[start:end])])
+    return tokens
+
+  def _is_punct(self, token:str) -> bool:
+    return all(unicodedata.category(c).startswith('P') for c in token)
+
+  def segment(self, text:str) -> List[Tuple[int, int]]:
+    tokens = self._tokenize(text)
+    if len(tokens) == 0:
+      return []
+
+    sent_starts = [0]
+    seen_period = False
+    for i, (start, end) in enumerate(tokens):
+      if end - start == 1 and text[start] in self.SENT_END_CHARS:
+        seen_period = True
+      elif seen_period and not self._is_punct(text[start:end]):
+        sent_starts.append(i)
+        seen_period = False
+
+    sent_ends = sent_starts[1:] + [len(tokens)]
+    return [(tokens[s][0], tokens[e - 1][1]) for s, e in zip(sent_starts, sent_ends)]
+
+
+_segmenters = {}
+_segmenters_lock = threading.Lock()
+
+def get_sentence_segmenter(engine:str='spacy') -> Sentence_Segmenter:
+  """
+  This function outputs the process-wide Sentence_Segmenter for an engine.
+  It is loaded on first call and reused afterwards.
+
+  Parameters
+  ----------
+  engine : str, optional
+    Must be one of {"spacy", "regex"}. The default is "spacy".
+  """
+  assert engine in {'spacy', 'regex'}, 'Segmenter engine must be one of {"spacy", "regex"}.'
+  with _segmenters_lock:
+    if engine not in _segmenters:
+      if engine == 'spacy':
+        _segmenters[engine] = Spacy_Sentence_Segmenter()
+      else:
+        _segmenters[engine] = Regex_Sentence_Segmenter()
+    return _segmenters[engine]
@@ -1,12 +1,15 @@
 # -*- coding: utf-8 -*-
 import abc
 import warnings
-from typing import List, Dict, Tuple, Union
-from itertools import combinations
+from typing import List, Dict, Tuple, Union, Iterable, Iterator, Any
+from itertools import combinations, chain
 import random
 import os
+import queue
+import threading
 from tqdm import tqdm
 import yaml
+import numpy as np
 import pandas as pd
 import json
 import torch
@@ -15,6 +18,71 @@ from torch.utils.tensorboard import SummaryWriter
 from transformers import AutoModelForTokenClassification, AutoModelForSequenceClassification
 
 
+def to_tensor(rows:List, shape:Tuple[int, ...]) -> torch.Tensor:
+  """
+  This function converts nested lists of ints (e.g. tokenizer outputs padded to the 
+  same length) to an int64 tensor of shape. It is faster than torch.tensor or np.array 
+  for large nested lists.
+  """
+  flat = rows
+  for _ in range(len(shape) - 1):
+    flat = chain.from_iterable(flat)
+  count = int(np.prod(shape))
+  return torch.from_numpy(np.fromiter(flat, dtype=np.int64, count=count).reshape(shape))
+
+
+def uncollate(batch:Dict[str, torch.Tensor]) -> List[Dict[str, torch.Tensor]]:
+  """
+  This function splits a collated batch of tensors into a list of items (views)
+  """
+  batch_size = len(next(iter(batch.values())))
+  return [{key:value[b] for key, value in batch.items()} for b in range(batch_size)]
+
+
+def prefetch(iterable:Iterable, depth:int) -> Iterator:
+  """
+  This function iterates an iterable in a worker thread and yields its items, keeping 
+  up to depth items ready in a bounded queue, so producing the next items (e.g. 
+  tokenizing batches) overlaps with consuming them (e.g. the model forward). 
+  An exception in the worker is raised when its position is reached. If the consumer 
+  stops early, the worker stops before its next item.
+  """
+  items = queue.Queue(maxsize=max(depth, 1))
+  stop = threading.Event()
+  end = object()
+  
+  def put(item:Any) -> bool:
+    while not stop.is_set():
+      try:
+        items.put(item, timeout=0.1)
+        return True
+      except queue.Full:
+        pass
+    return False
+  
+  def produce():
+    try:
+      for item in iterable:
+        if not put((item, None)):
+          return
+      put((end, None))
+    except Exception as e:
+      put((end, e))
+      
+  worker = threading.Thread(target=produce, daemon=True, name='prefetch')
+  worker.start()
+  try:
+    while True:
+      item, error = items.get()
+      if error is not None:
+        raise error
+      if item is end:
+        return
+      yield item
+  finally:
+    stop.set()
+
+
 class Information_Extraction_Document:
   def __init__(self, 
                doc_id:str,
@@ -494,10 +562,12 @@ class Trainer():
     self.early_stop_epochs = early_stop_epochs
     self.train_dataset = train_dataset
     self.train_loader = DataLoader(train_dataset, batch_size=self.batch_size, 
-                                   shuffle=self.shuffle, drop_last=drop_last)
+                                   shuffle=self.shuffle, drop_last=drop_last, 
+                                   collate_fn=getattr(train_dataset, 'collate', None))
     if valid_dataset != None:
       self.valid_loader = DataLoader(valid_dataset, batch_size=self.batch_size, 
-                                     shuffle=False, drop_last=drop_last)
+                                     shuffle=False, drop_last=drop_last, 
+                                     collate_fn=getattr(valid_dataset, 'collate', None))
     else:
       self.valid_loader = None
     
@@ -0,0 +1,186 @@
+# -*- coding: utf-8 -*-
+import os
+import threading
+import logging
+from typing import Tuple
+from easydict import EasyDict
+import numpy as np
+import torch
+from transformers import AutoModelForTokenClassification, AutoModelForSequenceClassification
+from IE_model import IE_model
+# onnx is used by the exporter and the quantization
+try:
+  import onnx
+  import onnxruntime
+except ImportError as e:
+  raise ImportError('The onnxruntime engine needs the onnxruntime and onnx packages ' + \
+                    '(pip install onnxruntime onnx), or set engine to pytorch in app_config.yaml.') from e
+
+
+class onnx_session_model:
+  def __init__(self, onnx_path:str, intra_op_threads:int=None, inter_op_threads:int=None):
+    """
+    This class runs an exported NER/ RE model with ONNX Runtime (CPU). It has the
+    interface of the PyTorch model used by the predictors: it is called with
+    input_ids and attention_mask and outputs {logits} as a torch tensor.
+    ONNX Runtime sessions are not fork-safe, so each process (e.g. forked gunicorn
+    worker) creates its own session on first call.
+
+    Parameters
+    ----------
+    onnx_path : str
+      path to the .onnx file.
+    intra_op_threads : int, optional
+      threads used within an operator. The default is None (ONNX Runtime default).
+    inter_op_threads : int, optional
+      threads used across operators. The default is None (ONNX Runtime default).
+    """
+    self.onnx_path = onnx_path
+    self.intra_op_threads = intra_op_threads
+    self.inter_op_threads = inter_op_threads
+    self.lock = threading.Lock()
+    # sessions by process ID. Sessions inherited from the parent process are kept
+    # (not released), since their thread pools do not exist after fork.
+    self.sessions = {}
+
+
+  def session(self) -> onnxruntime.InferenceSession:
+    pid = os.getpid()
+    with self.lock:
+      if pid not in self.sessions:
+        options = onnxruntime.SessionOptions()
+        if self.intra_op_threads is not None:
+          options.intra_op_num_threads = self.intra_op_threads
+        if self.inter_op_threads is not None:
+          options.inter_op_num_threads = self.inter_op_threads
+        self.sessions[pid] = onnxruntime.InferenceSession(self.onnx_path, sess_options=options,
+                                                          providers=['CPUExecutionProvider'])
+      return self.sessions[pid]
+
+
+  def __call__(self, input_ids:torch.Tensor, attention_mask:torch.Tensor) -> EasyDict:
+    logits = self.session().run(['logits'], {'input_ids':input_ids.cpu().numpy().astype(np.int64),
+                                             'attention_mask':attention_mask.cpu().numpy().astype(np.int64)})[0]
+    return EasyDict({'logits':torch.from_numpy(logits)})
+
+
+  def to(self, device:str) -> 'onnx_session_model':
+    # CPU only
+    return self
+
+
+  def eval(self) -> 'onnx_session_model':
+    return self
+
+
+  def share_memory(self) -> 'onnx_session_model':
+    # sessions are created per process, there are no weights to share
+    return self
+
+
+class ONNX_IE_model(IE_model):
+  def __init__(self, intra_op_threads:int=None, inter_op_threads:int=None, **kwargs):
+    """
+    This class is the ONNX Runtime backend. NER/ RE models are exported from the
+    PyTorch weight to ONNX on first use and cached under the model folder (onnx/),
+    keyed by the weight files and torch version. Segmentation, caches,
+    micro-batching and post-processing are the same as IE_model, only the model
+    forward runs with ONNX Runtime, so results match IE_model up to floating point
+    differences. precision in the model config.yaml can be fp32 or int8-dynamic
+    (ONNX Runtime dynamic quantization).
+
+    Parameters
+    ----------
+    intra_op_threads : int, optional
+      ONNX Runtime threads used within an operator. The default is None (ONNX Runtime default).
+    inter_op_threads : int, optional
+      ONNX Runtime threads used across operators. The default is None (ONNX Runtime default).
+    **kwargs
+      IE_model parameters (model_dir, memory_budget_MB, result_cache_config,
+      sentence_cache_config, scheduler_config).
+    """
+    super().__init__(**kwargs)
+    self.intra_op_threads = intra_op_threads
+    self.inter_op_threads = inter_op_threads
+
+
+  def set_threads(self, intra_op_threads:int=None, inter_op_threads:int=None):
+    """
+    This method sets the ONNX Runtime thread counts of the loaded and later loaded 
+    models. It applies to sessions created afterwards, e.g. in forked workers.
+    """
+    self.intra_op_threads = intra_op_threads
+    self.inter_op_threads = inter_op_threads
+    for entry in self.model_cache.entries.values():
+      entry.model.intra_op_threads = intra_op_threads
+      entry.model.inter_op_threads = inter_op_threads
+
+
+  def _load_model(self, mode:str, model_name:str) -> Tuple[EasyDict, int]:
+    entry, size = super()._load_model(mode, model_name)
+    entry.device = 'cpu'
+    return entry, size
+
+
+  def _load_weight(self, mode:str, model_path:str, precision:str='fp32') -> onnx_session_model:
+    """
+    This method outputs the ONNX model of a weight, exported at first use:
+      fp32: exported from the PyTorch weight.
+      int8-dynamic: the fp32 export with dynamically quantized (int8) weights.
+    """
+    if precision not in ('fp32', 'int8-dynamic'):
+      raise ValueError(f'precision must be fp32 or int8-dynamic for the ONNX backend, not {precision}.')
+
+    cache_dir = os.path.join(model_path, 'onnx')
+    weight_hash = self._weight_hash(model_path)
+    onnx_path = os.path.join(cache_dir, f'{precision}_{weight_hash}.onnx')
+    if not os.path.exists(onnx_path):
+      os.makedirs(cache_dir, exist_ok=True)
+      for file_name in os.listdir(cache_dir):
+        if file_name.startswith(f'{precision}_'):
+          os.remove(os.path.join(cache_dir, file_name))
+      tmp_path = f'{onnx_path}.{os.getpid()}.tmp'
+      if precision == 'fp32':
+        self._export(mode, model_path, tmp_path)
+      else:
+        from onnxruntime.quantization import quantize_dynamic, QuantType
+        fp32_path = self._load_weight(mode, model_path, 'fp32').onnx_path
+        logging.info(f'Quantizing {fp32_path}...')
+        quantize_dynamic(fp32_path, tmp_path, weight_type=QuantType.QInt8)
+      os.replace(tmp_path, onnx_path)
+
+    logging.info(f'Loading ONNX model {onnx_path}...')
+    return onnx_session_model(onnx_path, self.intra_op_threads, self.inter_op_threads)
+
+
+  def _export(self, mode:str, model_path:str, onnx_path:str):
+    """
+    This method exports the PyTorch weight to ONNX with dynamic batch and sequence length
+    """
+    logging.info(f'Exporting {mode} model to ONNX...')
+    model_class = AutoModelForTokenClassification if mode == 'NER' else AutoModelForSequenceClassification
+    model = model_class.from_pretrained(os.path.join(model_path, 'weight')).eval()
+    input_ids = torch.ones((2, 16), dtype=torch.long)
+    attention_mask = torch.ones((2, 16), dtype=torch.long)
+    axes = {0:'batch', 1:'sequence'}
+    # torch >= 2.5 has a dynamo exporter. Keep the TorchScript exporter used by older versions.
+    export_kwargs = {}
+    if tuple(int(v) for v in torch.__version__.split('+')[0].split('.')[:2]) >= (2, 5):
+      export_kwargs['dynamo'] = False
+    with torch.no_grad():
+      torch.onnx.export(model, (input_ids, attention_mask), onnx_path,
+                        input_names=['input_ids', 'attention_mask'],
+                        output_names=['logits'],
+                        dynamic_axes={'input_ids':axes, 'attention_mask':axes,
+                                      'logits':axes if mode == 'NER' else {0:'batch'}},
+                        opset_version=17,
+                        **export_kwargs)
+
+
+  @staticmethod
+  def _model_size(model:onnx_session_model) -> int:
+    """
+    This method outputs the size in bytes of the ONNX model file
+    """
+    return os.path.getsize(model.onnx_path)
+
@@ -1,7 +1,9 @@
 # -*- coding: utf-8 -*-
-from typing import List
+from typing import List, Dict
 import base64
 import os 
+import gc
+import threading
 import pandas as pd
 import json
 from easydict import EasyDict
@@ -15,22 +17,58 @@ from dash.exceptions import PreventUpdate
 from dash_extensions import EventListener
 from IE_modules.Utilities import Information_Extraction_Document
 from modules.utilities import control_panel_manager, report_manager, backend_model
+from modules.api import inference_api
+from modules.jobs import job, job_manager, job_rejected
+from modules.cache import result_cache
 from IE_model import IE_model
 
 """ Load manager obj """
 cpm = control_panel_manager(model_dir='models')
 rm = report_manager()
-model = IE_model()
-NER_model_info = None
-RE_model_info = None
+backend_kwargs = {'model_dir':'models', 
+                  'memory_budget_MB':CONFIG['model_cache']['memory_budget_MB'],
+                  'result_cache_config':CONFIG['result_cache'],
+                  'sentence_cache_config':CONFIG['sentence_cache'],
+                  'scheduler_config':CONFIG['scheduler'],
+                  'length_bucketing':CONFIG['backend']['length_bucketing'],
+                  'stream_segments':CONFIG['backend']['stream_segments'],
+                  'prefetch_batches':CONFIG['backend']['prefetch_batches']}
+if CONFIG['backend']['engine'] == 'onnxruntime':
+  # onnxruntime is only imported when this backend is used
+  from ONNX_IE_model import ONNX_IE_model
+  model = ONNX_IE_model(intra_op_threads=CONFIG['backend']['intra_op_threads'],
+                        inter_op_threads=CONFIG['backend']['inter_op_threads'],
+                        **backend_kwargs)
+else:
+  model = IE_model(compile_mode=CONFIG['backend']['compile'], **backend_kwargs)
+jobs = job_manager(max_workers=CONFIG['background_jobs']['max_workers'],
+                   job_dir=CONFIG['background_jobs']['job_dir'],
+                   max_queued=CONFIG['background_jobs']['max_queued'],
+                   timeout_s=CONFIG['background_jobs']['timeout_s'])
 
 """ App layout """
 app = dash.Dash(meta_tags=[{"name": "viewport", "content": "width=device-width, initial-scale=1"}], 
                 external_stylesheets=[dbc.themes.BOOTSTRAP])
+# WSGI entry point for production servers, e.g. gunicorn -c gunicorn.conf.py app:server
+server = app.server
+
+""" JSON API """
+if CONFIG['api']['enabled']:
+  api = inference_api(model=model, 
+                      model_dir='models', 
+                      max_documents=CONFIG['api']['max_documents'], 
+                      max_chars=CONFIG['api']['max_chars'])
+  api.register(app.server, max_content_MB=CONFIG['api']['max_content_MB'])
 
 app.layout = html.Div(id='app-container', children=[
   html.Div(id='entity-store', style={"display": "none"}, **{"data-json":""}),
   html.Div(id='relation-store', style={"display": "none"}, **{"data-json":""}),
+  # previous submission of this session {text, NER_model, RE_model, entities, relations}
+  html.Div(id='submission-store', style={"display": "none"}, **{"data-json":""}),
+  # background job of this session: job ID while running, and job ID when finished
+  html.Div(id='job-store', style={"display": "none"}, **{"data-json":""}),
+  html.Div(id='job-done', style={"display": "none"}, **{"data-json":""}),
+  dcc.Interval(id='job-interval', interval=CONFIG['background_jobs']['poll_interval_ms'], disabled=True),
   dbc.Modal(children=[dbc.ModalHeader(''), dbc.ModalBody('')],
               id="information-modal",
               is_open=False,
@@ -57,7 +95,8 @@ app.layout = html.Div(id='app-container', children=[
       html.Div(id='button-container', className='row', children=[
         html.Div(cpm.clear_button, className='button-holder'),
         html.Div(cpm.submit_button, className='button-holder')
-      ])
+      ]),
+      html.Div(id='job-progress', children='')
       ]),
     
     html.Div(id='right-column', className='column', children=[
@@ -94,7 +133,6 @@ def select_NER_model_dropdown(NER_model_dropdown_value:str):
     return {"entity_dropdown_options":[], "entity_dropdown_value":""}
 
   else:
-    global NER_model_info
     NER_model_info = cpm.load_model_info(model_name=NER_model_dropdown_value, mode='NER')
     color_map = cpm.get_entity_color(NER_model_info['categories'])
     
@@ -122,7 +160,6 @@ def select_RE_model_dropdown(RE_model_dropdown_value:str):
   if RE_model_dropdown_value is None:
     return {"relation_dropdown_options":[], "relation_dropdown_value":""}
   else:
-    global RE_model_info
     RE_model_info = cpm.load_model_info(model_name=RE_model_dropdown_value, mode='RE')
     
     return {"relation_dropdown_options":[{'label':c, 'value':c} for c in RE_model_info['categories']],
@@ -132,10 +169,9 @@ def select_RE_model_dropdown(RE_model_dropdown_value:str):
   output=dict(
     information_modal_open = Output("information-modal", "is_open"),
     information_modal_children = Output("information-modal", "children"),
-    entity_store_data = Output("entity-store", "data-json"),
-    relation_store_data = Output("relation-store", "data-json"),
-    entity_table_data = Output("entity-table", "data"),
-    relation_table_data = Output("relation-table", "data")
+    job_store_data = Output("job-store", "data-json"),
+    job_interval_disabled = Output("job-interval", "disabled"),
+    job_progress_children = Output("job-progress", "children")
   ),
   inputs=dict(
     submit_button = Input("submit-button", "n_clicks"),
@@ -143,13 +179,22 @@ def select_RE_model_dropdown(RE_model_dropdown_value:str):
     NER_model_dropdown_value = Input("NER-model-dropdown", "value"),
     RE_model_dropdown_value = Input("RE-model-dropdown", "value")
   ),
+  state=dict(
+    submission_store_data = State("submission-store", "data-json"),
+    job_store_data = State("job-store", "data-json")
+  ),
   prevent_initial_call=True
 )
 def click_submit_button(submit_button:int, text_input:str,
-                          NER_model_dropdown_value:str, RE_model_dropdown_value:str):
+                          NER_model_dropdown_value:str, RE_model_dropdown_value:str,
+                          submission_store_data:str, job_store_data:str):
   """
-  When submit button is clicked, backend model calculate and update data in 
-  entity-store and relation-store
+  When submit button is clicked, a background job is started to run the backend 
+  model (see run_extraction). The job ID is kept in job-store and job-interval 
+  polls the job. A running job of this session is cancelled, unless it runs the same 
+  text and models, then it is kept. Identical submissions in progress (same text 
+  and models) share one job. Texts over max_chars and 
+  submissions when the job queue is full are rejected with a message.
   """
   ctx = dash.callback_context
   trigger_id = ctx.triggered[0]["prop_id"].split(".")[0]
@@ -163,47 +208,225 @@ def click_submit_button(submit_button:int, text_input:str,
     return {"information_modal_open":True, 
             "information_modal_children":[dbc.ModalHeader(head), 
                                           dbc.ModalBody(msg)],
-            "entity_store_data":dash.no_update, 
-            "relation_store_data":dash.no_update, 
-            "entity_table_data":dash.no_update,
-            "relation_table_data":dash.no_update}
+            "job_store_data":dash.no_update,
+            "job_interval_disabled":dash.no_update,
+            "job_progress_children":dash.no_update}
               
-  # NER
   if NER_model_dropdown_value is None:
     head = "Select named entity recognition (NER) model:"
     msg = "Please select a NER model from the dropdown menu."
     return {"information_modal_open":True, 
             "information_modal_children":[dbc.ModalHeader(head), 
                                           dbc.ModalBody(msg)],
-            "entity_store_data":dash.no_update, 
-            "relation_store_data":dash.no_update, 
-            "entity_table_data":dash.no_update,
-            "relation_table_data":dash.no_update}
+            "job_store_data":dash.no_update,
+            "job_interval_disabled":dash.no_update,
+            "job_progress_children":dash.no_update}
 
-  else:
-    global NER_model_info
-    color_map = cpm.get_entity_color(NER_model_info['categories'])
-    entities = model.get_entities(NER_model_info, text_input)
+  if len(text_input) > CONFIG['background_jobs']['max_chars']:
+    head = "Input text for processing:"
+    msg = f"The text has {len(text_input)} characters, the limit is {CONFIG['background_jobs']['max_chars']}. " + \
+           "Please split it into smaller parts."
+    return {"information_modal_open":True, 
+            "information_modal_children":[dbc.ModalHeader(head), 
+                                          dbc.ModalBody(msg)],
+            "job_store_data":dash.no_update,
+            "job_interval_disabled":dash.no_update,
+            "job_progress_children":dash.no_update}
+
+  key = result_cache.hash([text_input, NER_model_dropdown_value, RE_model_dropdown_value])
+  if job_store_data and not cancel_job(job_store_data, key):
+    return {"information_modal_open":dash.no_update,
+            "information_modal_children":dash.no_update,
+            "job_store_data":job_store_data,
+            "job_interval_disabled":False,
+            "job_progress_children":dash.no_update}
+  
+  prev = json.loads(submission_store_data) if CONFIG['incremental'] and submission_store_data else None
+  try:
+    job_id = jobs.submit(run_extraction, text_input, NER_model_dropdown_value, RE_model_dropdown_value, prev,
+                         key=key)
+  except job_rejected:
+    head = "Server busy"
+    msg = "The server is processing too many requests. Please try again in a minute."
+    return {"information_modal_open":True, 
+            "information_modal_children":[dbc.ModalHeader(head), 
+                                          dbc.ModalBody(msg)],
+            "job_store_data":"",
+            "job_interval_disabled":True,
+            "job_progress_children":""}
+  return {"information_modal_open":dash.no_update,
+          "information_modal_children":dash.no_update,
+          "job_store_data":job_id,
+          "job_interval_disabled":False,
+          "job_progress_children":"Submitted..."}
+
+
+def cancel_job(job_id:str, key:str=None) -> bool:
+  """
+  This function cancels a job of this session, unless it is queued or running with 
+  the same key (same text and models), so submitting the same input keeps it.
+  outputs True if the job is cancelled
+  """
+  state = jobs.get(job_id)
+  if key is not None and state is not None and state['status'] in ('queued', 'running') and \
+    state.get('key') == key and not jobs.is_cancelled(job_id):
+    return False
+  jobs.cancel(job_id)
+  return True
+
+
+def run_extraction(job:job, text_input:str, NER_model_dropdown_value:str, 
+                   RE_model_dropdown_value:str, prev:Dict) -> Dict:
+  """
+  This function runs NER (and RE if a RE model is selected) in a background job.
+  If incremental is enabled and the same models were used in the previous 
+  submission (prev), only the edited parts of the text are processed.
+  outputs {entities, relations, submission}. relations is None if no RE model is selected.
+  """
+  # model selection is read from this session's dropdowns, not shared between sessions
+  NER_model_info = cpm.load_model_info(model_name=NER_model_dropdown_value, mode='NER')
+  color_map = cpm.get_entity_color(NER_model_info['categories'])
+  def add_color(entities:List[Dict]) -> List[Dict]:
     for entity in entities:
       entity['color'] = color_map[entity['entity_type']]
+    return entities
   
-  # RE
-  if RE_model_dropdown_value is None:
-    return {"information_modal_open":dash.no_update,
-            "information_modal_children":dash.no_update,
-            "entity_store_data":json.dumps(entities), 
-            "relation_store_data":dash.no_update, 
-            "entity_table_data":entities,
-            "relation_table_data":dash.no_update}
+  stream = CONFIG['background_jobs']['streaming']
+  stream_entities = (lambda entities: job.append_partial(entities=add_color(entities))) if stream else None
+  stream_relations = (lambda relations: job.append_partial(relations=relations)) if stream else None
+  if prev is not None and prev['NER_model'] == NER_model_dropdown_value:
+    entities = model.get_entities_incremental(NER_model_info, text_input, prev['text'], prev['entities'], 
+                                              progress=job.update, partial=stream_entities)
   else:
-    global RE_model_info
-    relations = model.get_relations(RE_model_info, text_input, entities)
-    return {"information_modal_open":dash.no_update,
-            "information_modal_children":dash.no_update,
-            "entity_store_data":json.dumps(entities), 
-            "relation_store_data":json.dumps(relations),
-            "entity_table_data":entities,
-            "relation_table_data":relations}
+    entities = model.get_entities(NER_model_info, text_input, progress=job.update, partial=stream_entities)
+  add_color(entities)
+  
+  relations = None
+  if RE_model_dropdown_value is not None:
+    # relations are displayed on the entities, so all entities are shown before relations stream
+    if stream:
+      job.put_partial(entities=entities)
+    RE_model_info = cpm.load_model_info(model_name=RE_model_dropdown_value, mode='RE')
+    if prev is not None and prev['NER_model'] == NER_model_dropdown_value and \
+      prev['RE_model'] == RE_model_dropdown_value:
+      relations = model.get_relations_incremental(RE_model_info, text_input, entities, 
+                                                  prev['text'], prev['entities'], prev['relations'],
+                                                  progress=job.update, partial=stream_relations)
+    else:
+      relations = model.get_relations(RE_model_info, text_input, entities, progress=job.update, 
+                                      partial=stream_relations)
+      
+  submission = {'text':text_input, 'NER_model':NER_model_dropdown_value, 'RE_model':RE_model_dropdown_value,
+                'entities':entities, 'relations':relations}
+  return {'entities':entities, 'relations':relations, 'submission':submission}
+
+
+@app.callback(
+  output=dict(
+    job_progress_children = Output("job-progress", "children", allow_duplicate=True),
+    job_interval_disabled = Output("job-interval", "disabled", allow_duplicate=True),
+    job_done_data = Output("job-done", "data-json"),
+    job_store_data = Output("job-store", "data-json", allow_duplicate=True),
+    entity_store_data = Output("entity-store", "data-json", allow_duplicate=True),
+    relation_store_data = Output("relation-store", "data-json", allow_duplicate=True)
+  ),
+  inputs=dict(
+    job_interval = Input("job-interval", "n_intervals")
+  ),
+  state=dict(
+    job_store_data = State("job-store", "data-json"),
+    job_progress_children = State("job-progress", "children")
+  ),
+  prevent_initial_call=True
+)
+def poll_job(job_interval:int, job_store_data:str, job_progress_children:str):
+  """
+  When job-interval fires, the job progress is displayed. If streaming is enabled,
+  partial entities and relations update entity-store and relation-store when the 
+  progress changes, so the display textbox shows results as batches finish. 
+  When the job is finished, polling stops and the job ID is passed to job-done 
+  to collect the result.
+  """
+  state = jobs.get(job_store_data) if job_store_data else None
+  if state is None or state['status'] == 'cancelled':
+    return {"job_progress_children":"", "job_interval_disabled":True, "job_done_data":dash.no_update,
+            "job_store_data":"", "entity_store_data":dash.no_update, "relation_store_data":dash.no_update}
+  
+  # the finished job leaves job-store, so it is not cancelled by the next submission or Clear
+  if state['status'] in ('done', 'error'):
+    return {"job_progress_children":"", "job_interval_disabled":True, "job_done_data":job_store_data,
+            "job_store_data":"", "entity_store_data":dash.no_update, "relation_store_data":dash.no_update}
+  
+  progress = format_progress(state)
+  # partial results are updated with the progress, so only send them when the progress changed
+  partial = state.get('partial') or {}
+  changed = progress != job_progress_children
+  return {"job_progress_children":progress,
+          "job_interval_disabled":dash.no_update, 
+          "job_done_data":dash.no_update,
+          "job_store_data":dash.no_update,
+          "entity_store_data":json.dumps(partial['entities']) if changed and 'entities' in partial else dash.no_update,
+          "relation_store_data":json.dumps(partial['relations']) if changed and 'relations' in partial else dash.no_update}
+
+
+def format_progress(state:Dict) -> str:
+  """
+  This function outputs the job progress for display
+  """
+  progress = state['progress']
+  if state['status'] == 'queued':
+    return "Waiting for other jobs to finish..."
+  if progress is None or progress['stage'] == 'Segmenting':
+    return "Segmenting text..."
+  if progress['stage'] == 'NER':
+    return f"Named entity recognition: {progress['done']}/{progress['total']} sentences"
+  return f"Relation extraction: {progress['done']}/{progress['total']} entity pairs"
+
+
+@app.callback(
+  output=dict(
+    information_modal_open = Output("information-modal", "is_open", allow_duplicate=True),
+    information_modal_children = Output("information-modal", "children", allow_duplicate=True),
+    entity_store_data = Output("entity-store", "data-json"),
+    relation_store_data = Output("relation-store", "data-json"),
+    entity_table_data = Output("entity-table", "data"),
+    relation_table_data = Output("relation-table", "data"),
+    submission_store_data = Output("submission-store", "data-json")
+  ),
+  inputs=dict(
+    job_done_data = Input("job-done", "data-json")
+  ),
+  prevent_initial_call=True
+)
+def collect_job(job_done_data:str):
+  """
+  When a job is finished, its result updates entity-store, relation-store, 
+  tables and submission-store. Errors are shown in the information modal.
+  """
+  state = jobs.get(job_done_data) if job_done_data else None
+  if state is None:
+    raise PreventUpdate
+  jobs.pop(job_done_data)
+  
+  if state['status'] == 'error':
+    return {"information_modal_open":True, 
+            "information_modal_children":[dbc.ModalHeader("Processing failed:"), 
+                                          dbc.ModalBody(state['error'])],
+            "entity_store_data":dash.no_update, 
+            "relation_store_data":dash.no_update, 
+            "entity_table_data":dash.no_update,
+            "relation_table_data":dash.no_update,
+            "submission_store_data":dash.no_update}
+    
+  result = state['result']
+  no_relations = result['relations'] is None
+  return {"information_modal_open":dash.no_update,
+          "information_modal_children":dash.no_update,
+          "entity_store_data":json.dumps(result['entities']), 
+          "relation_store_data":dash.no_update if no_relations else json.dumps(result['relations']),
+          "entity_table_data":result['entities'],
+          "relation_table_data":dash.no_update if no_relations else result['relations'],
+          "submission_store_data":json.dumps(result['submission'])}
 
 
 @app.callback(
@@ -218,17 +441,26 @@ def click_submit_button(submit_button:int, text_input:str,
     entity_table_data = Output("entity-table", "data", allow_duplicate=True),
     relation_table_data = Output("relation-table", "data", allow_duplicate=True),
     entity_store_data = Output("entity-store", "data-json", allow_duplicate=True),
-    relation_store_data = Output("relation-store", "data-json", allow_duplicate=True)
+    relation_store_data = Output("relation-store", "data-json", allow_duplicate=True),
+    submission_store_data = Output("submission-store", "data-json", allow_duplicate=True),
+    job_store_data = Output("job-store", "data-json", allow_duplicate=True),
+    job_interval_disabled = Output("job-interval", "disabled", allow_duplicate=True),
+    job_progress_children = Output("job-progress", "children", allow_duplicate=True)
   ),
   inputs=dict(
     submit_button = Input("clear-button", "n_clicks"),
   ),
+  state=dict(
+    job_store_data = State("job-store", "data-json")
+  ),
   prevent_initial_call=True
 )
-def click_clear_button(submit_button:int):
+def click_clear_button(submit_button:int, job_store_data:str):
   """
-  When clear button clicked, input text, NER and RE model dropdown, and backend 
-  model are reset to default. Stored data for entity and relation are cleared.
+  When clear button clicked, input text, NER and RE model dropdown are reset 
+  to default. Stored data for entity and relation are cleared.
+  A running job of this session is cancelled. The backend is shared by all 
+  sessions, so loaded models stay in the backend model cache.
   """
   ctx = dash.callback_context
   trigger_id = ctx.triggered[0]["prop_id"].split(".")[0]
@@ -236,7 +468,8 @@ def click_clear_button(submit_button:int):
   if  trigger_id != "clear-button":
     raise PreventUpdate
   
-  model.reset()
+  if job_store_data:
+    cancel_job(job_store_data)
   return {"text_input_value":"",
           "NER_model_dropdown_value":None,
           "entity_dropdown_options":[],
@@ -247,7 +480,11 @@ def click_clear_button(submit_button:int):
           "entity_table_data":None,
           "relation_table_data":None,
           "entity_store_data":"",
-          "relation_store_data":""
+          "relation_store_data":"",
+          "submission_store_data":"",
+          "job_store_data":"",
+          "job_interval_disabled":True,
+          "job_progress_children":""
           }
 
 
@@ -273,7 +510,47 @@ def upload(text_upload_panel_filename, text_upload_panel_contents):
     return {"text_input_value":byte_str}
 
 
+def _preload_kwargs() -> Dict:
+  """
+  This function outputs the model.preload arguments from app_config.yaml preload section
+  """
+  warm_up_text = None
+  if CONFIG['preload']['warm_up_example']:
+    with open(CONFIG['preload']['warm_up_example']) as f:
+      warm_up_text = f.read()[:CONFIG['preload']['warm_up_chars']]
+  return {'NER_model_names':CONFIG['preload']['NER'],
+          'RE_model_names':CONFIG['preload']['RE'],
+          'warm_up_text':warm_up_text}
+
+
+def start_preload() -> threading.Thread:
+  """
+  This function loads and warms up the models in app_config.yaml preload section 
+  in a background thread, so the App starts serving immediately.
+  """
+  preload_thread = threading.Thread(target=model.preload, kwargs=_preload_kwargs(), daemon=True)
+  preload_thread.start()
+  return preload_thread
+
+
+def prepare_workers():
+  """
+  This function runs in the pre-fork master process (see gunicorn.conf.py) before 
+  workers are forked. The preload models are loaded once, moved to shared memory 
+  if configured, and the loaded objects are excluded from garbage collection, so 
+  forked workers share the model weights instead of each loading a copy.
+  """
+  model.preload(**_preload_kwargs())
+  if CONFIG['deployment']['share_memory']:
+    model.share_memory()
+  # GC passes in workers would otherwise write to (and copy) the master's object pages
+  gc.collect()
+  gc.freeze()
+
+
 if __name__ == "__main__":
+  start_preload()
   app.run(debug=False, 
+          threaded=True,
           port=CONFIG['port'],
           host=CONFIG['address'])
\ No newline at end of file
@@ -0,0 +1,69 @@
+# -*- coding: utf-8 -*-
+"""
+Benchmark the ONNX Runtime backend against the PyTorch backend on the example notes.
+Reports load time (the first ONNX load includes the export), NER/ RE latency,
+entity/ relation agreement and the max difference of entity/ relation probabilities.
+Run from the project dir:
+  >> python -m benchmarks.backend_benchmark --NER_model i2b2_2018_BERT3 --RE_model i2b2_2018_BERT100% --repeat 3
+"""
+import argparse
+import glob
+import os
+import time
+from IE_model import IE_model
+from ONNX_IE_model import ONNX_IE_model
+
+
+def main():
+  parser = argparse.ArgumentParser()
+  parser.add_argument('--model_dir', type=str, default='models')
+  parser.add_argument('--NER_model', type=str, required=True)
+  parser.add_argument('--RE_model', type=str, required=True)
+  parser.add_argument('--example_dir', type=str, default='examples')
+  parser.add_argument('--intra_op_threads', type=int, default=None)
+  parser.add_argument('--repeat', type=int, default=3)
+  args = parser.parse_args()
+
+  texts = [open(f).read() for f in sorted(glob.glob(os.path.join(args.example_dir, '*.txt')))]
+  print(f'{len(texts)} documents, {sum(len(t) for t in texts)} characters')
+  NER_model_info = {'model_name':args.NER_model}
+  RE_model_info = {'model_name':args.RE_model}
+
+  results = {}
+  for engine, model in [('pytorch', IE_model(model_dir=args.model_dir)),
+                        ('onnxruntime', ONNX_IE_model(model_dir=args.model_dir,
+                                                      intra_op_threads=args.intra_op_threads))]:
+    start_time = time.perf_counter()
+    model._get_model('NER', args.NER_model)
+    model._get_model('RE', args.RE_model)
+    load_ms = (time.perf_counter() - start_time) * 1000
+
+    # RE runs on the pytorch entities, so both stages are compared on the same input
+    start_time = time.perf_counter()
+    for _ in range(args.repeat):
+      entities = [model.get_entities(NER_model_info, text, use_cache=False) for text in texts]
+    NER_ms = (time.perf_counter() - start_time) * 1000 / args.repeat
+    RE_entities = results['pytorch']['entities'] if 'pytorch' in results else entities
+    start_time = time.perf_counter()
+    for _ in range(args.repeat):
+      relations = [model.get_relations(RE_model_info, text, ents, use_cache=False)
+                   for text, ents in zip(texts, RE_entities)]
+    RE_ms = (time.perf_counter() - start_time) * 1000 / args.repeat
+
+    results[engine] = {'entities':entities,
+                       'entity_probs':{(i, e['entity_type'], e['start'], e['end']):e['prob']
+                                       for i, ents in enumerate(entities) for e in ents},
+                       'relation_probs':{(i, r['relation_type'], r['entity_1_id'], r['entity_2_id']):r['relation_prob']
+                                         for i, rels in enumerate(relations) for r in rels}}
+    print(f'{engine:>12} load: {load_ms:.0f} ms, NER: {NER_ms:.0f} ms, RE: {RE_ms:.0f} ms per pass')
+
+  for name in ['entity_probs', 'relation_probs']:
+    a, b = results['pytorch'][name], results['onnxruntime'][name]
+    same = a.keys() & b.keys()
+    max_diff = max((abs(float(a[k]) - float(b[k])) for k in same), default=0.0)
+    print(f'{name.split("_")[0]:>8}: {len(same)} identical, {len(a.keys() ^ b.keys())} different, ' + \
+          f'max probability difference {max_diff:.2e}')
+
+
+if __name__ == '__main__':
+  main()
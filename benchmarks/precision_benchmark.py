@@ -0,0 +1,92 @@
+# -*- coding: utf-8 -*-
+"""
+Benchmark the model precision modes (fp32, int8-dynamic, bf16) on the example notes.
+For each precision, reports load time (first and second load, the second
+int8-dynamic load reads the cached quantized model), model size, NER/ RE latency
+and entity/ relation agreement with fp32. Add --compile_mode torchscript (or torch.compile) 
+to run the models compiled.
+Run from the project dir:
+  >> python -m benchmarks.precision_benchmark --NER_model i2b2_2018_BERT3 --RE_model i2b2_2018_BERT100% --repeat 3
+"""
+import argparse
+import glob
+import os
+import time
+from easydict import EasyDict
+from IE_model import IE_model
+
+
+class precision_IE_model(IE_model):
+  def __init__(self, precision:str, **kwargs):
+    """
+    This class is an IE_model that loads all models in the given precision
+    """
+    super().__init__(**kwargs)
+    self.precision = precision
+
+
+  def _load_model_info(self, mode:str, model_name:str) -> EasyDict:
+    model_info = super()._load_model_info(mode, model_name)
+    model_info['precision'] = self.precision
+    return model_info
+
+
+def agreement(a:set, b:set) -> float:
+  return len(a & b) / len(a | b) if len(a | b) > 0 else 1.0
+
+
+def main():
+  parser = argparse.ArgumentParser()
+  parser.add_argument('--model_dir', type=str, default='models')
+  parser.add_argument('--NER_model', type=str, required=True)
+  parser.add_argument('--RE_model', type=str, required=True)
+  parser.add_argument('--example_dir', type=str, default='examples')
+  parser.add_argument('--precisions', type=str, nargs='+', default=['fp32', 'int8-dynamic', 'bf16'])
+  parser.add_argument('--compile_mode', type=str, default=None)
+  parser.add_argument('--repeat', type=int, default=3)
+  args = parser.parse_args()
+
+  texts = [open(f).read() for f in sorted(glob.glob(os.path.join(args.example_dir, '*.txt')))]
+  print(f'{len(texts)} documents, {sum(len(t) for t in texts)} characters')
+  NER_model_info = {'model_name':args.NER_model}
+  RE_model_info = {'model_name':args.RE_model}
+
+  reference = None
+  for precision in ['fp32'] + [p for p in args.precisions if p != 'fp32']:
+    # load time (a new model instance each time, so the model cache is empty)
+    load_ms = []
+    for _ in range(2):
+      model = precision_IE_model(precision, model_dir=args.model_dir, compile_mode=args.compile_mode)
+      start_time = time.perf_counter()
+      ner = model._get_model('NER', args.NER_model)
+      re_ = model._get_model('RE', args.RE_model)
+      load_ms.append((time.perf_counter() - start_time) * 1000)
+    size_MB = (model._model_size(ner.model) + model._model_size(re_.model)) / 1024**2
+
+    # latency (RE runs on the fp32 entities, so both stages are compared on the same input)
+    start_time = time.perf_counter()
+    for _ in range(args.repeat):
+      entities = [model.get_entities(NER_model_info, text, use_cache=False) for text in texts]
+    NER_ms = (time.perf_counter() - start_time) * 1000 / args.repeat
+    RE_entities = entities if reference is None else reference['entities']
+    start_time = time.perf_counter()
+    for _ in range(args.repeat):
+      relations = [model.get_relations(RE_model_info, text, ents, use_cache=False)
+                   for text, ents in zip(texts, RE_entities)]
+    RE_ms = (time.perf_counter() - start_time) * 1000 / args.repeat
+
+    entity_set = {(i, e['entity_type'], e['start'], e['end']) for i, ents in enumerate(entities) for e in ents}
+    relation_set = {(i, r['relation_type'], r['entity_1_id'], r['entity_2_id'])
+                    for i, rels in enumerate(relations) for r in rels}
+    if reference is None:
+      reference = {'entities':entities, 'entity_set':entity_set, 'relation_set':relation_set}
+
+    if precision in args.precisions:
+      print(f'{precision:>12} load: {load_ms[0]:.0f} ms (second load {load_ms[1]:.0f} ms), ' + \
+            f'size: {size_MB:.1f} MB, NER: {NER_ms:.0f} ms, RE: {RE_ms:.0f} ms per pass, ' + \
+            f'entity agreement: {agreement(entity_set, reference["entity_set"]):.3f}, ' + \
+            f'relation agreement: {agreement(relation_set, reference["relation_set"]):.3f}')
+
+
+if __name__ == '__main__':
+  main()
@@ -0,0 +1,63 @@
+# -*- coding: utf-8 -*-
+"""
+Benchmark the sentence segmenter engines on the example notes, and check that 
+they give the same sentences and segments (exits with status 1 otherwise).
+Run from the project dir:
+  >> python -m benchmarks.segmenter_benchmark --repeat 20
+"""
+import argparse
+import glob
+import os
+import sys
+import time
+from IE_modules.Utilities import Information_Extraction_Document
+from IE_modules.NER_utilities import Sentence_NER_Dataset
+from IE_modules.Segmenter_utilities import get_sentence_segmenter
+
+
+def main():
+  parser = argparse.ArgumentParser()
+  parser.add_argument('--example_dir', type=str, default='examples')
+  parser.add_argument('--repeat', type=int, default=20)
+  args = parser.parse_args()
+
+  IEs = [Information_Extraction_Document(doc_id=os.path.basename(f), text=open(f).read())
+         for f in sorted(glob.glob(os.path.join(args.example_dir, '*.txt')))]
+  texts = [ie['text'] for ie in IEs]
+  print(f'{len(texts)} documents, {sum(len(t) for t in texts)} characters')
+
+  # load time (first call of get_sentence_segmenter)
+  segmenters = {}
+  for engine in ['spacy', 'regex']:
+    start_time = time.perf_counter()
+    segmenters[engine] = get_sentence_segmenter(engine)
+    print(f'{engine:>6} load: {(time.perf_counter() - start_time) * 1000:.1f} ms')
+
+  # segmentation time
+  for engine, segmenter in segmenters.items():
+    start_time = time.perf_counter()
+    for _ in range(args.repeat):
+      segmenter.segment_batch(texts)
+    print(f'{engine:>6} segment: {(time.perf_counter() - start_time) * 1000 / args.repeat:.1f} ms per pass')
+
+  # sentence spans and segment records must be identical
+  spans = {engine:segmenter.segment_batch(texts) for engine, segmenter in segmenters.items()}
+  different = [ie['doc_id'] for ie, a, b in zip(IEs, spans['spacy'], spans['regex']) if a != b]
+  print(f'sentences: {len(IEs) - len(different)}/{len(IEs)} identical documents' + \
+        (f' (DIFFERENT: {", ".join(different)})' if different else ''))
+  ok = len(different) == 0
+  for N_sentences in [1, 3]:
+    segments = {engine:Sentence_NER_Dataset(IEs, tokenizer=None, token_length=256, label_map={},
+                                            has_label=False, N_sentences=N_sentences,
+                                            segmenter=engine).segments
+                for engine in segmenters}
+    n_same = sum(a == b for a, b in zip(segments['spacy'], segments['regex']))
+    identical = segments['spacy'] == segments['regex']
+    print(f'N_sentences={N_sentences}: {n_same}/{len(segments["spacy"])} identical segments ' + \
+          f'({"identical" if identical else "DIFFERENT"})')
+    ok = ok and identical
+  return 0 if ok else 1
+
+
+if __name__ == '__main__':
+  sys.exit(main())
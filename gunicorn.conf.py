@@ -0,0 +1,51 @@
+# -*- coding: utf-8 -*-
+"""
+Production deployment with a pre-fork server (Linux/ macOS):
+  gunicorn -c gunicorn.conf.py app:server
+The App is imported and the preload models are loaded once in the master process, 
+then the workers are forked and share the model weights (copy-on-write, or shared 
+memory if deployment.share_memory is set in app_config.yaml).
+"""
+import os
+import tempfile
+import torch
+from load_config import CONFIG
+
+bind = f"{CONFIG['address']}:{CONFIG['port']}"
+workers = CONFIG['deployment']['workers']
+threads = CONFIG['deployment']['threads']
+timeout = CONFIG['deployment']['timeout']
+# import the App (and the backend model) in the master before forking workers
+preload_app = True
+# background jobs are polled by any worker, so job states are shared on disk
+if workers > 1 and CONFIG['background_jobs']['job_dir'] is None:
+  CONFIG['background_jobs']['job_dir'] = tempfile.mkdtemp(prefix='ie_jobs_')
+
+
+def when_ready(server):
+  """
+  Load the preload models in the master, after the App is imported and before workers are forked. 
+  If this fails, the workers still start and load models at their first request.
+  """
+  from app import prepare_workers
+  # no OpenMP thread pool in the master, workers set their own thread count after fork
+  torch.set_num_threads(1)
+  try:
+    prepare_workers()
+  except Exception:
+    server.log.exception('Preparing workers failed. Models will be loaded by the workers at first use.')
+
+
+def post_fork(server, worker):
+  """
+  Set the torch (and ONNX Runtime) thread count of each worker, by default the CPU 
+  cores are split across workers
+  """
+  torch_threads = CONFIG['deployment']['torch_threads']
+  if torch_threads is None:
+    torch_threads = max(1, os.cpu_count() // workers)
+  torch.set_num_threads(torch_threads)
+  if CONFIG['backend']['engine'] == 'onnxruntime' and CONFIG['backend']['intra_op_threads'] is None:
+    from app import model
+    # ONNX Runtime sessions are created per worker at first use
+    model.set_threads(max(1, os.cpu_count() // workers), CONFIG['backend']['inter_op_threads'])
@@ -0,0 +1,254 @@
+# -*- coding: utf-8 -*-
+import os
+import time
+import threading
+import logging
+from collections import deque
+from typing import Any, Dict, List, Tuple
+from flask import Blueprint, Flask, request, jsonify
+from werkzeug.exceptions import HTTPException, RequestEntityTooLarge
+from modules.utilities import backend_model
+
+
+class api_error(Exception):
+  def __init__(self, message:str, status:int=400):
+    """
+    This exception is returned to the API client as {"error": message} with HTTP status.
+    """
+    super().__init__(message)
+    self.message = message
+    self.status = status
+
+
+class latency_metrics:
+  def __init__(self, window:int=1000):
+    """
+    This class records per-endpoint request latency. Percentiles are calculated
+    over the most recent window requests.
+
+    Parameters
+    ----------
+    window : int, optional
+      Number of recent requests per endpoint for percentiles. The default is 1000.
+    """
+    self.window = window
+    self.lock = threading.Lock()
+    self.endpoints = {}
+
+
+  def record(self, endpoint:str, seconds:float, status:int):
+    with self.lock:
+      if endpoint not in self.endpoints:
+        self.endpoints[endpoint] = {'count':0, 'errors':0, 'total_seconds':0.0,
+                                    'recent':deque(maxlen=self.window)}
+      m = self.endpoints[endpoint]
+      m['count'] += 1
+      m['errors'] += int(status >= 400)
+      m['total_seconds'] += seconds
+      m['recent'].append(seconds)
+
+
+  def stats(self) -> Dict[str, Dict[str, float]]:
+    """
+    This method outputs {endpoint: {count, errors, mean_ms, p50_ms, p95_ms, max_ms}}
+    """
+    with self.lock:
+      out = {}
+      for endpoint, m in self.endpoints.items():
+        recent = sorted(m['recent'])
+        out[endpoint] = {'count':m['count'],
+                         'errors':m['errors'],
+                         'mean_ms':round(1000 * m['total_seconds'] / m['count'], 1),
+                         'p50_ms':round(1000 * recent[len(recent) // 2], 1),
+                         'p95_ms':round(1000 * recent[min(len(recent) - 1, int(len(recent) * 0.95))], 1),
+                         'max_ms':round(1000 * recent[-1], 1)}
+      return out
+
+
+class inference_api:
+  def __init__(self, model:backend_model, model_dir:str, max_documents:int=32, max_chars:int=100000):
+    """
+    This class is a JSON HTTP API over a backend model.
+    POST /api/ner      {"NER_model", "text"} or {"NER_model", "documents":[{"doc_id", "text"}]}
+    POST /api/re       {"RE_model", "text", "entities"} or {"RE_model", "documents":[{"doc_id", "text", "entities"}]}
+    POST /api/extract  {"NER_model", "RE_model", "text"} or {"NER_model", "RE_model", "documents":[{"doc_id", "text"}]}
+    GET  /api/metrics  per-endpoint latency
+    GET  /api/status   backend status {ready, ...}, with HTTP status 503 until the backend is ready
+    A single text returns {"entities", "relations"}; documents return
+    {"documents":[{"doc_id", "entities", "relations"}]}. Entities and relations
+    are the same dicts shown in the App tables.
+
+    Parameters
+    ----------
+    model : backend_model
+      backend model.
+    model_dir : str
+      Directory with NER and RE model folders. Used to validate model names.
+    max_documents : int, optional
+      Max number of documents per request. The default is 32.
+    max_chars : int, optional
+      Max number of characters per document. The default is 100000.
+    """
+    self.model = model
+    self.model_dir = model_dir
+    self.max_documents = max_documents
+    self.max_chars = max_chars
+    self.metrics = latency_metrics()
+    self.blueprint = Blueprint('api', __name__, url_prefix='/api')
+    self.blueprint.add_url_rule('/ner', 'ner', self._endpoint(self.ner), methods=['POST'])
+    self.blueprint.add_url_rule('/re', 're', self._endpoint(self.re), methods=['POST'])
+    self.blueprint.add_url_rule('/extract', 'extract', self._endpoint(self.extract), methods=['POST'])
+    self.blueprint.add_url_rule('/metrics', 'metrics', lambda: jsonify(self.metrics.stats()), methods=['GET'])
+    self.blueprint.add_url_rule('/status', 'status', self.status, methods=['GET'])
+
+
+  def status(self):
+    """
+    This method outputs the backend status, e.g. for readiness checks of a load balancer
+    """
+    status = self.model.status()
+    return jsonify(status), 200 if status['ready'] else 503
+
+
+  def register(self, server:Flask, max_content_MB:float=None):
+    """
+    This method mounts the API on a Flask server (e.g. app.server of Dash)
+
+    Parameters
+    ----------
+    server : Flask
+      Flask server.
+    max_content_MB : float, optional
+      Max request body size (MB). Larger requests are rejected with 413.
+      The default is None (no limit).
+    """
+    if max_content_MB is not None:
+      server.config['MAX_CONTENT_LENGTH'] = int(max_content_MB * 1024**2)
+    server.register_blueprint(self.blueprint)
+
+
+  def _endpoint(self, handler):
+    """
+    This method wraps a handler with JSON parsing, error responses and latency metrics
+    """
+    def view():
+      start_time = time.time()
+      try:
+        body = request.get_json(silent=True)
+        if not isinstance(body, dict):
+          raise api_error('Request body must be a JSON object.')
+        response, status = jsonify(handler(body)), 200
+      except api_error as e:
+        response, status = jsonify({'error':e.message}), e.status
+      except RequestEntityTooLarge:
+        response, status = jsonify({'error':'Request body too large.'}), 413
+      except HTTPException as e:
+        response, status = jsonify({'error':e.description}), e.code
+      except Exception as e:
+        logging.exception(f'API error in {request.path}')
+        response, status = jsonify({'error':f'{type(e).__name__}: {e}'}), 500
+
+      self.metrics.record(request.path, time.time() - start_time, status)
+      return response, status
+    return view
+
+
+  def _model_info(self, body:Dict, key:str, mode:str) -> Dict[str, str]:
+    """
+    This method validates the model name in request body
+    outputs model info {model_name} for the backend model
+    """
+    model_name = body.get(key)
+    if not isinstance(model_name, str) or model_name not in os.listdir(os.path.join(self.model_dir, mode)):
+      raise api_error(f'"{key}" must be one of the {mode} models: {sorted(os.listdir(os.path.join(self.model_dir, mode)))}')
+    return {'model_name':model_name}
+
+
+  def _documents(self, body:Dict, with_entities:bool=False) -> Tuple[List[Dict[str, Any]], bool]:
+    """
+    This method validates the documents in request body
+    outputs a list of {doc_id, text, (entities)} and whether it was a single text
+    """
+    if 'text' in body:
+      documents = [{'doc_id':'input_doc', 'text':body['text'], 'entities':body.get('entities')}]
+      single = True
+    elif isinstance(body.get('documents'), list):
+      documents = body['documents']
+      single = False
+    else:
+      raise api_error('Request must have "text" or "documents".')
+
+    if len(documents) > self.max_documents:
+      raise api_error(f'Too many documents ({len(documents)}), the limit is {self.max_documents}.', 413)
+    for i, doc in enumerate(documents):
+      if not isinstance(doc, dict) or not isinstance(doc.get('text'), str):
+        raise api_error(f'Document {i} must have a "text" string.')
+      if len(doc['text']) > self.max_chars:
+        raise api_error(f'Document {i} has {len(doc["text"])} characters, the limit is {self.max_chars}.', 413)
+      if with_entities:
+        self._validate_entities(doc, i)
+      doc.setdefault('doc_id', f'doc_{i}')
+      if not isinstance(doc['doc_id'], str):
+        raise api_error(f'Document {i} "doc_id" must be a string.')
+
+    if len({doc['doc_id'] for doc in documents}) != len(documents):
+      raise api_error('"doc_id" must be unique.')
+    return documents, single
+
+
+  def _validate_entities(self, doc:Dict, i:int):
+    """
+    This method validates the entities of document i: a list of {entity_id, entity_type, 
+    start, end, (entity_text)} with 0 <= start <= end <= len(text). A missing entity_text 
+    is filled from the text.
+    """
+    if not isinstance(doc.get('entities'), list):
+      raise api_error(f'Document {i} must have an "entities" list.')
+    for j, entity in enumerate(doc['entities']):
+      if not isinstance(entity, dict):
+        raise api_error(f'Document {i} entity {j} must be an object.')
+      for key in ['entity_id', 'entity_type']:
+        if not isinstance(entity.get(key), str):
+          raise api_error(f'Document {i} entity {j} must have "{key}" as a string.')
+      for key in ['start', 'end']:
+        if not isinstance(entity.get(key), int) or isinstance(entity[key], bool):
+          raise api_error(f'Document {i} entity {j} must have "{key}" as an integer.')
+      if not 0 <= entity['start'] <= entity['end'] <= len(doc['text']):
+        raise api_error(f'Document {i} entity {j} must have 0 <= "start" <= "end" <= text length.')
+      entity.setdefault('entity_text', doc['text'][entity['start']:entity['end']].replace('\n', ' '))
+      if not isinstance(entity['entity_text'], str):
+        raise api_error(f'Document {i} entity {j} "entity_text" must be a string.')
+
+
+  def ner(self, body:Dict) -> Dict:
+    NER_model_info = self._model_info(body, 'NER_model', 'NER')
+    documents, single = self._documents(body)
+    entities = self.model.get_entities_batch(NER_model_info, [(doc['doc_id'], doc['text']) for doc in documents])
+    return self._response([{'doc_id':doc['doc_id'], 'entities':entities[doc['doc_id']]} for doc in documents], single)
+
+
+  def re(self, body:Dict) -> Dict:
+    RE_model_info = self._model_info(body, 'RE_model', 'RE')
+    documents, single = self._documents(body, with_entities=True)
+    relations = self.model.get_relations_batch(RE_model_info, [(doc['doc_id'], doc['text'], doc['entities'])
+                                                               for doc in documents])
+    return self._response([{'doc_id':doc['doc_id'], 'relations':relations[doc['doc_id']]} for doc in documents], single)
+
+
+  def extract(self, body:Dict) -> Dict:
+    NER_model_info = self._model_info(body, 'NER_model', 'NER')
+    RE_model_info = self._model_info(body, 'RE_model', 'RE')
+    documents, single = self._documents(body)
+    entities = self.model.get_entities_batch(NER_model_info, [(doc['doc_id'], doc['text']) for doc in documents])
+    relations = self.model.get_relations_batch(RE_model_info, [(doc['doc_id'], doc['text'], entities[doc['doc_id']])
+                                                               for doc in documents])
+    return self._response([{'doc_id':doc['doc_id'],
+                            'entities':entities[doc['doc_id']],
+                            'relations':relations[doc['doc_id']]} for doc in documents], single)
+
+
+  def _response(self, results:List[Dict], single:bool) -> Dict:
+    if single:
+      results[0].pop('doc_id')
+      return results[0]
+    return {'documents':results}
@@ -0,0 +1,230 @@
+# -*- coding: utf-8 -*-
+import os
+import json
+import hashlib
+import threading
+import logging
+from collections import OrderedDict
+from typing import Any, Callable, Dict, Hashable, Tuple
+
+
+class model_cache:
+  def __init__(self, memory_budget_MB:float=None):
+    """
+    This class keeps loaded backend models (e.g. model, tokenizer and config)
+    resident in memory, keyed by any hashable key such as (mode, model_name).
+    When the total size of resident entries exceeds the memory budget, the least
+    recently used entries are evicted.
+
+    Parameters
+    ----------
+    memory_budget_MB : float, optional
+      Max resident memory (MB) for cached entries. The default is None (no limit).
+      The most recently used entry is always kept, even if it alone exceeds the budget.
+    """
+    self.memory_budget = None if memory_budget_MB is None else memory_budget_MB * 1024**2
+    self.entries = OrderedDict()
+    self.sizes = {}
+    self.lock = threading.RLock()
+    # per-key locks for entries being loaded
+    self.load_locks = {}
+    self.hits = 0
+    self.misses = 0
+    self.evictions = 0
+
+
+  def get(self, key:Hashable, loader:Callable[[], Tuple[Any, int]]) -> Any:
+    """
+    This method returns the cached entry for key. If not cached, the loader is
+    called to load it and the LRU entries are evicted to fit the memory budget.
+    Concurrent calls for the same key wait for one load.
+
+    Parameters
+    ----------
+    key : Hashable
+      cache key.
+    loader : Callable[[], Tuple[Any, int]]
+      function that loads the entry and returns (entry, size in bytes).
+    """
+    with self.lock:
+      if key in self.entries:
+        return self._hit(key)
+      load_lock = self.load_locks.setdefault(key, threading.Lock())
+
+    # one caller loads the entry, concurrent callers of the same key wait for it.
+    # Other keys are not blocked while loading
+    with load_lock:
+      with self.lock:
+        if key in self.entries:
+          return self._hit(key)
+        self.misses += 1
+
+      entry, size = loader()
+      with self.lock:
+        self.entries[key] = entry
+        self.sizes[key] = size
+        self.load_locks.pop(key, None)
+        self._evict()
+        logging.info(f'Model cache: {self.stats()}')
+      return entry
+
+
+  def _hit(self, key:Hashable) -> Any:
+    self.hits += 1
+    self.entries.move_to_end(key)
+    return self.entries[key]
+
+
+  def _evict(self):
+    """
+    This method evicts least recently used entries until the total size fits
+    the memory budget. The most recently used entry is never evicted.
+    """
+    if self.memory_budget is None:
+      return
+
+    while len(self.entries) > 1 and sum(self.sizes.values()) > self.memory_budget:
+      key, _ = self.entries.popitem(last=False)
+      del self.sizes[key]
+      self.evictions += 1
+      logging.info(f'Model cache: evicted {key}')
+
+
+  def __contains__(self, key:Hashable) -> bool:
+    return key in self.entries
+
+
+  def fits(self, size:int) -> bool:
+    """
+    This method outputs whether an entry of size bytes can be added without 
+    evicting resident entries
+    """
+    with self.lock:
+      return self.memory_budget is None or sum(self.sizes.values()) + size <= self.memory_budget
+
+
+  def clear(self):
+    """
+    This method releases all cached entries. Counters are kept.
+    """
+    with self.lock:
+      self.evictions += len(self.entries)
+      self.entries.clear()
+      self.sizes.clear()
+
+
+  def stats(self) -> Dict[str, Any]:
+    """
+    This method outputs cache statistics as dict
+    {hits, misses, evictions, entries, resident_MB, budget_MB}
+    """
+    return {'hits':self.hits,
+            'misses':self.misses,
+            'evictions':self.evictions,
+            'entries':list(self.entries.keys()),
+            'resident_MB':round(sum(self.sizes.values()) / 1024**2, 1),
+            'budget_MB':None if self.memory_budget is None else self.memory_budget / 1024**2}
+
+
+class result_cache:
+  def __init__(self, max_entries:int=1024, cache_dir:str=None):
+    """
+    This class caches prediction results (JSON-serializable) by a content key.
+    Results are kept in an in-memory LRU tier and, optionally, in an on-disk tier
+    (one JSON file per key) that survives restarts.
+
+    Parameters
+    ----------
+    max_entries : int, optional
+      Max number of results in memory. The default is 1024.
+    cache_dir : str, optional
+      Directory for the on-disk tier. The default is None (no on-disk tier).
+    """
+    self.max_entries = max_entries
+    self.cache_dir = cache_dir
+    if self.cache_dir is not None:
+      os.makedirs(self.cache_dir, exist_ok=True)
+    # results are stored as JSON strings, so callers cannot modify cached results
+    self.entries = OrderedDict()
+    self.lock = threading.RLock()
+    self.hits = 0
+    self.disk_hits = 0
+    self.misses = 0
+
+
+  @staticmethod
+  def hash(obj:Any) -> str:
+    """
+    This method outputs a SHA-256 hex digest of a string or a JSON-serializable object
+    """
+    if not isinstance(obj, str):
+      obj = json.dumps(obj, sort_keys=True, default=str)
+    return hashlib.sha256(obj.encode('utf-8')).hexdigest()
+
+
+  def _path(self, key:str) -> str:
+    return os.path.join(self.cache_dir, f'{self.hash(key)}.json')
+
+
+  def get(self, key:str) -> Any:
+    """
+    This method outputs the cached result for key, or None if not cached.
+    """
+    with self.lock:
+      if key in self.entries:
+        self.hits += 1
+        self.entries.move_to_end(key)
+        return json.loads(self.entries[key])
+
+      if self.cache_dir is not None and os.path.isfile(self._path(key)):
+        with open(self._path(key)) as f:
+          value = f.read()
+        self.disk_hits += 1
+        self._put_memory(key, value)
+        return json.loads(value)
+
+      self.misses += 1
+      return None
+
+
+  def put(self, key:str, result:Any):
+    """
+    This method caches a JSON-serializable result for key.
+    """
+    value = json.dumps(result)
+    with self.lock:
+      self._put_memory(key, value)
+      if self.cache_dir is not None:
+        # write to a temp file then rename, so readers never see partial files
+        tmp_path = f'{self._path(key)}.{os.getpid()}.{threading.get_ident()}.tmp'
+        with open(tmp_path, 'w') as f:
+          f.write(value)
+        os.replace(tmp_path, self._path(key))
+
+
+  def _put_memory(self, key:str, value:str):
+    self.entries[key] = value
+    self.entries.move_to_end(key)
+    while len(self.entries) > self.max_entries:
+      self.entries.popitem(last=False)
+
+
+  def clear(self):
+    """
+    This method releases the in-memory tier. The on-disk tier is kept.
+    """
+    with self.lock:
+      self.entries.clear()
+
+
+  def stats(self) -> Dict[str, Any]:
+    """
+    This method outputs cache statistics as dict
+    {hits, disk_hits, misses, entries, max_entries, cache_dir}
+    """
+    return {'hits':self.hits,
+            'disk_hits':self.disk_hits,
+            'misses':self.misses,
+            'entries':len(self.entries),
+            'max_entries':self.max_entries,
+            'cache_dir':self.cache_dir}
@@ -0,0 +1,84 @@
+# -*- coding: utf-8 -*-
+import re
+import difflib
+import bisect
+from typing import List, Tuple
+
+
+def get_equal_blocks(prev_text:str, text:str) -> List[Tuple[int, int, int]]:
+  """
+  This function diffs a text against its previous version
+  outputs the unchanged blocks as a list of (prev_start, start, length), sorted by position.
+  The common prefix and suffix are matched first, the rest is diffed by words,
+  so small edits in long documents are fast.
+
+  Parameters
+  ----------
+  prev_text : str
+    previous version of the text.
+  text : str
+    current version of the text.
+  """
+  max_common = min(len(prev_text), len(text))
+  prefix = 0
+  while prefix < max_common and prev_text[prefix] == text[prefix]:
+    prefix += 1
+  suffix = 0
+  while suffix < max_common - prefix and prev_text[-suffix-1] == text[-suffix-1]:
+    suffix += 1
+
+  blocks = [(0, 0, prefix)]
+  # diff the middle part by words and whitespaces
+  prev_words = re.findall(r'\s+|\S+', prev_text[prefix:len(prev_text) - suffix])
+  words = re.findall(r'\s+|\S+', text[prefix:len(text) - suffix])
+  prev_offsets = _word_offsets(prev_words, prefix)
+  offsets = _word_offsets(words, prefix)
+  matcher = difflib.SequenceMatcher(None, prev_words, words, autojunk=False)
+  for a, b, size in matcher.get_matching_blocks():
+    if size > 0:
+      blocks.append((prev_offsets[a], offsets[b], prev_offsets[a + size] - prev_offsets[a]))
+  blocks.append((len(prev_text) - suffix, len(text) - suffix, suffix))
+
+  # merge adjacent blocks
+  merged = []
+  for prev_start, start, length in blocks:
+    if length == 0:
+      continue
+    if merged and merged[-1][0] + merged[-1][2] == prev_start and merged[-1][1] + merged[-1][2] == start:
+      merged[-1] = (merged[-1][0], merged[-1][1], merged[-1][2] + length)
+    else:
+      merged.append((prev_start, start, length))
+  return merged
+
+
+def _word_offsets(words:List[str], start:int) -> List[int]:
+  """
+  This function outputs the start offset of each word, plus the end offset
+  """
+  offsets = [start]
+  for word in words:
+    offsets.append(offsets[-1] + len(word))
+  return offsets
+
+
+def map_span(start:int, end:int, blocks:List[Tuple[int, int, int]],
+             to_prev:bool=False) -> Tuple[int, int]:
+  """
+  This function maps a span of the previous text to the current text, or
+  the current text to the previous text if to_prev=True.
+  outputs the mapped (start, end), or None if the span is not within an unchanged block.
+  """
+  for prev_start, cur_start, length in blocks:
+    from_start, to_start = (cur_start, prev_start) if to_prev else (prev_start, cur_start)
+    if from_start <= start and end <= from_start + length:
+      return (start - from_start + to_start, end - from_start + to_start)
+  return None
+
+
+def overlaps(start:int, end:int, spans:List[Tuple[int, int]]) -> bool:
+  """
+  This function outputs whether the span (start, end) overlaps any of the spans.
+  spans must be sorted and not overlapping each other.
+  """
+  i = bisect.bisect_left(spans, (end,)) - 1
+  return i >= 0 and spans[i][1] > start
@@ -0,0 +1,343 @@
+# -*- coding: utf-8 -*-
+import os
+import copy
+import json
+import time
+import uuid
+import threading
+import logging
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Callable, Dict, Hashable
+
+
+class job_cancelled(Exception):
+  """
+  This exception is raised in a running job when it is cancelled.
+  """
+
+
+class job_timeout(job_cancelled):
+  """
+  This exception is raised in a running job when it exceeds the time limit.
+  """
+
+
+class job_rejected(Exception):
+  """
+  This exception is raised by job_manager.submit when the job queue is full.
+  """
+
+
+class job:
+  def __init__(self, job_id:str, manager:'job_manager', deadline:float=None):
+    """
+    This class is the handle passed to a job function. The job function reports
+    its progress with update(), which raises job_cancelled if the job was cancelled
+    or job_timeout if the deadline has passed.
+    """
+    self.job_id = job_id
+    self.manager = manager
+    self.deadline = deadline
+    self.partial = {}
+
+
+  def update(self, stage:str, done:int=0, total:int=0):
+    """
+    This method records the progress of the job, e.g. ('NER', 3, 10).
+    It raises job_cancelled if the job was cancelled or job_timeout if it timed out.
+    """
+    if self.manager.is_cancelled(self.job_id):
+      raise job_cancelled(self.job_id)
+    if self.deadline is not None and time.time() > self.deadline:
+      raise job_timeout(self.job_id)
+    self.manager._set(self.job_id, progress={'stage':stage, 'done':done, 'total':total})
+
+
+  def put_partial(self, **results):
+    """
+    This method records partial results of the job before it is done,
+    e.g. put_partial(entities=[...]). Results must be JSON-serializable.
+    """
+    with self.manager.lock:
+      self.partial.update(results)
+    self.manager._set(self.job_id, partial=self.partial)
+
+
+  def append_partial(self, **results):
+    """
+    This method appends new partial results to the lists recorded so far, 
+    e.g. append_partial(entities=[...]) with the entities found since the last call.
+    """
+    with self.manager.lock:
+      for name, values in results.items():
+        self.partial.setdefault(name, []).extend(values)
+    self.manager._set(self.job_id, partial=self.partial)
+
+
+class job_manager:
+  def __init__(self, max_workers:int=2, job_dir:str=None, ttl_s:float=600,
+               max_queued:int=None, timeout_s:float=None, write_interval_s:float=0.5):
+    """
+    This class runs jobs (e.g. NER and RE of a submitted note) in background
+    threads, so web requests return immediately and the client polls the job
+    state {status, progress, partial, result, error}. status is one of queued,
+    running, done, error or cancelled. Job states are kept in memory and, if job_dir is
+    given, also written to job_dir, so any process sharing job_dir (e.g. gunicorn
+    workers) can poll or cancel a job.
+    Admission control: submit() rejects jobs when max_queued jobs are already
+    waiting, identical in-flight jobs (same key) are shared by their submitters,
+    and jobs that exceed timeout_s stop at their next progress update. The number 
+    of submitters of a job (refs) is kept in its state, so a cancel from another 
+    process only cancels the job when no other submitter waits for it.
+
+    Parameters
+    ----------
+    max_workers : int, optional
+      Max number of jobs running at the same time, the others wait in queue. The default is 2.
+    job_dir : str, optional
+      Directory for job states shared across processes. The default is None (memory only).
+    ttl_s : float, optional
+      Finished jobs not collected within ttl_s seconds are removed. The default is 600.
+    max_queued : int, optional
+      Max number of jobs waiting for a worker. The default is None (no limit).
+    timeout_s : float, optional
+      Max seconds from submission to the end of a job. The default is None (no limit).
+    write_interval_s : float, optional
+      Min seconds between writes of a job state to job_dir for progress and partial 
+      updates. Status changes are always written. The default is 0.5.
+    """
+    self.job_dir = job_dir
+    if self.job_dir is not None:
+      os.makedirs(self.job_dir, exist_ok=True)
+    self.ttl = ttl_s
+    self.max_workers = max_workers
+    self.max_queued = max_queued
+    self.timeout = timeout_s
+    self.write_interval = write_interval_s
+    # time of the last write of each job state to job_dir
+    self.written = {}
+    self.executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='job')
+    self.jobs = {}
+    self.cancelled = set()
+    # number of submitters of each in-flight job, and in-flight jobs by key
+    self.refs = {}
+    self.keys = {}
+    self.job_keys = {}
+    self.lock = threading.RLock()
+    self.rejected = 0
+
+
+  def submit(self, fn:Callable[..., Any], *args, key:Hashable=None, **kwargs) -> str:
+    """
+    This method queues fn(job, *args, **kwargs) and outputs the job ID.
+    The return value of fn and key must be JSON-serializable. If key is given and a job
+    with the same key is queued or running, its job ID is returned instead.
+    Raises job_rejected if max_queued jobs are waiting.
+    """
+    self._cleanup()
+    with self.lock:
+      if key is not None and key in self.keys and not self.is_cancelled(self.keys[key]):
+        job_id = self.keys[key]
+        self.refs[job_id] += 1
+        self._set(job_id, refs=self.refs[job_id])
+        logging.info(f'Job {job_id} shared by {self.refs[job_id]} submitters')
+        return job_id
+
+      queued = sum(state['status'] == 'queued' for state in self.jobs.values())
+      if self.max_queued is not None and queued >= self.max_queued:
+        self.rejected += 1
+        raise job_rejected(f'{queued} jobs are waiting')
+
+      job_id = uuid.uuid4().hex
+      self.refs[job_id] = 1
+      if key is not None:
+        self.keys[key] = job_id
+        self.job_keys[job_id] = key
+      self._set(job_id, status='queued', key=key, refs=1, progress=None, partial=None, result=None, error=None)
+
+    deadline = None if self.timeout is None else time.time() + self.timeout
+    self.executor.submit(self._run, job_id, fn, args, kwargs, deadline)
+    return job_id
+
+
+  def _run(self, job_id:str, fn:Callable[..., Any], args:tuple, kwargs:Dict, deadline:float):
+    try:
+      if self.is_cancelled(job_id):
+        self._set(job_id, status='cancelled')
+        return
+      if deadline is not None and time.time() > deadline:
+        raise job_timeout(job_id)
+
+      self._set(job_id, status='running')
+      result = fn(job(job_id, self, deadline), *args, **kwargs)
+      self._set(job_id, status='done', result=result)
+    except job_timeout:
+      logging.info(f'Job {job_id} timed out')
+      self._set(job_id, status='error', error=f'Processing took longer than {self.timeout} seconds.')
+    except job_cancelled:
+      logging.info(f'Job {job_id} cancelled')
+      self._set(job_id, status='cancelled')
+    except Exception as e:
+      logging.exception(f'Job {job_id} failed')
+      self._set(job_id, status='error', error=f'{type(e).__name__}: {e}')
+    finally:
+      self._release_key(job_id)
+
+
+  def _release_key(self, job_id:str):
+    """
+    This method stops sharing a job with new submitters
+    """
+    with self.lock:
+      key = self.job_keys.pop(job_id, None)
+      if key is not None and self.keys.get(key) == job_id:
+        del self.keys[key]
+
+
+  def get(self, job_id:str) -> Dict[str, Any]:
+    """
+    This method outputs the job state {status, key, refs, progress, partial, result, error, time},
+    or None if the job is not found. time is the time of the last update.
+    """
+    with self.lock:
+      if job_id in self.jobs:
+        state = dict(self.jobs[job_id])
+        # partial results are extended in place by the job
+        if state.get('partial') is not None:
+          state['partial'] = {name:copy.copy(value) for name, value in state['partial'].items()}
+        return state
+
+    if self.job_dir is not None and os.path.exists(self._path(job_id)):
+      try:
+        with open(self._path(job_id)) as f:
+          return json.load(f)
+      except (OSError, ValueError):
+        return None
+    return None
+
+
+  def cancel(self, job_id:str):
+    """
+    This method cancels a job for one submitter. The job is cancelled when no
+    other submitter waits for it: a queued job does not start, a running job
+    stops at its next progress update. With job_dir, each cancel writes a cancel 
+    request file, and a job owned by another process is cancelled when the 
+    requests reach its number of submitters.
+    """
+    with self.lock:
+      if self.refs.get(job_id, 0) - self._cancel_requests(job_id) > 1:
+        self.refs[job_id] -= 1
+        self._set(job_id, refs=self.refs[job_id])
+        return
+      if job_id in self.refs:
+        self.refs.pop(job_id)
+        self.cancelled.add(job_id)
+        self._release_key(job_id)
+    if self.job_dir is not None:
+      open(self._path(job_id, f'{uuid.uuid4().hex}.cancel'), 'w').close()
+
+
+  def is_cancelled(self, job_id:str) -> bool:
+    if job_id in self.cancelled:
+      return True
+    if self.job_dir is None:
+      return False
+    requests = self._cancel_requests(job_id)
+    if requests == 0:
+      return False
+    with self.lock:
+      refs = self.refs.get(job_id)
+    if refs is None:
+      # job owned by another process
+      state = self.get(job_id)
+      refs = 1 if state is None else state.get('refs', 1)
+    return requests >= refs
+
+
+  def _cancel_requests(self, job_id:str) -> int:
+    """
+    This method outputs the number of cancel request files of a job in job_dir
+    """
+    if self.job_dir is None:
+      return 0
+    return sum(file_name.startswith(f'{job_id}.') and file_name.endswith('.cancel') 
+               for file_name in os.listdir(self.job_dir))
+
+
+  def pop(self, job_id:str):
+    """
+    This method removes a job after its result is collected by all submitters.
+    Files in job_dir are removed after ttl, since other processes may still poll them.
+    """
+    with self.lock:
+      if self.refs.get(job_id, 0) > 1:
+        self.refs[job_id] -= 1
+        return
+      self.refs.pop(job_id, None)
+      self.jobs.pop(job_id, None)
+      self.written.pop(job_id, None)
+      self.cancelled.discard(job_id)
+
+
+  def stats(self) -> Dict[str, int]:
+    """
+    This method outputs {queued, running, rejected}
+    """
+    with self.lock:
+      statuses = [state['status'] for state in self.jobs.values()]
+      return {'queued':statuses.count('queued'),
+              'running':statuses.count('running'),
+              'rejected':self.rejected}
+
+
+  def _path(self, job_id:str, ext:str='json') -> str:
+    return os.path.join(self.job_dir, f'{job_id}.{ext}')
+
+
+  def _set(self, job_id:str, **fields):
+    """
+    This method updates the job state, and writes it to job_dir if given. 
+    Progress and partial updates are written at most every write_interval seconds, 
+    status and refs changes are always written.
+    """
+    now = time.time()
+    with self.lock:
+      state = self.jobs.setdefault(job_id, {})
+      state.update(fields, time=now)
+      if self.job_dir is None:
+        return
+      if 'status' not in fields and 'refs' not in fields and \
+        now - self.written.get(job_id, 0) < self.write_interval:
+        return
+      self.written[job_id] = now
+      # serialized in the lock, since partial results are extended in place by the job
+      data = json.dumps(state)
+
+    tmp_path = self._path(job_id, f'{threading.get_ident()}.tmp')
+    with open(tmp_path, 'w') as f:
+      f.write(data)
+    os.replace(tmp_path, self._path(job_id))
+
+
+  def _cleanup(self):
+    """
+    This method removes finished jobs not updated within ttl
+    """
+    expired = time.time() - self.ttl
+    with self.lock:
+      job_ids = [job_id for job_id, state in self.jobs.items()
+                 if state['status'] in ('done', 'error', 'cancelled') and state['time'] < expired]
+      for job_id in job_ids:
+        self.refs.pop(job_id, None)
+        self.jobs.pop(job_id, None)
+        self.written.pop(job_id, None)
+        self.cancelled.discard(job_id)
+
+    if self.job_dir is not None:
+      for file_name in os.listdir(self.job_dir):
+        path = os.path.join(self.job_dir, file_name)
+        try:
+          if os.path.getmtime(path) < expired:
+            os.remove(path)
+        except OSError:
+          pass
@@ -0,0 +1,105 @@
+# -*- coding: utf-8 -*-
+import os
+import time
+import threading
+import logging
+from collections import deque
+from concurrent.futures import Future
+from typing import Any, Callable, Dict, Hashable, List
+
+
+class batch_scheduler:
+  def __init__(self, window_ms:float=5):
+    """
+    This class collects model inputs from concurrent requests and runs them in
+    shared batches (micro-batching). Inputs are queued by key (e.g. one key per
+    model). A worker thread per key waits up to window_ms after the first queued
+    input, or until batch_size inputs are queued, runs one batch and returns
+    each output to the request that submitted it.
+
+    Parameters
+    ----------
+    window_ms : float, optional
+      Max time (ms) to wait for more inputs before running a batch. The default is 5.
+    """
+    self.window = window_ms / 1000
+    self._reset()
+    # worker threads do not survive fork (e.g. pre-fork servers), start over in the child
+    if hasattr(os, 'register_at_fork'):
+      os.register_at_fork(after_in_child=self._reset)
+
+
+  def _reset(self):
+    self.cond = threading.Condition()
+    self.queues = {}
+    self.workers = {}
+    self.batches = 0
+    self.items = 0
+
+
+  def submit(self, key:Hashable, items:List[Any], run_batch:Callable[[List[Any]], List[Any]],
+             batch_size:int) -> List[Any]:
+    """
+    This method queues items and blocks until all their outputs are ready.
+    outputs a list of outputs in the same order as items.
+
+    Parameters
+    ----------
+    key : Hashable
+      batch key. Items with the same key must be runnable in one batch, by the 
+      run_batch of any of them.
+    items : List[Any]
+      model inputs.
+    run_batch : Callable[[List[Any]], List[Any]]
+      function that inputs a list of items and outputs a list of outputs. It must only 
+      depend on the key (e.g. the model), not on the request, and not update request state.
+    batch_size : int
+      Max number of items per batch.
+    """
+    futures = [Future() for _ in items]
+    with self.cond:
+      queue = self.queues.setdefault(key, deque())
+      queue.extend((item, future, run_batch, batch_size) for item, future in zip(items, futures))
+      if key not in self.workers:
+        self.workers[key] = threading.Thread(target=self._worker, args=(key,), daemon=True)
+        self.workers[key].start()
+      self.cond.notify_all()
+
+    return [future.result() for future in futures]
+
+
+  def _worker(self, key:Hashable):
+    queue = self.queues[key]
+    while True:
+      with self.cond:
+        while not queue:
+          self.cond.wait()
+        # wait for more items until the window closes or the batch is full
+        deadline = time.time() + self.window
+        batch_size = queue[0][3]
+        while len(queue) < batch_size and time.time() < deadline:
+          self.cond.wait(deadline - time.time())
+        batch = [queue.popleft() for _ in range(min(batch_size, len(queue)))]
+
+      # items with the same key share one run_batch function
+      items, futures, run_batches, _ = zip(*batch)
+      try:
+        outputs = run_batches[0](list(items))
+        for future, output in zip(futures, outputs):
+          future.set_result(output)
+      except Exception as e:
+        logging.exception(f'Batch scheduler: batch {key} failed')
+        for future in futures:
+          future.set_exception(e)
+
+      self.batches += 1
+      self.items += len(batch)
+
+
+  def stats(self) -> Dict[str, float]:
+    """
+    This method outputs {batches, items, mean_batch_size}
+    """
+    return {'batches':self.batches,
+            'items':self.items,
+            'mean_batch_size':round(self.items / self.batches, 1) if self.batches else 0}
@@ -1,7 +1,7 @@
 # -*- coding: utf-8 -*-
 import abc
 import os
-from typing import Dict, List
+from typing import Any, Callable, Dict, List, Tuple
 from easydict import EasyDict
 import yaml
 import pandas as pd
@@ -164,16 +164,22 @@ class backend_model:
   def __init__(self):
     """
     This is a parent class for individual backend implementation to inherit
-    The get_entities(), get_relations(), and reset() methods must be implemented and return 
-    consistent data structure as defined.
+    The get_entities() and get_relations() methods must be implemented and return 
+    consistent data structure as defined. The backend is shared by all sessions, 
+    so loaded models are not released when a session clears its input.
     """
     pass
   
   @abc.abstractmethod
-  def get_entities(self, text:str) -> List[Dict[str,str]]:
+  def get_entities(self, NER_model_info:Dict[str,str], text:str, 
+                   progress:Callable[[str, int, int], None]=None, 
+                   partial:Callable[[List[Dict[str,str]]], None]=None) -> List[Dict[str,str]]:
     """
-    This method inputs the text (from input textbox) 
-    and outputs a dict of extracted entities
+    This method inputs the NER model info and the text (from input textbox) 
+    and outputs a dict of extracted entities. The App also passes two optional 
+    callbacks, which backends can ignore: progress(stage, done, total) for the 
+    progress display and cancellation, and partial(entities) with the new entities 
+    since its last call for streaming.
 
     Returns
     -------
@@ -184,11 +190,14 @@ class backend_model:
     
     
   @abc.abstractmethod
-  def get_relations(self, text:str, entities:List[Dict[str,str]]) -> List[Dict[str,str]]:
+  def get_relations(self, RE_model_info:Dict[str,str], text:str, entities:List[Dict[str,str]], 
+                    progress:Callable[[str, int, int], None]=None, 
+                    partial:Callable[[List[Dict[str,str]]], None]=None) -> List[Dict[str,str]]:
     """
-    This method inputs the text (from input textbox) and a list of entities:
+    This method inputs the RE model info, the text (from input textbox) and a list of entities:
       list of dict with {entity_id, entity_type, entity_text, start, end}
-    Outputs a dict of extracted relations
+    Outputs a dict of extracted relations. progress and partial are optional 
+    callbacks as in get_entities().
 
     Returns
     -------
@@ -198,10 +207,78 @@ class backend_model:
     """
     return NotImplemented
   
-  @abc.abstractmethod
-  def reset(self):
+  
+  def get_entities_batch(self, NER_model_info:Dict[str,str], docs:List[Tuple[str,str]], 
+                         progress:Callable[[str, int, int], None]=None, 
+                         partial:Callable[[Dict[str, List[Dict[str,str]]]], None]=None) -> Dict[str, List[Dict[str,str]]]:
+    """
+    This method inputs a list of (doc_id, text) 
+    outputs a dict of {doc_id: entities}, entities as in get_entities(). 
+    partial receives {doc_id: new entities}. 
+    Children classes can override this to batch documents together. 
+    The default runs get_entities() on each document.
+    """
+    return {doc_id:self.get_entities(NER_model_info, text, progress=progress, 
+                                     partial=self._doc_partial(partial, doc_id)) for doc_id, text in docs}
+  
+  
+  def get_relations_batch(self, RE_model_info:Dict[str,str], docs:List[Tuple[str,str,List[Dict[str,str]]]], 
+                          progress:Callable[[str, int, int], None]=None, 
+                          partial:Callable[[Dict[str, List[Dict[str,str]]]], None]=None) -> Dict[str, List[Dict[str,str]]]:
+    """
+    This method inputs a list of (doc_id, text, entities) 
+    outputs a dict of {doc_id: relations}, relations as in get_relations(). 
+    partial receives {doc_id: new relations}. 
+    Children classes can override this to batch documents together. 
+    The default runs get_relations() on each document.
+    """
+    return {doc_id:self.get_relations(RE_model_info, text, entities, progress=progress, 
+                                      partial=self._doc_partial(partial, doc_id)) for doc_id, text, entities in docs}
+  
+  
+  @staticmethod
+  def _doc_partial(partial:Callable[[Dict[str, List[Dict[str,str]]]], None], 
+                   doc_id:str) -> Callable[[List[Dict[str,str]]], None]:
+    """
+    This method outputs a per-document partial callback that forwards {doc_id: results} 
+    to the batch partial callback, or None
+    """
+    if partial is None:
+      return None
+    return lambda results: partial({doc_id:results})
+  
+  
+  def get_entities_incremental(self, NER_model_info:Dict[str,str], text:str, 
+                               prev_text:str, prev_entities:List[Dict[str,str]], 
+                               progress:Callable[[str, int, int], None]=None, 
+                               partial:Callable[[List[Dict[str,str]]], None]=None) -> List[Dict[str,str]]:
+    """
+    This method inputs the text and the previous submission (text and its entities)
+    outputs the entities of the text, same as get_entities(). 
+    Children classes can override this to only process the edited parts of the text. 
+    The default runs get_entities() on the whole text.
+    """
+    return self.get_entities(NER_model_info, text, progress=progress, partial=partial)
+  
+  
+  def get_relations_incremental(self, RE_model_info:Dict[str,str], text:str, entities:List[Dict[str,str]], 
+                                prev_text:str, prev_entities:List[Dict[str,str]], 
+                                prev_relations:List[Dict[str,str]], 
+                                progress:Callable[[str, int, int], None]=None, 
+                                partial:Callable[[List[Dict[str,str]]], None]=None) -> List[Dict[str,str]]:
+    """
+    This method inputs the text, entities and the previous submission (text, entities and relations)
+    outputs the relations of the text, same as get_relations(). 
+    Children classes can override this to only process the entity pairs affected by edits. 
+    The default runs get_relations() on the whole text.
+    """
+    return self.get_relations(RE_model_info, text, entities, progress=progress, partial=partial)
+  
+  
+  def status(self) -> Dict[str, Any]:
     """
-    This method releases backend model resources and reset the model names (if any)
-    to default. This method is called when clear button click. 
+    This method outputs the backend status {ready, ...}. ready is False while the 
+    backend is not ready for requests (e.g. models are preloading). 
+    Children classes can override this to add details. The default is always ready.
     """
-    return NotImplemented
\ No newline at end of file
+    return {'ready':True}